@@ -14,8 +14,10 @@
 #    under the License.
 
 from oslo.config import cfg
+import webob.exc
 
 from glance.common import exception
+from glance.common import utils
 from glance.openstack.common import log as logging
 
 LOG = logging.getLogger(__name__)
@@ -55,6 +57,86 @@ def size_checked_iter(response, image_meta, expected_size, image_iter,
                                           "image %(image_id)s") % locals())
 
 
+def checked_image_iter(response, image_meta, expected_size, image_iter,
+                       notifier):
+    """
+    Wrap image data in a size_checked_iter. If the data is backed by a
+    file, the result remains a FileWrapper so that the WSGI server can still
+    send it with sendfile, in which case the size check and notification
+    are done once the server reports how much was transmitted.
+    """
+    checked_iter = size_checked_iter(response, image_meta, expected_size,
+                                     image_iter, notifier)
+    if not isinstance(image_iter, utils.FileWrapper):
+        return checked_iter
+
+    def transmitted(bytes_written):
+        image_id = image_meta['id']
+
+        def notify_image_sent_hook(env):
+            image_send_notification(bytes_written, expected_size,
+                                    image_meta, response.request, notifier)
+
+        if 'eventlet.posthooks' in response.request.environ:
+            response.request.environ['eventlet.posthooks'].append(
+                (notify_image_sent_hook, (), {}))
+
+        if expected_size != bytes_written:
+            msg = _("Backend storage for image %(image_id)s "
+                    "disconnected after writing only %(bytes_written)d "
+                    "bytes") % locals()
+            LOG.error(msg)
+
+    return image_iter.wrap(checked_iter, callback=transmitted)
+
+
+def get_image_range(request, image_size):
+    """
+    Return the byte range of image data requested through a Range header
+    as a (start, stop) tuple, stop being exclusive, or None if the whole
+    image should be returned.
+
+    Only a single byte range is supported. Multiple ranges and malformed
+    headers are ignored, in which case the whole image is returned as
+    permitted by RFC 2616.
+
+    :param request: The webob.Request for the image data
+    :param image_size: The size of the image in bytes
+    :raises HTTPRequestRangeNotSatisfiable if the range lies entirely
+            outside of the image
+    """
+    range_header = request.headers.get('Range')
+    if not range_header or ',' in range_header or not image_size:
+        return None
+
+    byte_range = request.range
+    if byte_range is None:
+        return None
+
+    image_range = byte_range.range_for_length(image_size)
+    if image_range is None:
+        content_range = 'bytes */%d' % image_size
+        raise webob.exc.HTTPRequestRangeNotSatisfiable(
+                request=request, headers={'Content-Range': content_range})
+    return image_range
+
+
+def set_range_headers(response, image_range, image_size):
+    """
+    Turn response into a 206 Partial Content response for image_range.
+
+    :param response: The webob.Response carrying the image data
+    :param image_range: The (start, stop) tuple from get_image_range
+    :param image_size: The size of the whole image in bytes
+    :returns: The number of bytes in the range
+    """
+    start, stop = image_range
+    response.status_int = 206
+    response.headers['Content-Range'] = ('bytes %d-%d/%d' %
+                                         (start, stop - 1, image_size))
+    return stop - start
+
+
 def image_send_notification(bytes_written, expected_size, image_meta, request,
                             notifier):
     """Send an image.send message to the notifier."""
@@ -110,6 +110,11 @@ class CacheFilter(wsgi.Middleware):
         if request.method != 'GET' or not self.cache.is_cached(image_id):
             return None
 
+        if request.headers.get('Range'):
+            # NOTE: partial downloads are served from the backend store,
+            # which can read just the requested range
+            return None
+
         LOG.debug(_("Cache hit for image '%s'"), image_id)
         image_iterator = self.get_from_cache(image_id)
         method = getattr(self, '_process_%s_request' % version)
@@ -221,6 +226,10 @@ class CacheFilter(wsgi.Middleware):
         return resp
 
     def _process_GET_response(self, resp, image_id):
+        if self.get_status_code(resp) == 206:
+            # Only part of the image is being sent, nothing to cache
+            return resp
+
         image_checksum = resp.headers.get('Content-MD5', None)
 
         if not image_checksum:
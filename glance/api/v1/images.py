@@ -301,9 +301,11 @@ class Controller(controller.BaseController):
         return Controller._validate_source(source, req)
 
     @staticmethod
-    def _get_from_store(context, where):
+    def _get_from_store(context, where, offset=0, length=None):
         try:
-            image_data, image_size = get_from_backend(context, where)
+            image_data, image_size = get_from_backend(context, where,
+                                                      offset=offset,
+                                                      length=length)
         except exception.NotFound as e:
             raise HTTPNotFound(explanation="%s" % e)
         image_size = int(image_size) if image_size else None
@@ -323,18 +325,29 @@ class Controller(controller.BaseController):
         self._enforce(req, 'download_image')
         image_meta = self.get_active_image_meta_or_404(req, id)
 
+        image_range = None
         if image_meta.get('size') == 0:
             image_iterator = iter([])
         else:
-            image_iterator, size = self._get_from_store(req.context,
-                                                        image_meta['location'])
-            image_iterator = utils.cooperative_iter(image_iterator)
-            image_meta['size'] = size or image_meta['size']
+            image_range = common.get_image_range(req, image_meta.get('size'))
+            if image_range:
+                start, stop = image_range
+                image_data, size = self._get_from_store(
+                        req.context, image_meta['location'],
+                        offset=start, length=stop - start)
+            else:
+                image_data, size = self._get_from_store(
+                        req.context, image_meta['location'])
+                image_meta['size'] = size or image_meta['size']
+            image_iterator = utils.cooperative_iter(image_data)
+            if isinstance(image_data, utils.FileWrapper):
+                image_iterator = image_data.wrap(image_iterator)
 
         image_meta = redact_loc(image_meta)
         return {
             'image_iterator': image_iterator,
             'image_meta': image_meta,
+            'image_range': image_range,
         }
 
     def _reserve(self, req, image_meta):
@@ -918,11 +931,16 @@ class ImageSerializer(wsgi.JSONResponseSerializer):
         image_iter = result['image_iterator']
         # image_meta['size'] should be an int, but could possibly be a str
         expected_size = int(image_meta['size'])
-        response.app_iter = common.size_checked_iter(
+        image_range = result.get('image_range')
+        if image_range:
+            expected_size = common.set_range_headers(response, image_range,
+                                                     expected_size)
+        response.app_iter = common.checked_image_iter(
                 response, image_meta, expected_size, image_iter, self.notifier)
         # Using app_iter blanks content-length, so we set it here...
-        response.headers['Content-Length'] = str(image_meta['size'])
+        response.headers['Content-Length'] = str(expected_size)
         response.headers['Content-Type'] = 'application/octet-stream'
+        response.headers['Accept-Ranges'] = 'bytes'
 
         self._inject_image_meta_headers(response, image_meta)
         self._inject_location_header(response, image_meta)
@@ -122,6 +122,10 @@ class ImageDataController(object):
         if not image.locations:
             reason = _("No image data could be found")
             raise webob.exc.HTTPNotFound(reason)
+
+        # NOTE: the range is validated here as errors raised by the
+        # serializer do not reach the client
+        glance.api.common.get_image_range(req, image.size)
         return image
 
 
@@ -142,15 +146,32 @@ class ResponseSerializer(wsgi.JSONResponseSerializer):
         # NOTE(markwash): filesystem store (and maybe others?) cause a problem
         # with the caching middleware if they are not wrapped in an iterator
         # very strange
-        response.app_iter = iter(image.get_data())
+        image_range = glance.api.common.get_image_range(response.request,
+                                                        image.size)
+        if image_range:
+            start, stop = image_range
+            data = image.get_data(offset=start, length=stop - start)
+        else:
+            data = image.get_data()
+        if isinstance(data, utils.FileWrapper):
+            # NOTE: keep file backed data intact so the server can send it
+            # with sendfile, iterating over it behaves as iter() would
+            response.app_iter = data
+        else:
+            response.app_iter = iter(data)
         #NOTE(saschpe): "response.app_iter = ..." currently resets Content-MD5
         # (https://github.com/Pylons/webob/issues/86), so it should be set
         # afterwards for the time being.
-        if image.checksum:
+        if image.checksum and not image_range:
             response.headers['Content-MD5'] = image.checksum
         #NOTE(markwash): "response.app_iter = ..." also erroneously resets the
         # content-length
-        response.headers['Content-Length'] = str(image.size)
+        content_length = image.size
+        if image_range:
+            content_length = glance.api.common.set_range_headers(
+                    response, image_range, image.size)
+        response.headers['Content-Length'] = str(content_length)
+        response.headers['Accept-Ranges'] = 'bytes'
 
     def upload(self, response, result):
         response.status_int = 204
@@ -44,6 +44,7 @@ from glance.common import exception
 import glance.db.sqlalchemy.api
 import glance.db.sqlalchemy.migration
 from glance.openstack.common import log
+import glance.store.filesystem
 
 CONF = cfg.CONF
 
@@ -77,6 +78,17 @@ def do_db_sync():
                                            CONF.command.current_version)
 
 
+def do_filesystem_store_shard():
+    """
+    Move the image files of filesystem store data directories to the
+    layout for the given number of levels of shard directories
+    """
+    for datadir in CONF.command.datadirs:
+        moved = glance.store.filesystem.shard_datadir(datadir,
+                                                      CONF.command.depth)
+        print "Moved %d image files in %s" % (moved, datadir)
+
+
 def add_command_parsers(subparsers):
     parser = subparsers.add_parser('db_version')
     parser.set_defaults(func=do_db_version)
@@ -98,6 +110,11 @@ def add_command_parsers(subparsers):
     parser.add_argument('version', nargs='?')
     parser.add_argument('current_version', nargs='?')
 
+    parser = subparsers.add_parser('filesystem_store_shard')
+    parser.set_defaults(func=do_filesystem_store_shard)
+    parser.add_argument('depth', type=int)
+    parser.add_argument('datadirs', nargs='+')
+
 
 command_opt = cfg.SubCommandOpt('command',
                                 title='Commands',
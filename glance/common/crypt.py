@@ -24,7 +24,13 @@ import base64
 
 from Crypto.Cipher import AES
 from Crypto import Random
-from Crypto.Random import random
+
+from glance.common import utils
+
+# Storage URIs are decrypted every time an image is read, so remember
+# the plaintext of recently seen ciphertexts.
+DECRYPT_CACHE_SIZE = 1024
+_DECRYPT_CACHE = utils.LRUCache(DECRYPT_CACHE_SIZE)
 
 
 def urlsafe_encrypt(key, plaintext, blocksize=16):
@@ -41,9 +47,9 @@ def urlsafe_encrypt(key, plaintext, blocksize=16):
         Pads text to be encrypted
         """
         pad_length = (blocksize - len(text) % blocksize)
-        sr = random.StrongRandom()
-        pad = ''.join(chr(sr.randint(1, 0xFF)) for i in range(pad_length - 1))
-        # We use chr(0) as a delimiter between text and padding
+        # We use chr(0) as a delimiter between text and padding, so the
+        # padding itself must not contain any
+        pad = Random.get_random_bytes(pad_length - 1).replace(chr(0), chr(1))
         return text + chr(0) + pad
 
     # random initial 16 bytes for CBC
@@ -62,7 +68,12 @@ def urlsafe_decrypt(key, ciphertext):
     :returns : Resulting plaintext
     """
     # Cast from unicode
-    ciphertext = base64.urlsafe_b64decode(str(ciphertext))
-    cypher = AES.new(key, AES.MODE_CBC, ciphertext[:16])
-    padded = cypher.decrypt(ciphertext[16:])
-    return padded[:padded.rfind(chr(0))]
+    ciphertext = str(ciphertext)
+    plaintext = _DECRYPT_CACHE.get((key, ciphertext))
+    if plaintext is None:
+        decoded = base64.urlsafe_b64decode(ciphertext)
+        cypher = AES.new(key, AES.MODE_CBC, decoded[:16])
+        padded = cypher.decrypt(decoded[16:])
+        plaintext = padded[:padded.rfind(chr(0))]
+        _DECRYPT_CACHE[(key, ciphertext)] = plaintext
+    return plaintext
@@ -20,19 +20,25 @@
 System-level utilities and helper functions.
 """
 
+import contextlib
 import errno
 
 try:
     from eventlet import sleep
 except ImportError:
     from time import sleep
+import eventlet
 from eventlet.green import socket
+from eventlet import queue
+from eventlet import tpool
 
 import functools
+import hashlib
 import os
 import platform
 import subprocess
 import sys
+import time
 import uuid
 
 from OpenSSL import crypto
@@ -43,7 +49,15 @@ from glance.common import exception
 import glance.openstack.common.log as logging
 from glance.openstack.common import strutils
 
+native_opts = [
+    cfg.IntOpt('native_thread_pool_size', default=20,
+               help=_('Number of native threads used to checksum image '
+                      'data and to make blocking calls into C libraries '
+                      'such as librbd, without stalling other requests.')),
+]
+
 CONF = cfg.CONF
+CONF.register_opts(native_opts)
 
 LOG = logging.getLogger(__name__)
 
@@ -63,6 +77,12 @@ IMAGE_META_HEADERS = ['x-image-meta-location', 'x-image-meta-size',
 
 GLANCE_TEST_SOCKET_FD_STR = 'GLANCE_TEST_SOCKET_FD'
 
+# Chunks smaller than this are cheaper to hash in the calling green thread
+# than to hand over to a native one
+NATIVE_HASH_MIN_SIZE = 64 * 1024
+
+_native_pool_sized = False
+
 
 def chunkreadable(iter, chunk_size=65536):
     """
@@ -90,6 +110,85 @@ def chunkiter(fp, chunk_size=65536):
             break
 
 
+def readinto(fp, buf, chunk_size=65536):
+    """
+    Fill a bytearray with data read from a file-like object, returning
+    the number of bytes read, which is less than the size of the buffer
+    only at the end of the file. Files with a readinto() method fill the
+    buffer directly, others are read chunk_size bytes at a time.
+    """
+    filled = 0
+    size = len(buf)
+    fp_readinto = getattr(fp, 'readinto', None)
+    try:
+        view = memoryview(buf)
+    except NameError:
+        # python 2.6 has no memoryview to read into part of the buffer
+        fp_readinto = None
+    while filled < size:
+        if fp_readinto is not None:
+            count = fp_readinto(view[filled:])
+        else:
+            data = fp.read(min(chunk_size, size - filled))
+            count = len(data)
+            buf[filled:filled + count] = data
+        if not count:
+            break
+        filled += count
+    return filled
+
+
+class BufferPool(object):
+    """
+    A pool of reusable buffers of a fixed size, so that buffers of large
+    chunks of data are not allocated again for every chunk. Buffers are
+    allocated as needed and at most count of them are kept for reuse.
+    """
+
+    def __init__(self, size, count):
+        self.size = size
+        self.count = count
+        self.free = []
+
+    def get(self):
+        if self.free:
+            return self.free.pop()
+        return bytearray(self.size)
+
+    def put(self, buf):
+        if len(self.free) < self.count:
+            self.free.append(buf)
+
+
+class BufferReader(object):
+    """
+    A seekable file-like object reading the first length bytes of a
+    buffer, without copying the buffer as a whole.
+    """
+
+    def __init__(self, buf, length):
+        self.buf = buf
+        self.len = length
+        self.pos = 0
+
+    def read(self, size=-1):
+        if size is None or size < 0 or size > self.len - self.pos:
+            size = self.len - self.pos
+        data = str(buffer(self.buf, self.pos, size))
+        self.pos += len(data)
+        return data
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self.pos
+        elif whence == os.SEEK_END:
+            offset += self.len
+        self.pos = max(0, min(offset, self.len))
+
+    def tell(self):
+        return self.pos
+
+
 def cooperative_iter(iter):
     """
     Return an iterator which schedules after each
@@ -121,6 +220,70 @@ def cooperative_read(fd):
     return readfn
 
 
+def native_call(func, *args, **kwargs):
+    """
+    Run a blocking call in a native thread, so that it does not stall the
+    eventlet hub, logging how long it waited for a thread and ran for.
+    """
+    global _native_pool_sized
+    if not _native_pool_sized:
+        # NOTE: this only has an effect before the first native call
+        tpool.set_num_threads(CONF.native_thread_pool_size)
+        _native_pool_sized = True
+
+    queued = time.time()
+    started = []
+
+    def call():
+        started.append(time.time())
+        return func(*args, **kwargs)
+
+    try:
+        return tpool.execute(call)
+    finally:
+        if started:
+            LOG.debug(_('Native call %(func)s waited %(wait).4fs and ran '
+                        'for %(run).4fs'),
+                      {'func': getattr(func, '__name__', func),
+                       'wait': started[0] - queued,
+                       'run': time.time() - started[0]})
+
+
+def update_checksum(checksum, data):
+    """Hash data into checksum, in a native thread if data is large."""
+    if isinstance(checksum, MultiHash) and not checksum.hashes:
+        return
+    if len(data) >= NATIVE_HASH_MIN_SIZE:
+        native_call(checksum.update, data)
+    else:
+        checksum.update(data)
+
+
+class MultiHash(object):
+    """
+    Computes the digests of the same data with several hash algorithms in
+    a single pass over it. Digests default to the md5 one, so this can
+    stand in for a hashlib md5 object.
+    """
+
+    def __init__(self, algorithms):
+        self.hashes = dict((name, hashlib.new(name)) for name in algorithms)
+
+    def update(self, data):
+        for checksum in self.hashes.itervalues():
+            checksum.update(data)
+
+    def digest(self, name='md5'):
+        return self.hashes[name].digest()
+
+    def hexdigest(self, name='md5'):
+        return self.hashes[name].hexdigest()
+
+    def hexdigests(self):
+        return dict((name, checksum.hexdigest())
+                    for name, checksum in self.hashes.iteritems())
+
+
 class CooperativeReader(object):
     """
     An eventlet thread friendly class for reading in image data.
@@ -160,6 +323,96 @@ class CooperativeReader(object):
         return cooperative_iter(self.fd.__iter__())
 
 
+class IterReader(object):
+    """
+    A file-like object reading the chunks of data yielded by an iterator.
+    """
+
+    def __init__(self, iterator):
+        self.iterator = iterator
+        self.buffer = []
+        self.buffered = 0
+        self.eof = False
+
+    def _next_chunk(self):
+        return next(self.iterator, '')
+
+    def read(self, length=None):
+        while not self.eof and (length is None or self.buffered < length):
+            chunk = self._next_chunk()
+            if not chunk:
+                self.eof = True
+            self.buffer.append(chunk)
+            self.buffered += len(chunk)
+        data = ''.join(self.buffer)
+        if length is None or length >= len(data):
+            self.buffer = []
+            self.buffered = 0
+            return data
+        self.buffer = [data[length:]]
+        self.buffered = len(data) - length
+        return data[:length]
+
+
+class QueueReader(IterReader):
+    """
+    A file-like object reading the chunks of data another green thread
+    puts on a bounded queue. An empty chunk marks the end of the data and
+    an exception put on the queue is raised to the reader.
+    """
+
+    def __init__(self, depth):
+        super(QueueReader, self).__init__(None)
+        self.queue = queue.Queue(depth)
+
+    def _next_chunk(self):
+        chunk = self.queue.get()
+        if isinstance(chunk, Exception):
+            raise chunk
+        return chunk
+
+
+class ReadAheadReader(QueueReader):
+    """
+    Reads chunks of a file ahead on a separate green thread, keeping up
+    to depth chunks buffered, so that receiving the next chunks overlaps
+    with writing out the previous ones. The reader must be closed to
+    stop reading ahead if the data is not read to the end.
+    """
+
+    def __init__(self, fd, chunk_size, depth):
+        super(ReadAheadReader, self).__init__(depth)
+        self.thread = eventlet.spawn(self._read_ahead, fd, chunk_size)
+
+    def _read_ahead(self, fd, chunk_size):
+        try:
+            chunk = None
+            while chunk != '':
+                chunk = fd.read(chunk_size)
+                self.queue.put(chunk)
+        except Exception as e:
+            self.queue.put(e)
+
+    def close(self):
+        self.thread.kill()
+
+
+@contextlib.contextmanager
+def read_ahead(fd, chunk_size, depth):
+    """
+    Yield a `ReadAheadReader` of fd, or fd itself if depth is less than
+    one, and stop reading ahead on the way out.
+    """
+    if depth < 1:
+        yield fd
+        return
+    reader = ReadAheadReader(fd, chunk_size, depth)
+    try:
+        yield reader
+    finally:
+        reader.close()
+
+
 class LimitingReader(object):
     """
     Reader designed to fail when reading image data past the configured
@@ -190,6 +443,68 @@ class LimitingReader(object):
         return result
 
 
+class FileWrapper(object):
+    """
+    Image data backed by an open file.
+
+    Iterating over the wrapper yields the chunks of the wrapped iterable, so
+    anything that needs to see or transform the data keeps working. A WSGI
+    server which finds an untouched FileWrapper as the response body may
+    instead hand fileno() straight to sendfile(2), after which it calls
+    transmitted() so that accounting normally done while iterating (size
+    checks, notifications) still happens.
+    """
+    def __init__(self, filelike, length, iterable=None, callbacks=None,
+                 offset=0):
+        """
+        :param filelike: Underlying file object, must support fileno()
+        :param length: number of bytes of image data in the file
+        :param iterable: iterable yielding the image data, defaults to
+                         iterating over filelike itself
+        :param callbacks: functions called with the number of bytes sent
+                          when the data is transmitted without iterating
+        :param offset: position of the image data in the file
+        """
+        self.filelike = filelike
+        self.length = length
+        self.offset = offset
+        self.iterable = filelike if iterable is None else iterable
+        self.callbacks = callbacks or []
+
+    def __iter__(self):
+        return iter(self.iterable)
+
+    def fileno(self):
+        return self.filelike.fileno()
+
+    def wrap(self, iterable, callback=None):
+        """
+        Return a wrapper around the same file whose data is read through
+        the supplied iterable.
+
+        :param iterable: iterable wrapping this object, e.g. a generator
+                         counting or checksumming the chunks
+        :param callback: function called with the number of bytes sent if
+                         the iterable is bypassed by sendfile
+        """
+        callbacks = list(self.callbacks)
+        if callback is not None:
+            callbacks.append(callback)
+        return FileWrapper(self.filelike, self.length, iterable, callbacks,
+                           self.offset)
+
+    def transmitted(self, bytes_sent):
+        """Called by the server after sending the data with sendfile"""
+        for callback in self.callbacks:
+            callback(bytes_sent)
+
+    def close(self):
+        if hasattr(self.iterable, 'close'):
+            self.iterable.close()
+        if hasattr(self.filelike, 'close'):
+            self.filelike.close()
+
+
 def image_meta_to_http_headers(image_meta):
     """
     Returns a set of image metadata into a dict
@@ -445,6 +760,72 @@ def setup_remote_pydev_debug(host, port):
         raise
 
 
+class LRUCache(object):
+    """
+    A small dict-like cache that holds at most `size` entries, evicting
+    the least recently used entry when full.
+    """
+
+    # Entries are [prev, next, key, value] links of a circular doubly
+    # linked list kept in recency order; collections.OrderedDict is not
+    # available on python 2.6.
+    PREV, NEXT, KEY, VALUE = range(4)
+
+    def __init__(self, size):
+        self.size = size
+        self._data = {}
+        self._root = []
+        self._root[:] = [self._root, self._root, None, None]
+
+    def _unlink(self, link):
+        link[self.PREV][self.NEXT] = link[self.NEXT]
+        link[self.NEXT][self.PREV] = link[self.PREV]
+
+    def _append(self, link):
+        last = self._root[self.PREV]
+        link[self.PREV] = last
+        link[self.NEXT] = self._root
+        last[self.NEXT] = link
+        self._root[self.PREV] = link
+
+    def get(self, key, default=None):
+        link = self._data.get(key)
+        if link is None:
+            return default
+        self._unlink(link)
+        self._append(link)
+        return link[self.VALUE]
+
+    def __setitem__(self, key, value):
+        link = self._data.get(key)
+        if link is not None:
+            self._unlink(link)
+        link = [None, None, key, value]
+        self._data[key] = link
+        self._append(link)
+        while len(self._data) > self.size:
+            oldest = self._root[self.NEXT]
+            self._unlink(oldest)
+            del self._data[oldest[self.KEY]]
+
+    def pop(self, key, default=None):
+        link = self._data.pop(key, None)
+        if link is None:
+            return default
+        self._unlink(link)
+        return link[self.VALUE]
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+    def clear(self):
+        self._data.clear()
+        self._root[:] = [self._root, self._root, None, None]
+
+
 class LazyPluggable(object):
     """A pluggable backend loaded lazily based on some value."""
 
@@ -33,6 +33,7 @@ import time
 import eventlet
 from eventlet.green import socket, ssl
 import eventlet.greenio
+import eventlet.hubs
 import eventlet.wsgi
 from oslo.config import cfg
 import routes
@@ -40,6 +41,12 @@ import routes.middleware
 import webob.dec
 import webob.exc
 
+try:
+    import sendfile
+    SENDFILE_SUPPORTED = True
+except ImportError:
+    SENDFILE_SUPPORTED = False
+
 from glance.common import exception
 from glance.common import utils
 import glance.openstack.common.log as os_logging
@@ -67,6 +74,13 @@ socket_opts = [
                                    'server securely.')),
     cfg.StrOpt('key_file', help=_('Private key file to use when starting API '
                                   'server securely.')),
+    cfg.BoolOpt('use_sendfile', default=False,
+                help=_('Send image data backed by a local file with the '
+                       'sendfile system call, avoiding a copy through user '
+                       'space. Only used when the response body is not '
+                       'transformed, e.g. by gzip or the image cache. '
+                       'Requires the pysendfile module; without it the data '
+                       'is sent as usual.')),
 ]
 
 eventlet_opts = [
@@ -183,6 +197,82 @@ def get_socket(default_port):
     return sock
 
 
+class SendfileApplication(object):
+    """
+    Wraps a WSGI application, transmitting response bodies which are
+    `glance.common.utils.FileWrapper` instances with sendfile(2).
+
+    The body must reach the server untouched: any middleware that needs to
+    transform the data (gzip, cache tee'ing) wraps it in another iterator,
+    in which case it is served by iterating as usual.
+    """
+
+    FIRST_CHUNKSIZE = 65536
+
+    def __init__(self, application):
+        self.application = application
+
+    def __call__(self, environ, start_response):
+        headers = {}
+
+        def _start_response(status, response_headers, exc_info=None):
+            headers.clear()
+            headers.update((k.lower(), v) for k, v in response_headers)
+            return start_response(status, response_headers, exc_info)
+
+        result = self.application(environ, _start_response)
+        if self._can_sendfile(environ, headers, result):
+            sock = environ['eventlet.input'].get_socket()
+            # NOTE: make the server write each chunk as soon as it is
+            # yielded so that headers are flushed before we bypass it
+            environ['eventlet.minimum_write_chunk_size'] = 0
+            return self._sendfile_iter(sock, result)
+        return result
+
+    @staticmethod
+    def _can_sendfile(environ, headers, result):
+        if not SENDFILE_SUPPORTED:
+            return False
+        if not isinstance(result, utils.FileWrapper) or not result.length:
+            return False
+        # sendfile can neither encrypt nor chunk-encode the data
+        if environ.get('wsgi.url_scheme') == 'https':
+            return False
+        if 'eventlet.input' not in environ:
+            return False
+        return (headers.get('content-length') == str(result.length) and
+                'content-encoding' not in headers)
+
+    def _sendfile_iter(self, sock, result):
+        """
+        Yield the first chunk of the file through the server, which sends
+        the status line and headers along with it, then send the rest of
+        the file straight from the page cache to the socket.
+        """
+        try:
+            fd = result.fileno()
+            os.lseek(fd, result.offset, os.SEEK_SET)
+            chunk = os.read(fd, min(self.FIRST_CHUNKSIZE, result.length))
+            yield chunk
+            bytes_sent = len(chunk)
+            while chunk and bytes_sent < result.length:
+                try:
+                    count = sendfile.sendfile(sock.fileno(), fd,
+                                              result.offset + bytes_sent,
+                                              result.length - bytes_sent)
+                except OSError as err:
+                    if err.errno != errno.EAGAIN:
+                        raise
+                    eventlet.hubs.trampoline(sock.fileno(), write=True)
+                    continue
+                if count == 0:
+                    break
+                bytes_sent += count
+            result.transmitted(bytes_sent)
+        finally:
+            result.close()
+
+
 class Server(object):
     """Server class to manage multiple WSGI sockets and applications."""
 
@@ -230,6 +320,8 @@ class Server(object):
             self.running = False
 
         self.application = application
+        if CONF.use_sendfile:
+            self.application = SendfileApplication(application)
         self.sock = get_socket(default_port)
 
         os.umask(0o27)  # ensure files are created with the correct privileges
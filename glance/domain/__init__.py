@@ -149,7 +149,7 @@ class Image(object):
             raise exception.ProtectedImageDelete(image_id=self.image_id)
         self.status = 'deleted'
 
-    def get_data(self):
+    def get_data(self, offset=0, length=None):
         raise NotImplementedError()
 
     def set_data(self, data, size=None):
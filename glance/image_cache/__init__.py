@@ -237,7 +237,7 @@ class ImageCache(object):
                         try:
                             cache_file.write(chunk)
                         finally:
-                            current_checksum.update(chunk)
+                            utils.update_checksum(current_checksum, chunk)
                             yield chunk
                     cache_file.flush()
 
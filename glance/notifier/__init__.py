@@ -22,6 +22,7 @@ import uuid
 from oslo.config import cfg
 
 from glance.common import exception
+from glance.common import utils
 import glance.domain
 import glance.domain.proxy
 from glance.openstack.common import importutils
@@ -176,13 +177,10 @@ class ImageProxy(glance.domain.proxy.Image):
             'receiver_user_id': self.context.user,
         }
 
-    def get_data(self):
-        sent = 0
-        for chunk in self.image.get_data():
-            yield chunk
-            sent += len(chunk)
-
-        if sent != self.image.size:
+    def _notify_image_send(self, sent, expected_size=None):
+        if expected_size is None:
+            expected_size = self.image.size
+        if sent != expected_size:
             notify = self.notifier.error
         else:
             notify = self.notifier.info
@@ -194,6 +192,29 @@ class ImageProxy(glance.domain.proxy.Image):
                     " notification: %(err)s") % locals()
             LOG.error(msg)
 
+    def _get_data(self, data, expected_size):
+        sent = 0
+        for chunk in data:
+            yield chunk
+            sent += len(chunk)
+        self._notify_image_send(sent, expected_size)
+
+    def get_data(self, offset=0, length=None):
+        data = self.image.get_data(offset=offset, length=length)
+        expected_size = self.image.size
+        if expected_size is not None and (offset or length is not None):
+            expected_size = max(expected_size - offset, 0)
+            if length is not None:
+                expected_size = min(expected_size, length)
+
+        def notify(sent):
+            self._notify_image_send(sent, expected_size)
+
+        if isinstance(data, utils.FileWrapper):
+            return data.wrap(self._get_data(data, expected_size),
+                             callback=notify)
+        return self._get_data(data, expected_size)
+
     def set_data(self, data, size=None):
         payload = format_image_notification(self.image)
         self.notifier.info('image.prepare', payload)
@@ -19,7 +19,11 @@ import collections
 import os
 import sys
 import time
+import urlparse
 
+import eventlet
+from eventlet import queue
+import greenlet
 from oslo.config import cfg
 
 from glance.common import crypt
@@ -29,6 +33,7 @@ import glance.context
 import glance.domain.proxy
 from glance.openstack.common import importutils
 import glance.openstack.common.log as logging
+from glance.store import compression
 from glance.store import location
 
 LOG = logging.getLogger(__name__)
@@ -60,6 +65,24 @@ store_opts = [
     cfg.IntOpt('scrub_time', default=0,
                help=_('The amount of time in seconds to delay before '
                       'performing a delete.')),
+    cfg.ListOpt('location_preference', default=[],
+                help=_('List of schemes or URL prefixes, most preferred '
+                       'first, used to order the locations of an image '
+                       'when reading its data. Locations on backends that '
+                       'have recently been failing are always tried last.')),
+    cfg.BoolOpt('location_race', default=False,
+                help=_('Start reading image data from the two best '
+                       'locations at once and keep whichever returns its '
+                       'first chunk soonest.')),
+    cfg.ListOpt('replica_stores', default=[],
+                help=_('List of schemes of stores that uploaded image data '
+                       'is written to at the same time as the default '
+                       'store, each copy being added as a location of the '
+                       'image.')),
+    cfg.IntOpt('replica_store_buffer_chunks', default=16,
+               help=_('Number of 64 KB chunks of image data buffered for '
+                      'each store when writing replicas. Once a store has '
+                      'this much data pending the upload waits for it.')),
 ]
 
 CONF = cfg.CONF
@@ -150,11 +173,30 @@ def _get_store_class(store_entry):
     return store_cls
 
 
+# Configured store instances, keyed by their class, shared by all requests
+# of the process
+_STORES = {}
+
+# Seconds after which a shared store whose add method was disabled by a
+# configuration error is configured again, in case the backend it needed
+# became available
+_ADD_RETRY_INTERVAL = 60
+
+
+def clear_store_cache():
+    """
+    Forget the configured store instances, so that the stores are
+    configured again from the current configuration on next use.
+    """
+    _STORES.clear()
+
+
 def create_stores():
     """
     Registers all store modules and all schemes
     from the given config. Duplicates are not re-registered.
     """
+    clear_store_cache()
     store_count = 0
     store_classes = set()
     for store_entry in CONF.known_stores:
@@ -184,6 +226,7 @@ def create_stores():
                 store_count += 1
             else:
                 LOG.debug("Store %s already registered", store_cls)
+    compression.configure_codecs()
     return store_count
 
 
@@ -201,11 +244,31 @@ def get_store_from_scheme(context, scheme, loc=None):
     """
     Given a scheme, return the appropriate store object
     for handling that scheme.
+
+    Stores are configured once per process and shared, each request
+    getting a copy bound to its context, unless their configuration
+    depends on the context.
     """
     if scheme not in location.SCHEME_TO_CLS_MAP:
         raise exception.UnknownScheme(scheme=scheme)
-    scheme_info = location.SCHEME_TO_CLS_MAP[scheme]
-    store = scheme_info['store_class'](context, loc)
+    registered_cls = location.SCHEME_TO_CLS_MAP[scheme]['store_class']
+    # The registered class may build different stores depending on the
+    # location, as the Swift store does in multi-tenant mode
+    store_cls = registered_cls.get_store_class(loc)
+    store = _STORES.get(store_cls)
+    if (store is not None and store.add_disabled_at is not None and
+            time.time() - store.add_disabled_at >= _ADD_RETRY_INTERVAL):
+        store = None
+    if store is None:
+        store = store_cls(context, loc)
+        if not store.configure_per_context:
+            store.context = None
+            _STORES[store_cls] = store
+    if not store.configure_per_context:
+        store = store.for_context(context)
+    codec = compression.get_codec(registered_cls)
+    if codec is not None:
+        store = compression.CompressedStore(store, codec)
     return store
 
 
@@ -221,14 +284,44 @@ def get_store_from_uri(context, uri, loc=None):
     return store
 
 
-def get_from_backend(context, uri, **kwargs):
-    """Yields chunks of data from backend specified by uri"""
+def get_range_size(size, offset=0, length=None):
+    """
+    Return the number of bytes in the range of length bytes starting at
+    offset of an object of the given size.
+    """
+    size = max(size - offset, 0)
+    if length is not None:
+        size = min(size, length)
+    return size
+
+
+def get_range_header(offset=0, length=None):
+    """
+    Return the value of an HTTP Range header asking for length bytes
+    starting at offset, or None if the whole object is wanted.
+    """
+    if not offset and length is None:
+        return None
+    if length is None:
+        return 'bytes=%d-' % offset
+    return 'bytes=%d-%d' % (offset, offset + length - 1)
+
+
+def get_from_backend(context, uri, offset=0, length=None, metadata=None,
+                     **kwargs):
+    """
+    Yields chunks of data from backend specified by uri, optionally
+    limited to length bytes starting at offset. The metadata of the
+    location, if known, spares compressed stores from looking at the
+    stored data to tell whether it was compressed.
+    """
 
     loc = location.get_location_from_uri(uri)
+    loc.metadata = metadata
     store = get_store_from_uri(context, uri, loc)
 
     try:
-        return store.get(loc)
+        return store.get(loc, offset=offset, length=length)
     except NotImplementedError:
         raise exception.StoreGetNotSupported
 
@@ -616,6 +709,96 @@ def _locations_proxy(target, attr):
     return property(get_attr, set_attr, del_attr)
 
 
+# Weight of the newest sample in the moving averages kept per backend
+BACKEND_STATS_DECAY = 0.3
+# Backends whose error rate is above this are tried after all others...
+BACKEND_ERROR_THRESHOLD = 0.5
+# ...until this many seconds have passed since their last failure
+BACKEND_RETRY_INTERVAL = 60
+
+
+class BackendStats(object):
+    """
+    Keeps moving averages of the latency and error rate seen when
+    reading image data from each backend, so that locations on fast and
+    healthy backends can be tried first.
+    """
+
+    def __init__(self):
+        self.latency = {}
+        self.errors = {}
+        self.last_failure = {}
+
+    @staticmethod
+    def _backend(url):
+        pieces = urlparse.urlparse(url)
+        # Leave out any credentials so they are not kept as keys
+        return pieces.scheme, pieces.netloc.rpartition('@')[2]
+
+    @staticmethod
+    def _update(averages, backend, sample):
+        average = averages.get(backend, sample)
+        averages[backend] = average + BACKEND_STATS_DECAY * (sample - average)
+
+    def record_success(self, url, latency):
+        backend = self._backend(url)
+        self._update(self.latency, backend, latency)
+        self._update(self.errors, backend, 0.0)
+
+    def record_failure(self, url):
+        backend = self._backend(url)
+        self._update(self.errors, backend, 1.0)
+        self.last_failure[backend] = time.time()
+
+    def health(self, url):
+        """
+        Returns a (degraded, latency) tuple for the backend holding url,
+        suitable for use as a sort key.
+        """
+        backend = self._backend(url)
+        degraded = (self.errors.get(backend, 0.0) > BACKEND_ERROR_THRESHOLD
+                    and time.time() - self.last_failure[backend] <
+                    BACKEND_RETRY_INTERVAL)
+        return degraded, self.latency.get(backend, 0.0)
+
+    def clear(self):
+        self.latency.clear()
+        self.errors.clear()
+        self.last_failure.clear()
+
+
+BACKEND_STATS = BackendStats()
+
+
+def _close(data):
+    if hasattr(data, 'close'):
+        data.close()
+
+
+def _prepend(chunk, data, chunks):
+    try:
+        yield chunk
+        for chunk in chunks:
+            yield chunk
+    finally:
+        _close(data)
+
+
+REPLICA_CHUNK_SIZE = 64 * 1024
+
+
+class _ReplicaReader(utils.QueueReader):
+    """
+    File-like object handing one store the chunks of image data queued
+    for it while the same data is written to other stores.
+    """
+
+    def __init__(self, depth):
+        super(_ReplicaReader, self).__init__(depth)
+        self.done = False
+        self.error = None
+
+
 class ImageProxy(glance.domain.proxy.Image):
 
     locations = _locations_proxy('image', 'locations')
@@ -644,28 +827,163 @@ class ImageProxy(glance.domain.proxy.Image):
                                                          self.image.image_id,
                                                          location['url'])
 
+    def _add_replica(self, scheme, reader, size):
+        try:
+            return self.store_api.add_to_backend(self.context, scheme,
+                                                 self.image.image_id,
+                                                 reader, size)
+        except Exception as e:
+            reader.error = e
+            LOG.error(_('Failed to write image %(id)s to the %(scheme)s '
+                        'store: %(err)s') % {'id': self.image.image_id,
+                                             'scheme': scheme, 'err': e})
+        finally:
+            # Never let the upload block on a store that stopped reading
+            reader.done = True
+            reader.queue.resize(None)
+
+    def _add_to_backends(self, schemes, data, size):
+        """
+        Writes the image data to all the given stores in a single pass,
+        returning the result of add_to_backend for each of them. If any
+        store fails, the copies written to the others are deleted.
+        """
+        readers = [_ReplicaReader(CONF.replica_store_buffer_chunks)
+                   for scheme in schemes]
+        threads = [eventlet.spawn(self._add_replica, scheme, reader, size)
+                   for scheme, reader in zip(schemes, readers)]
+        error = abort = None
+        chunk = None
+        try:
+            while chunk != '':
+                if any(reader.error for reader in readers):
+                    break
+                chunk = data.read(REPLICA_CHUNK_SIZE)
+                for reader in readers:
+                    if not reader.done:
+                        reader.queue.put(chunk)
+        except Exception as e:
+            error = e
+        if chunk != '':
+            abort = error or BackendException(
+                _('Writing image data to another store failed'))
+            for reader in readers:
+                if not reader.done:
+                    reader.queue.put(abort)
+
+        results = [thread.wait() for thread in threads]
+        for reader in readers:
+            if error is None and reader.error is not abort:
+                error = reader.error
+        if error is not None:
+            for result in results:
+                if result is not None:
+                    self.store_api.safe_delete_from_backend(
+                        result[0], self.context, self.image.image_id)
+            raise error
+        return results
+
     def set_data(self, data, size=None):
         if size is None:
             size = 0  # NOTE(markwash): zero -> unknown size
-        location, size, checksum, loc_meta = self.store_api.add_to_backend(
+        data = utils.CooperativeReader(data)
+        schemes = [CONF.default_store]
+        schemes.extend(scheme for scheme in CONF.replica_stores
+                       if scheme not in schemes)
+        if len(schemes) > 1:
+            results = self._add_to_backends(schemes, data, size)
+        else:
+            results = [self.store_api.add_to_backend(
                 self.context, CONF.default_store,
-                self.image.image_id, utils.CooperativeReader(data), size)
-        self.image.locations = [{'url': location, 'metadata': loc_meta}]
+                self.image.image_id, data, size)]
+        location, size, checksum, loc_meta = results[0]
+        self.image.locations = [{'url': result[0], 'metadata': result[3]}
+                                for result in results]
         self.image.size = size
         self.image.checksum = checksum
         self.image.status = 'active'
 
-    def get_data(self):
+    def _ordered_locations(self):
+        preference = CONF.location_preference
+
+        def sort_key(loc):
+            degraded, latency = BACKEND_STATS.health(loc['url'])
+            for rank, prefix in enumerate(preference):
+                if loc['url'].startswith(prefix):
+                    break
+            else:
+                rank = len(preference)
+            return degraded, rank, latency
+
+        return sorted(self.image.locations, key=sort_key)
+
+    def _read_first_chunk(self, loc, offset, length, results):
+        start = time.time()
+        data = None
+        try:
+            data, size = self.store_api.get_from_backend(
+                self.context, loc['url'], offset=offset, length=length,
+                metadata=loc.get('metadata'))
+            chunks = iter(data)
+            chunk = next(chunks, '')
+        except greenlet.GreenletExit:
+            _close(data)
+            raise
+        except Exception as e:
+            BACKEND_STATS.record_failure(loc['url'])
+            LOG.warn(_('Get image %(id)s data from %(loc)s '
+                       'failed: %(err)s.') % {'id': self.image.image_id,
+                                              'loc': loc, 'err': e})
+            results.put(e)
+            return
+        BACKEND_STATS.record_success(loc['url'], time.time() - start)
+        results.put(_prepend(chunk, data, chunks))
+
+    def _race_locations(self, locations, offset, length):
+        """
+        Starts reading from all the given locations at once and returns
+        the data of the first one to produce a chunk, along with the last
+        error seen. The data is None if every location failed.
+        """
+        results = queue.LightQueue()
+        threads = [eventlet.spawn(self._read_first_chunk, loc, offset,
+                                  length, results)
+                   for loc in locations]
+        err = None
+        for i in range(len(threads)):
+            result = results.get()
+            if isinstance(result, Exception):
+                err = result
+                continue
+            for thread in threads:
+                thread.kill()
+            # Close the data of any location that finished while the
+            # others were being stopped
+            while not results.empty():
+                _close(results.get())
+            return result, err
+        return None, err
+
+    def get_data(self, offset=0, length=None):
         if not self.image.locations:
             raise exception.NotFound(_("No image data could be found"))
+        locations = self._ordered_locations()
         err = None
-        for loc in self.image.locations:
+        if CONF.location_race and len(locations) > 1:
+            data, err = self._race_locations(locations[:2], offset, length)
+            if data is not None:
+                return data
+            locations = locations[2:]
+        for loc in locations:
+            start = time.time()
             try:
-                data, size = self.store_api.get_from_backend(self.context,
-                                                             loc['url'])
-
+                data, size = self.store_api.get_from_backend(
+                    self.context, loc['url'], offset=offset, length=length,
+                    metadata=loc.get('metadata'))
+                BACKEND_STATS.record_success(loc['url'], time.time() - start)
                 return data
             except Exception as e:
+                BACKEND_STATS.record_failure(loc['url'])
                 LOG.warn(_('Get image %(id)s data from %(loc)s '
                            'failed: %(err)s.') % {'id': self.image.image_id,
                                                   'loc': loc, 'err': e})
@@ -18,6 +18,11 @@
 
 """Base class for all storage backends"""
 
+import copy
+import time
+
+from oslo.config import cfg
+
 from glance.common import exception
 from glance.common import utils
 from glance.openstack.common import importutils
@@ -26,6 +31,22 @@ from glance.openstack.common import strutils
 
 LOG = logging.getLogger(__name__)
 
+digest_opts = [
+    cfg.ListOpt('image_digest_algorithms', default=[],
+                help=_('Digest algorithms, such as sha256, computed along '
+                       'with the md5 checksum while image data is written '
+                       'to a store, in the same pass over the data. They '
+                       'are saved in the metadata of the image location.')),
+    cfg.IntOpt('store_read_ahead_chunks', default=0,
+               help=_('Number of chunks of image data stores that support '
+                      'it read ahead from the request while writing the '
+                      'previous ones to the backend. 0, the default, '
+                      'disables reading ahead.')),
+]
+
+CONF = cfg.CONF
+CONF.register_opts(digest_opts)
+
 
 def _exception_to_str(exc):
     try:
@@ -43,6 +64,18 @@ class Store(object):
 
     CHUNKSIZE = (16 * 1024 * 1024)  # 16M
 
+    # Stores configured from the request context, for instance from its
+    # service catalog, are set up for every request instead of being
+    # shared by glance.store.get_store_from_scheme
+    configure_per_context = False
+
+    # Whether add can be given an image size of zero, meaning the size is
+    # unknown until all the data was read
+    accepts_unknown_size = True
+
+    # When configure_add last failed and disabled add, or None
+    add_disabled_at = None
+
     def __init__(self, context=None, location=None):
         """
         Initialize the Store
@@ -52,9 +85,11 @@ class Store(object):
         self.configure()
 
         try:
+            self._check_digest_algorithms()
             self.configure_add()
         except exception.BadStoreConfiguration as e:
             self.add = self.add_disabled
+            self.add_disabled_at = time.time()
             msg = (_("Failed to configure store correctly: %s "
                      "Disabling add method.") % _exception_to_str(e))
             LOG.warn(msg)
@@ -67,6 +102,23 @@ class Store(object):
         """
         pass
 
+    @classmethod
+    def get_store_class(cls, loc=None):
+        """
+        Return the class of the store built for loc, or for adding images
+        if loc is None. Configured stores are shared per class.
+        """
+        return cls
+
+    def for_context(self, context):
+        """
+        Return a copy of this configured store acting on behalf of
+        context, without configuring it again.
+        """
+        store = copy.copy(self)
+        store.context = context
+        return store
+
     def get_schemes(self):
         """
         Returns a tuple of schemes which this store can handle.
@@ -83,6 +135,50 @@ class Store(object):
             self.store_location_class = importutils.import_class(class_name)
         return self.store_location_class
 
+    def _check_digest_algorithms(self):
+        try:
+            self.new_digests()
+        except ValueError as e:
+            reason = (_("Invalid image_digest_algorithms: %s") %
+                      _exception_to_str(e))
+            raise exception.BadStoreConfiguration(store_name=self.__module__,
+                                                  reason=reason)
+
+    def new_digests(self, backend_md5=False):
+        """
+        Return a `glance.common.utils.MultiHash` computing the digests of
+        an image being added: those named by image_digest_algorithms, and
+        md5 unless backend_md5 is set because the backend returns a
+        trustworthy md5 of the data it stored itself.
+        """
+        algorithms = set(name.lower()
+                         for name in CONF.image_digest_algorithms)
+        if backend_md5:
+            algorithms.discard('md5')
+        else:
+            algorithms.add('md5')
+        return utils.MultiHash(algorithms)
+
+    def read_ahead(self, image_file, chunk_size):
+        """
+        Return a context manager yielding a reader of image_file that
+        reads up to store_read_ahead_chunks chunks of chunk_size ahead
+        while the store writes the previous ones to the backend.
+        """
+        return utils.read_ahead(image_file, chunk_size,
+                                CONF.store_read_ahead_chunks)
+
+    @staticmethod
+    def digests_metadata(digests):
+        """
+        Return the location metadata recording the digests of an added
+        image other than its md5 checksum.
+        """
+        extra = dict((unicode(name), unicode(hexdigest))
+                     for name, hexdigest in digests.hexdigests().iteritems()
+                     if name != 'md5')
+        return extra and {u'digests': extra} or {}
+
     def configure_add(self):
         """
         This is like `configure` except that it's specifically for
@@ -93,14 +189,20 @@ class Store(object):
         """
         pass
 
-    def get(self, location):
+    def get(self, location, offset=0, length=None):
         """
         Takes a `glance.store.location.Location` object that indicates
         where to find the image file, and returns a tuple of generator
         (for reading the image file) and image_size
 
+        When offset or length are given only that byte range of the image
+        is read, and the size returned is the size of the range.
+
         :param location `glance.store.location.Location` object, supplied
                         from glance.store.location.get_location_from_uri()
+        :param offset: offset of the first byte to read
+        :param length: maximum number of bytes to read, None to read up to
+                       the end of the image
         :raises `glance.exception.NotFound` if image does not exist
         """
         raise NotImplementedError
@@ -135,6 +135,7 @@ class Store(glance.store.base.Store):
     """Cinder backend store adapter."""
 
     EXAMPLE_URL = "cinder://volume-id"
+    configure_per_context = True
 
     def get_schemes(self):
         return ('cinder',)
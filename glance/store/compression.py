@@ -0,0 +1,338 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2013 OpenStack, LLC
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Transparent compression of the image data written to a store.
+
+Image data is compressed in blocks of compression_block_size KB of
+uncompressed data, each compressed on its own so that a byte range can be
+read by decompressing only the blocks it covers. The compressed object is
+laid out as:
+
+    block 0 | block 1 | ... | index | footer
+
+where the index holds the compressed size of each block as a 32 bit
+integer and the footer records the codec, the block size, the size of the
+uncompressed data and the offset of the index. Locations whose metadata
+is known and does not name a codec, such as those written before
+compression was enabled, are read unchanged. Otherwise the footer is
+looked for, and objects not ending with a valid one are read unchanged.
+The footer and index of an object are read once and then cached.
+"""
+
+import collections
+import struct
+import tempfile
+import zlib
+
+from oslo.config import cfg
+
+from glance.common import exception
+from glance.common import utils
+import glance.openstack.common.log as logging
+import glance.store
+from glance.store import location
+
+try:
+    import lz4.block as lz4_block
+except ImportError:
+    lz4_block = None
+
+LOG = logging.getLogger(__name__)
+
+compression_opts = [
+    cfg.ListOpt('compressed_stores', default=[],
+                help=_('List of scheme:codec pairs, such as file:zlib, '
+                       'naming the stores that compress the image data they '
+                       'store, and the codec they use: zlib, or lz4 if the '
+                       'lz4 module is installed.')),
+    cfg.IntOpt('compression_block_size', default=1024,
+               help=_('Size, in kilobytes, of the blocks of image data '
+                      'compressed on their own. Reading part of an image '
+                      'decompresses the whole blocks it covers.')),
+    cfg.IntOpt('compression_level', default=6,
+               help=_('zlib compression level, from 1 (fastest) to 9 '
+                      '(smallest).')),
+]
+
+CONF = cfg.CONF
+CONF.register_opts(compression_opts)
+
+MAGIC = 'GLZ\x01'
+# magic, codec id, block size, uncompressed size, index offset
+FOOTER = struct.Struct('<4sB3xIQQ')
+INDEX_ENTRY = struct.Struct('<I')
+# Bytes read from the end of a compressed object to find its footer, and
+# with it the index of most images
+TAIL_SIZE = 64 * 1024
+
+# Layouts of the objects read, keyed by store URI, or False for objects
+# not written compressed. Stored objects are never modified, so entries
+# are only dropped when an object is added or deleted.
+LAYOUT_CACHE_SIZE = 1024
+_LAYOUT_CACHE = utils.LRUCache(LAYOUT_CACHE_SIZE)
+
+Codec = collections.namedtuple('Codec', 'name id compress decompress')
+
+CODECS = {
+    'zlib': Codec('zlib', 1, zlib.compress, zlib.decompress),
+}
+if lz4_block is not None:
+    CODECS['lz4'] = Codec('lz4', 2,
+                          lambda data, level: lz4_block.compress(data),
+                          lz4_block.decompress)
+
+CODECS_BY_ID = dict((codec.id, codec) for codec in CODECS.values())
+
+# Codecs of the stores compressing their data, keyed by the store class
+# registered for their schemes, set by configure_codecs
+_STORE_CODECS = {}
+
+
+def get_configured_codecs():
+    """
+    Return a dict mapping the schemes in compressed_stores to the codecs
+    their stores compress data with.
+
+    :raises `glance.common.exception.BadStoreConfiguration` if an entry
+            is malformed or names an unknown codec
+    """
+    codecs = {}
+    for entry in CONF.compressed_stores:
+        scheme, sep, name = entry.strip().partition(':')
+        if not sep or name not in CODECS:
+            reason = (_("Invalid compressed_stores entry %(entry)s, known "
+                        "codecs are %(codecs)s") %
+                      {'entry': entry, 'codecs': ', '.join(sorted(CODECS))})
+            LOG.error(reason)
+            raise exception.BadStoreConfiguration(store_name=scheme,
+                                                  reason=reason)
+        codecs[scheme] = CODECS[name]
+    return codecs
+
+
+def configure_codecs():
+    """
+    Set the codecs of the stores named in compressed_stores, once the
+    stores are registered.
+
+    :raises `glance.common.exception.BadStoreConfiguration` if an entry
+            is malformed or names an unknown codec
+    """
+    codecs = get_configured_codecs()
+    _STORE_CODECS.clear()
+    for scheme, codec in codecs.items():
+        scheme_info = location.SCHEME_TO_CLS_MAP.get(scheme)
+        if scheme_info:
+            _STORE_CODECS[scheme_info['store_class']] = codec
+
+
+def get_codec(store_cls):
+    """
+    Return the codec the given registered store class compresses data
+    with, or None if its data is not compressed.
+    """
+    return _STORE_CODECS.get(store_cls)
+
+
+def _compress(image_file, codec, block_size, level, digests, result):
+    """
+    Yield the compressed blocks of the data read from image_file followed
+    by the index and footer, hashing the uncompressed data into digests.
+    The size of the uncompressed data is set as result['size'] before the
+    footer is yielded.
+    """
+    buf = bytearray(block_size)
+    sizes = []
+    size = 0
+    while True:
+        count = utils.readinto(image_file, buf)
+        if not count:
+            break
+        data = str(buffer(buf, 0, count))
+        utils.update_checksum(digests, data)
+        size += count
+        block = utils.native_call(codec.compress, data, level)
+        sizes.append(len(block))
+        yield block
+        if count < block_size:
+            break
+    result['size'] = size
+    index = ''.join(INDEX_ENTRY.pack(length) for length in sizes)
+    yield index + FOOTER.pack(MAGIC, codec.id, block_size, size, sum(sizes))
+
+
+class Layout(object):
+    """The blocks of a compressed object, read from its index and footer"""
+
+    def __init__(self, codec, block_size, size, offsets):
+        self.codec = codec
+        self.block_size = block_size
+        self.size = size
+        # offsets[i] is where block i starts, offsets[-1] where the index
+        # starts
+        self.offsets = offsets
+
+
+class CompressedStore(object):
+    """
+    Wraps a store, compressing the image data added to it with codec and
+    decompressing the data read from it. Anything else is handed to the
+    wrapped store.
+    """
+
+    def __init__(self, store, codec):
+        self.store = store
+        self.codec = codec
+
+    def __getattr__(self, name):
+        return getattr(self.store, name)
+
+    def _read(self, location, offset, length):
+        data, size = self.store.get(location, offset=offset, length=length)
+        return ''.join(data)
+
+    def _get_layout(self, location):
+        """
+        Return the `Layout` of the object at location, or None if it was
+        not written compressed.
+        """
+        metadata = getattr(location, 'metadata', None)
+        if metadata is not None and u'compression' not in metadata:
+            return None
+        uri = location.get_store_uri()
+        layout = _LAYOUT_CACHE.get(uri)
+        if layout is None:
+            layout = self._read_layout(location) or False
+            _LAYOUT_CACHE[uri] = layout
+        return layout or None
+
+    def _read_layout(self, location):
+        """Read the `Layout` of the object at location from its tail"""
+        stored_size = self.store.get_size(location)
+        if stored_size < FOOTER.size:
+            return None
+        tail_offset = max(stored_size - TAIL_SIZE, 0)
+        tail = self._read(location, tail_offset, stored_size - tail_offset)
+        (magic, codec_id, block_size, size,
+         index_offset) = FOOTER.unpack(tail[-FOOTER.size:])
+        blocks = (size + block_size - 1) // block_size if block_size else 0
+        if (magic != MAGIC or codec_id not in CODECS_BY_ID or
+                index_offset + blocks * INDEX_ENTRY.size + FOOTER.size !=
+                stored_size):
+            return None
+
+        if index_offset < tail_offset:
+            tail = (self._read(location, index_offset,
+                               tail_offset - index_offset) + tail)
+            tail_offset = index_offset
+        index = tail[index_offset - tail_offset:-FOOTER.size]
+        offsets = [0]
+        for i in xrange(blocks):
+            offsets.append(offsets[-1] +
+                           INDEX_ENTRY.unpack_from(index,
+                                                   i * INDEX_ENTRY.size)[0])
+        return Layout(CODECS_BY_ID[codec_id], block_size, size, offsets)
+
+    def _iter_range(self, location, layout, offset, length):
+        """Yield length bytes of uncompressed data starting at offset"""
+        if not length:
+            return
+        first = offset // layout.block_size
+        last = (offset + length - 1) // layout.block_size
+        offsets = layout.offsets
+        data, size = self.store.get(location, offset=offsets[first],
+                                    length=offsets[last + 1] - offsets[first])
+        skip = offset - first * layout.block_size
+        block = first
+        pending = []
+        pending_size = 0
+        for chunk in data:
+            pending.append(chunk)
+            pending_size += len(chunk)
+            while (block <= last and
+                   pending_size >= offsets[block + 1] - offsets[block]):
+                block_size = offsets[block + 1] - offsets[block]
+                compressed = ''.join(pending)
+                rest = compressed[block_size:]
+                pending = [rest]
+                pending_size = len(rest)
+                uncompressed = utils.native_call(layout.codec.decompress,
+                                                 compressed[:block_size])
+                uncompressed = uncompressed[skip:skip + length]
+                skip = 0
+                length -= len(uncompressed)
+                block += 1
+                yield uncompressed
+
+    def get(self, location, offset=0, length=None):
+        layout = self._get_layout(location)
+        if layout is None:
+            return self.store.get(location, offset=offset, length=length)
+        size = glance.store.get_range_size(layout.size, offset, length)
+        return (self._iter_range(location, layout, offset, size), size)
+
+    def get_size(self, location):
+        layout = self._get_layout(location)
+        if layout is None:
+            return self.store.get_size(location)
+        return layout.size
+
+    def add(self, image_id, image_file, image_size):
+        """
+        Compresses the image data while adding it to the wrapped store,
+        returning the size and checksum of the uncompressed data and the
+        codec in the location metadata.
+        """
+        digests = self.store.new_digests()
+        result = {}
+        data = utils.IterReader(_compress(image_file, self.codec,
+                                          CONF.compression_block_size * 1024,
+                                          CONF.compression_level,
+                                          digests, result))
+        # The compressed size is only known once all the data was read
+        size = 0
+        if not self.store.accepts_unknown_size:
+            data, size = self._spool(data)
+
+        location, stored_size, checksum, metadata = self.store.add(
+            image_id, data, size)
+        _LAYOUT_CACHE.pop(location, None)
+
+        LOG.debug(_("Compressed image %(image_id)s from %(size)d to "
+                    "%(stored_size)d bytes with %(codec)s") %
+                  {'image_id': image_id, 'size': result['size'],
+                   'stored_size': stored_size, 'codec': self.codec.name})
+        metadata = dict(metadata or {})
+        metadata.pop(u'digests', None)
+        metadata.update(self.store.digests_metadata(digests))
+        metadata[u'compression'] = unicode(self.codec.name)
+        return location, result['size'], digests.hexdigest(), metadata
+
+    def delete(self, location):
+        _LAYOUT_CACHE.pop(location.get_store_uri(), None)
+        return self.store.delete(location)
+
+    @staticmethod
+    def _spool(data):
+        """Copy data to a temporary file, returning it and its size"""
+        spool = tempfile.TemporaryFile()
+        for chunk in utils.chunkiter(data):
+            spool.write(chunk)
+        size = spool.tell()
+        spool.seek(0)
+        return spool, size
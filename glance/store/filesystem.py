@@ -20,7 +20,7 @@ A simple filesystem-backed store
 """
 
 import errno
-import hashlib
+import functools
 import json
 import os
 import urlparse
@@ -30,6 +30,7 @@ from oslo.config import cfg
 from glance.common import exception
 from glance.common import utils
 import glance.openstack.common.log as logging
+from glance.openstack.common import uuidutils
 import glance.store
 import glance.store.base
 import glance.store.location
@@ -40,6 +41,15 @@ filesystem_opts = [
     cfg.StrOpt('filesystem_store_datadir',
                help=_('Directory to which the Filesystem backend '
                       'store writes images.')),
+    cfg.MultiStrOpt('filesystem_store_datadirs',
+                    help=_("List of directories and their priorities to "
+                           "which the Filesystem backend store writes "
+                           "images, as <directory>:<priority> entries.")),
+    cfg.IntOpt('filesystem_store_shard_depth', default=0,
+               help=_("Number of levels of subdirectories, named after "
+                      "successive pairs of characters of the image ID, "
+                      "that new image files are written to. 0 writes "
+                      "images directly into the data directory.")),
     cfg.StrOpt('filesystem_store_metadata_file',
                help=_("The path to a file which contains the "
                       "metadata to be returned with any location "
@@ -49,6 +59,101 @@ filesystem_opts = [
 CONF = cfg.CONF
 CONF.register_opts(filesystem_opts)
 
+SHARD_WIDTH = 2
+MAX_SHARD_DEPTH = 16
+
+
+def _get_shards(image_id, depth):
+    return [image_id[i * SHARD_WIDTH:(i + 1) * SHARD_WIDTH]
+            for i in range(depth)]
+
+
+def get_image_path(datadir, image_id, depth=0):
+    """
+    Return the path of the file holding image_id in datadir when depth
+    levels of shard directories are used.
+    """
+    return os.path.join(datadir, *(_get_shards(image_id, depth) + [image_id]))
+
+
+def _split_image_path(filepath):
+    """
+    Split the path of an image file into the data directory it belongs to
+    and the image ID, stripping any shard directories in between.
+    """
+    dirname, image_id = os.path.split(filepath)
+    parts = dirname.split(os.sep)
+    for depth in range(min(MAX_SHARD_DEPTH, len(parts) - 1), 0, -1):
+        if parts[-depth:] == _get_shards(image_id, depth):
+            return os.sep.join(parts[:-depth]), image_id
+    return dirname, image_id
+
+
+def shard_datadir(datadir, depth):
+    """
+    Move the image files in datadir to the layout for depth levels of
+    shard directories, removing shard directories left empty. Existing
+    locations remain valid, as the store looks images up in both the
+    flat and the sharded layout.
+
+    :param datadir: The data directory to migrate
+    :param depth: The number of levels of shard directories, 0 to move
+                  every image back to the top of datadir
+    :retval The number of image files moved
+    """
+    datadir = os.path.normpath(datadir)
+    filepaths = []
+    for dirpath, dirnames, filenames in os.walk(datadir):
+        filepaths.extend(os.path.join(dirpath, filename)
+                         for filename in filenames
+                         if uuidutils.is_uuid_like(filename))
+
+    moved = 0
+    for filepath in filepaths:
+        image_datadir, image_id = _split_image_path(filepath)
+        if image_datadir != datadir:
+            continue
+        new_filepath = get_image_path(datadir, image_id, depth)
+        if new_filepath == filepath:
+            continue
+        if os.path.exists(new_filepath):
+            LOG.warn(_("Not moving %(filepath)s as %(new_filepath)s "
+                       "already exists") % locals())
+            continue
+        _create_image_directory(os.path.dirname(new_filepath))
+        os.rename(filepath, new_filepath)
+        LOG.debug(_("Moved image file %(filepath)s to %(new_filepath)s")
+                  % locals())
+        moved += 1
+
+    for dirpath, dirnames, filenames in os.walk(datadir, topdown=False):
+        shard = os.path.basename(dirpath)
+        if (dirpath != datadir and len(shard) == SHARD_WIDTH and
+                not os.listdir(dirpath)):
+            os.rmdir(dirpath)
+    return moved
+
+
+def _create_image_directory(datadir):
+    if os.path.exists(datadir):
+        return
+
+    msg = _("Directory to write image files does not exist "
+            "(%s). Creating.") % datadir
+    LOG.info(msg)
+    try:
+        os.makedirs(datadir)
+    except (IOError, OSError):
+        if os.path.exists(datadir):
+            # NOTE(markwash): If the path now exists, some other
+            # process must have beat us in the race condition. But it
+            # doesn't hurt, so we can safely ignore the error.
+            return
+        reason = _("Unable to create datadir: %s") % datadir
+        LOG.error(reason)
+        raise exception.BadStoreConfiguration(store_name="filesystem",
+                                              reason=reason)
+
 
 class StoreLocation(glance.store.location.StoreLocation):
 
@@ -87,23 +192,35 @@ class ChunkedFile(object):
 
     CHUNKSIZE = 65536
 
-    def __init__(self, filepath):
+    def __init__(self, filepath, offset=0, length=None):
         self.filepath = filepath
         self.fp = open(self.filepath, 'rb')
+        if offset:
+            self.fp.seek(offset)
+        self.remaining = length
 
     def __iter__(self):
         """Return an iterator over the image file"""
         try:
             if self.fp:
-                while True:
-                    chunk = self.fp.read(ChunkedFile.CHUNKSIZE)
+                while self.remaining is None or self.remaining > 0:
+                    chunk_size = ChunkedFile.CHUNKSIZE
+                    if self.remaining is not None:
+                        chunk_size = min(chunk_size, self.remaining)
+                    chunk = self.fp.read(chunk_size)
                     if chunk:
+                        if self.remaining is not None:
+                            self.remaining -= len(chunk)
                         yield chunk
                     else:
                         break
         finally:
             self.close()
 
+    def fileno(self):
+        """Return the file descriptor of the internal file pointer"""
+        return self.fp.fileno()
+
     def close(self):
         """Close the internal file pointer"""
         if self.fp:
@@ -123,37 +240,130 @@ class Store(glance.store.base.Store):
         this method. If the store was not able to successfully configure
         itself, it should raise `exception.BadStoreConfiguration`
         """
-        self.datadir = CONF.filesystem_store_datadir
-        if self.datadir is None:
-            reason = (_("Could not find %s in configuration options.") %
-                      'filesystem_store_datadir')
+        if not (CONF.filesystem_store_datadir or
+                CONF.filesystem_store_datadirs):
+            reason = (_("Specify at least 'filesystem_store_datadir' or "
+                        "'filesystem_store_datadirs' option"))
             LOG.error(reason)
             raise exception.BadStoreConfiguration(store_name="filesystem",
                                                   reason=reason)
 
-        if not os.path.exists(self.datadir):
-            msg = _("Directory to write image files does not exist "
-                    "(%s). Creating.") % self.datadir
-            LOG.info(msg)
-            try:
-                os.makedirs(self.datadir)
-            except (IOError, OSError):
-                if os.path.exists(self.datadir):
-                    # NOTE(markwash): If the path now exists, some other
-                    # process must have beat us in the race condition. But it
-                    # doesn't hurt, so we can safely ignore the error.
-                    return
-                reason = _("Unable to create datadir: %s") % self.datadir
-                LOG.error(reason)
-                raise exception.BadStoreConfiguration(store_name="filesystem",
-                                                      reason=reason)
+        if CONF.filesystem_store_datadir and CONF.filesystem_store_datadirs:
+            reason = (_("Specify either 'filesystem_store_datadir' or "
+                        "'filesystem_store_datadirs' option"))
+            LOG.error(reason)
+            raise exception.BadStoreConfiguration(store_name="filesystem",
+                                                  reason=reason)
+
+        self.multiple_datadirs = False
+        directory_paths = []
+        if CONF.filesystem_store_datadir:
+            self.datadir = CONF.filesystem_store_datadir
+            directory_paths.append(self.datadir)
+        else:
+            self.multiple_datadirs = True
+            self.priority_data_map = {}
+            for datadir in CONF.filesystem_store_datadirs:
+                datadir_path, priority = self._get_datadir_path_and_priority(
+                        datadir)
+                if datadir_path in directory_paths:
+                    reason = (_("Directory %s specified multiple times in "
+                                "filesystem_store_datadirs option")
+                              % datadir_path)
+                    LOG.error(reason)
+                    raise exception.BadStoreConfiguration(
+                            store_name="filesystem", reason=reason)
+                directory_paths.append(datadir_path)
+                self.priority_data_map.setdefault(priority,
+                                                  []).append(datadir_path)
+            self.priority_list = sorted(self.priority_data_map, reverse=True)
+
+        for datadir_path in directory_paths:
+            _create_image_directory(datadir_path)
+
+        self.shard_depth = CONF.filesystem_store_shard_depth
+        if not 0 <= self.shard_depth <= MAX_SHARD_DEPTH:
+            reason = (_("filesystem_store_shard_depth must be between 0 "
+                        "and %d") % MAX_SHARD_DEPTH)
+            LOG.error(reason)
+            raise exception.BadStoreConfiguration(store_name="filesystem",
+                                                  reason=reason)
+
+    @staticmethod
+    def _get_datadir_path_and_priority(datadir):
+        """
+        Split a filesystem_store_datadirs entry into the directory path
+        and its priority, which defaults to 0 if not given.
+        """
+        parts = [part.strip() for part in datadir.rsplit(":", 1)]
+        datadir_path = parts[0]
+        priority = parts[1] if len(parts) == 2 else '0'
+        if not datadir_path or not priority.isdigit():
+            reason = (_("Invalid directory specified in "
+                        "filesystem_store_datadirs option: %s") % datadir)
+            LOG.error(reason)
+            raise exception.BadStoreConfiguration(store_name="filesystem",
+                                                  reason=reason)
+        return datadir_path, int(priority)
+
+    @staticmethod
+    def _get_free_space(datadir):
+        """Return the number of bytes available in datadir"""
+        result = os.statvfs(datadir)
+        return result.f_bavail * result.f_frsize
+
+    def _find_best_datadir(self, image_size):
+        """
+        Return the directory a new image of image_size bytes should be
+        written to. Directories are tried in order of decreasing priority
+        and, within a priority, the one with the most free space that can
+        hold the image is chosen.
+
+        :raises `glance.common.exception.StorageFull` if no directory has
+                enough free space
+        """
+        if not self.multiple_datadirs:
+            return self.datadir
+
+        for priority in self.priority_list:
+            best_datadir = None
+            max_free_space = -1
+            for datadir in self.priority_data_map[priority]:
+                free_space = self._get_free_space(datadir)
+                if free_space >= image_size and free_space > max_free_space:
+                    max_free_space = free_space
+                    best_datadir = datadir
+            if best_datadir:
+                return best_datadir
+
+        msg = (_("There is not enough disk space left on the image storage "
+                 "media. requested=%s") % image_size)
+        LOG.error(msg)
+        raise exception.StorageFull(msg)
 
     @staticmethod
-    def _resolve_location(location):
-        filepath = location.store_location.path
+    def _find_image_file(filepath):
+        """
+        Return the path of the image file recorded as filepath, looking for
+        it in the flat and sharded layouts of its data directory if it has
+        been moved, or None if it cannot be found.
+        """
+        if os.path.exists(filepath):
+            return filepath
+
+        datadir, image_id = _split_image_path(filepath)
+        for depth in set([0, CONF.filesystem_store_shard_depth]):
+            candidate = get_image_path(datadir, image_id, depth)
+            if os.path.exists(candidate):
+                return candidate
+        return None
+
+    def _resolve_location(self, location):
+        filepath = self._find_image_file(location.store_location.path)
 
-        if not os.path.exists(filepath):
-            raise exception.NotFound(_("Image file %s not found") % filepath)
+        if filepath is None:
+            raise exception.NotFound(_("Image file %s not found")
+                                     % location.store_location.path)
 
         filesize = os.path.getsize(filepath)
         return filepath, filesize
@@ -185,7 +395,7 @@ class Store(glance.store.base.Store):
                             'returned to the client.') % str(ex))
             return {}
 
-    def get(self, location):
+    def get(self, location, offset=0, length=None):
         """
         Takes a `glance.store.location.Location` object that indicates
         where to find the image file, and returns a tuple of generator
@@ -193,12 +403,16 @@ class Store(glance.store.base.Store):
 
         :param location `glance.store.location.Location` object, supplied
                         from glance.store.location.get_location_from_uri()
+        :param offset: offset of the first byte to read
+        :param length: maximum number of bytes to read
         :raises `glance.exception.NotFound` if image does not exist
         """
         filepath, filesize = self._resolve_location(location)
         msg = _("Found image at %s. Returning in ChunkedFile.") % filepath
         LOG.debug(msg)
-        return (ChunkedFile(filepath), filesize)
+        size = glance.store.get_range_size(filesize, offset, length)
+        chunked_file = ChunkedFile(filepath, offset, length)
+        return (utils.FileWrapper(chunked_file, size, offset=offset), size)
 
     def get_size(self, location):
         """
@@ -227,15 +441,16 @@ class Store(glance.store.base.Store):
         :raises Forbidden if cannot delete because of permissions
         """
         loc = location.store_location
-        fn = loc.path
-        if os.path.exists(fn):
+        fn = self._find_image_file(loc.path)
+        if fn is not None:
             try:
                 LOG.debug(_("Deleting image at %(fn)s") % locals())
                 os.unlink(fn)
             except OSError:
                 raise exception.Forbidden(_("You cannot delete file %s") % fn)
         else:
-            raise exception.NotFound(_("Image file %s does not exist") % fn)
+            raise exception.NotFound(_("Image file %s does not exist")
+                                     % loc.path)
 
     def add(self, image_id, image_file, image_size):
         """
@@ -255,24 +470,40 @@ class Store(glance.store.base.Store):
         :note By default, the backend writes the image data to a file
               `/<DATADIR>/<ID>`, where <DATADIR> is the value of
               the filesystem_store_datadir configuration option and <ID>
-              is the supplied image ID.
+              is the supplied image ID. When filesystem_store_datadirs is
+              set instead, <DATADIR> is the directory with the highest
+              priority that has room for the image. If
+              filesystem_store_shard_depth is set the file is written to
+              `/<DATADIR>/<ID[0:2]>/<ID[2:4]>/.../<ID>` instead.
         """
 
-        filepath = os.path.join(self.datadir, str(image_id))
+        datadir = self._find_best_datadir(image_size)
+        filepath = get_image_path(datadir, str(image_id), self.shard_depth)
 
         if os.path.exists(filepath):
             raise exception.Duplicate(_("Image file %s already exists!")
                                       % filepath)
 
-        checksum = hashlib.md5()
+        try:
+            _create_image_directory(os.path.dirname(filepath))
+        except exception.BadStoreConfiguration:
+            raise exception.StorageWriteDenied()
+
+        checksum = self.new_digests()
         bytes_written = 0
         try:
-            with open(filepath, 'wb') as f:
-                for buf in utils.chunkreadable(image_file,
-                                               ChunkedFile.CHUNKSIZE):
-                    bytes_written += len(buf)
-                    checksum.update(buf)
-                    f.write(buf)
+            with self.read_ahead(image_file, ChunkedFile.CHUNKSIZE) as data:
+                with open(filepath, 'wb') as f:
+                    write = f.write
+                    if data is not image_file:
+                        # Write from a native thread, so that the data is
+                        # read ahead meanwhile
+                        write = functools.partial(utils.native_call, f.write)
+                    for buf in utils.chunkreadable(data,
+                                                   ChunkedFile.CHUNKSIZE):
+                        bytes_written += len(buf)
+                        utils.update_checksum(checksum, buf)
+                        write(buf)
         except IOError as e:
             if e.errno != errno.EACCES:
                 self._delete_partial(filepath, image_id)
@@ -286,6 +517,7 @@ class Store(glance.store.base.Store):
 
         checksum_hex = checksum.hexdigest()
         metadata = self._get_metadata()
+        metadata.update(self.digests_metadata(checksum))
 
         LOG.debug(_("Wrote %(bytes_written)d bytes to %(filepath)s with "
                     "checksum %(checksum_hex)s") % locals())
@@ -22,6 +22,7 @@ from oslo.config import cfg
 import urlparse
 
 from glance.common import exception
+from glance.common import utils
 import glance.openstack.common.log as logging
 import glance.store
 import glance.store.base
@@ -45,11 +46,41 @@ gridfs_opts = [
                     "in '[' and ']' characters following the RFC2732 "
                     "URL syntax (e.g. '[::1]' for localhost)"),
     cfg.StrOpt('mongodb_store_db', default=None, help='Database to use'),
+    cfg.IntOpt('mongodb_store_chunk_size', default=256,
+               help='Size, in KB, of the GridFS chunks images are written '
+                    'in. Each chunk is stored as a separate document.'),
 ]
 
 CONF = cfg.CONF
 CONF.register_opts(gridfs_opts)
 
+_CLIENTS = {}
+
+
+def get_client(uri):
+    """
+    Return the process-wide client for a mongodb URI. A MongoClient keeps
+    its own pool of connections and is safe to share, so all store
+    instances of a process use one client per URI.
+    """
+    client = _CLIENTS.get(uri)
+    if client is None:
+        client = _CLIENTS[uri] = pymongo.MongoClient(uri)
+    return client
+
+
+def range_iterator(image, offset, length):
+    """
+    Return an iterator over length bytes of a GridOut starting at offset.
+    """
+    image.seek(offset)
+    while length > 0:
+        chunk = image.read(min(image.chunk_size, length))
+        if not chunk:
+            break
+        length -= len(chunk)
+        yield chunk
+
 
 class StoreLocation(glance.store.location.StoreLocation):
     """
@@ -106,8 +137,17 @@ class Store(glance.store.base.Store):
         self.mongodb_db = self._option_get('mongodb_store_db') or \
             parsed.get("database")
 
-        self.mongodb = pymongo.MongoClient(self.mongodb_uri)
-        self.fs = gridfs.GridFS(self.mongodb[self.mongodb_db])
+        self.chunk_size = self._option_get('mongodb_store_chunk_size') * 1024
+
+        self.mongodb = get_client(self.mongodb_uri)
+        database = self.mongodb[self.mongodb_db]
+        try:
+            # NOTE: add computes the md5 of the image while writing it, so
+            # the server need not read the chunks back to compute it
+            self.fs = gridfs.GridFS(database, disable_md5=True)
+        except TypeError:
+            # pymongo older than 3.6 always has the server compute it
+            self.fs = gridfs.GridFS(database)
 
     def _option_get(self, param):
         result = getattr(CONF, param)
@@ -119,7 +159,7 @@ class Store(glance.store.base.Store):
                                                   reason=reason)
         return result
 
-    def get(self, location):
+    def get(self, location, offset=0, length=None):
         """
         Takes a `glance.store.location.Location` object that indicates
         where to find the image file, and returns a tuple of generator
@@ -127,10 +167,15 @@ class Store(glance.store.base.Store):
 
         :param location `glance.store.location.Location` object, supplied
                         from glance.store.location.get_location_from_uri()
+        :param offset: offset of the first byte to read
+        :param length: maximum number of bytes to read
         :raises `glance.exception.NotFound` if image does not exist
         """
         image = self._get_file(location)
-        return (image, image.length)
+        if not offset and length is None:
+            return (image, image.length)
+        size = glance.store.get_range_size(image.length, offset, length)
+        return (range_iterator(image, offset, size), size)
 
     def get_size(self, location):
         """
@@ -185,13 +230,30 @@ class Store(glance.store.base.Store):
         LOG.debug(_("Adding a new image to GridFS with id %s and size %s") %
                  (image_id, image_size))
 
-        self.fs.put(image_file, _id=image_id)
-        image = self._get_file(loc)
+        # NOTE: the body is read in whole chunks, so each write is sent
+        # to GridFS as a chunk document straight away, and the size and
+        # digests are computed on the way instead of read back afterwards.
+        digests = self.new_digests()
+        size = 0
+        image = self.fs.new_file(_id=image_id, chunkSize=self.chunk_size)
+        try:
+            for chunk in utils.chunkreadable(image_file, self.chunk_size):
+                utils.update_checksum(digests, chunk)
+                size += len(chunk)
+                image.write(chunk)
+            image.close()
+        except Exception:
+            # chunks already written would otherwise be left behind
+            # without a file document
+            self.fs.delete(image_id)
+            raise
 
+        checksum_hex = digests.hexdigest()
         LOG.debug(_("Uploaded image %s, md5 %s, length %s to GridFS") %
-                 (image._id, image.md5, image.length))
+                 (image_id, checksum_hex, size))
 
-        return (loc.get_uri(), image.length, image.md5, {})
+        return (loc.get_uri(), size, checksum_hex,
+                self.digests_metadata(digests))
 
     def delete(self, location):
         """
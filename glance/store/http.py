@@ -16,10 +16,15 @@
 #    under the License.
 
 import httplib
+import socket
+import time
 import urlparse
 
+from oslo.config import cfg
+
 from glance.common import exception
 import glance.openstack.common.log as logging
+import glance.store
 import glance.store.base
 import glance.store.location
 
@@ -27,6 +32,99 @@ LOG = logging.getLogger(__name__)
 
 
 MAX_REDIRECTS = 5
+MAX_HEAD_CACHE_ENTRIES = 1024
+
+http_opts = [
+    cfg.IntOpt('http_store_connection_pool_size', default=10,
+               help=_('The number of idle keep-alive connections kept per '
+                      'host for reuse by later requests. Set to 0 to use a '
+                      'new connection for every request.')),
+    cfg.IntOpt('http_store_head_cache_ttl', default=30,
+               help=_('The number of seconds the size of an image found '
+                      'by a HEAD request is reused before the image is '
+                      'queried again, during which changes to the image '
+                      'are not seen. Set to 0 to disable the cache.')),
+]
+
+CONF = cfg.CONF
+CONF.register_opts(http_opts)
+
+
+class ConnectionPool(object):
+
+    """
+    Process-wide pool of idle keep-alive connections, keyed by the scheme
+    and host they were opened to. Reusing a connection saves a TCP (and
+    TLS) handshake per request.
+    """
+
+    def __init__(self):
+        self.connections = {}
+
+    def get(self, key):
+        """Return an idle connection for key, or None if there is none"""
+        try:
+            return self.connections.get(key, []).pop()
+        except IndexError:
+            return None
+
+    def put(self, key, connection):
+        """Hand back a connection whose last response was read in full"""
+        idle = self.connections.setdefault(key, [])
+        if len(idle) < CONF.http_store_connection_pool_size:
+            idle.append(connection)
+        else:
+            connection.close()
+
+    def clear(self):
+        self.connections.clear()
+
+
+CONNECTION_POOL = ConnectionPool()
+
+
+class HeadCache(object):
+
+    """
+    Process-wide cache of the image sizes returned by HEAD requests,
+    keyed by image URI, so the size queries made around every activation
+    or download of an image do not each cost a request.
+
+    Entries are not revalidated: a change of the image behind a URI is
+    seen up to http_store_head_cache_ttl seconds late.
+    """
+
+    def __init__(self):
+        self.entries = {}
+
+    def get(self, uri):
+        """Return the cached size of uri, or None"""
+        entry = self.entries.get(uri)
+        if entry is None:
+            return None
+        size, fetched = entry
+        if time.time() - fetched >= CONF.http_store_head_cache_ttl:
+            del self.entries[uri]
+            return None
+        return size
+
+    def put(self, uri, size):
+        if CONF.http_store_head_cache_ttl <= 0:
+            return
+        if len(self.entries) >= MAX_HEAD_CACHE_ENTRIES:
+            now = time.time()
+            for key, (_size, fetched) in self.entries.items():
+                if now - fetched >= CONF.http_store_head_cache_ttl:
+                    del self.entries[key]
+            if len(self.entries) >= MAX_HEAD_CACHE_ENTRIES:
+                self.entries.clear()
+        self.entries[uri] = (size, time.time())
+
+    def clear(self):
+        self.entries.clear()
+
+
+HEAD_CACHE = HeadCache()
 
 
 class StoreLocation(glance.store.location.StoreLocation):
@@ -93,26 +191,55 @@ class StoreLocation(glance.store.location.StoreLocation):
         self.path = path
 
 
-def http_response_iterator(conn, response, size):
+def http_response_iterator(conn, response, size, offset=0, length=None,
+                           release=None):
     """
     Return an iterator for a file-like object.
 
     :param conn: HTTP(S) Connection
     :param response: httplib.HTTPResponse object
     :param size: Chunk size to iterate with
+    :param offset: Number of bytes to discard before yielding data
+    :param length: Maximum number of bytes to yield
+    :param release: Called with conn instead of closing it if the response
+                    was read in full and the connection can be reused
     """
-    chunk = response.read(size)
-    while chunk:
-        yield chunk
-        chunk = response.read(size)
-    conn.close()
+    try:
+        while offset > 0:
+            skipped = response.read(min(size, offset))
+            if not skipped:
+                break
+            offset -= len(skipped)
+
+        remaining = length
+        while remaining is None or remaining > 0:
+            chunk = response.read(size if remaining is None
+                                  else min(size, remaining))
+            if not chunk:
+                break
+            if remaining is not None:
+                remaining -= len(chunk)
+            yield chunk
+    finally:
+        if release is not None and _reusable(response):
+            release(conn)
+        else:
+            conn.close()
+
+
+def _reusable(response):
+    """
+    Whether response was read in full from a connection the server keeps
+    open, so that the connection can send another request.
+    """
+    return response.isclosed() and not response.will_close
 
 
 class Store(glance.store.base.Store):
 
     """An implementation of the HTTP(S) Backend Adapter"""
 
-    def get(self, location):
+    def get(self, location, offset=0, length=None):
         """
         Takes a `glance.store.location.Location` object that indicates
         where to find the image file, and returns a tuple of generator
@@ -120,10 +247,30 @@ class Store(glance.store.base.Store):
 
         :param location `glance.store.location.Location` object, supplied
                         from glance.store.location.get_location_from_uri()
+        :param offset: offset of the first byte to read
+        :param length: maximum number of bytes to read
         """
-        conn, resp, content_length = self._query(location, 'GET')
+        headers = {}
+        range_header = glance.store.get_range_header(offset, length)
+        if range_header:
+            headers['Range'] = range_header
+        conn, resp, content_length = self._query(location, 'GET',
+                                                 headers=headers)
+        loc = location.store_location
+
+        def release(conn):
+            CONNECTION_POOL.put(self._get_connection_key(loc), conn)
 
-        iterator = http_response_iterator(conn, resp, self.CHUNKSIZE)
+        if range_header and resp.status != httplib.PARTIAL_CONTENT:
+            # NOTE: the server ignored the Range header and is sending the
+            # whole image, so skip up to the requested range ourselves
+            content_length = glance.store.get_range_size(content_length,
+                                                         offset, length)
+            iterator = http_response_iterator(conn, resp, self.CHUNKSIZE,
+                                              offset, length, release)
+        else:
+            iterator = http_response_iterator(conn, resp, self.CHUNKSIZE,
+                                              release=release)
 
         class ResponseIndexable(glance.store.Indexable):
             def another(self):
@@ -145,38 +292,82 @@ class Store(glance.store.base.Store):
         :param location `glance.store.location.Location` object, supplied
                         from glance.store.location.get_location_from_uri()
         """
+        uri = location.store_location.get_uri()
+        cached = HEAD_CACHE.get(uri)
+        if cached is not None:
+            return cached
         try:
-            return self._query(location, 'HEAD')[2]
+            conn, resp, content_length = self._query(location, 'HEAD')
         except Exception:
             return 0
+        self._release(location.store_location, conn, resp)
+        HEAD_CACHE.put(uri, content_length)
+        return content_length
+
+    def _get_connection_key(self, loc):
+        return (loc.scheme, loc.netloc)
 
-    def _query(self, location, verb, depth=0):
+    def _release(self, loc, conn, resp):
+        """
+        Hand conn back to the pool once resp has been read, or close it if
+        it cannot be reused.
+        """
+        resp.read()
+        if _reusable(resp):
+            CONNECTION_POOL.put(self._get_connection_key(loc), conn)
+        else:
+            conn.close()
+
+    def _send(self, loc, verb, headers):
+        """
+        Send a request over an idle pooled connection to the host of loc,
+        or a new one, and return the connection and its response.
+
+        A server may close an idle keep-alive connection at any time, so a
+        request that fails on a pooled connection is sent again on a new
+        one.
+        """
+        conn_class = self._get_conn_class(loc)
+        conn = None
+        if CONF.http_store_connection_pool_size > 0:
+            conn = CONNECTION_POOL.get(self._get_connection_key(loc))
+        if conn is not None:
+            try:
+                conn.request(verb, loc.path, "", headers)
+                return conn, conn.getresponse()
+            except (httplib.HTTPException, socket.error):
+                conn.close()
+        conn = conn_class(loc.netloc)
+        conn.request(verb, loc.path, "", headers)
+        return conn, conn.getresponse()
+
+    def _query(self, location, verb, depth=0, headers=None):
         if depth > MAX_REDIRECTS:
             raise exception.MaxRedirectsExceeded(redirects=MAX_REDIRECTS)
         loc = location.store_location
-        conn_class = self._get_conn_class(loc)
-        conn = conn_class(loc.netloc)
-        conn.request(verb, loc.path, "", {})
-        resp = conn.getresponse()
+        conn, resp = self._send(loc, verb, headers or {})
 
         # Check for bad status codes
         if resp.status >= 400:
+            conn.close()
             reason = _("HTTP URL returned a %s status code.") % resp.status
             raise exception.BadStoreUri(loc.path, reason)
 
         location_header = resp.getheader("location")
         if location_header:
             if resp.status not in (301, 302):
+                conn.close()
                 reason = _("The HTTP URL attempted to redirect with an "
                            "invalid status code.")
                 raise exception.BadStoreUri(loc.path, reason)
+            self._release(loc, conn, resp)
             location_class = glance.store.location.Location
             new_loc = location_class(location.store_name,
                                      location.store_location.__class__,
                                      uri=location_header,
                                      image_id=location.image_id,
                                      store_specs=location.store_specs)
-            return self._query(new_loc, verb, depth + 1)
+            return self._query(new_loc, verb, depth + 1, headers)
         content_length = int(resp.getheader('content-length', 0))
         return (conn, resp, content_length)
 
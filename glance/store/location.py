@@ -39,15 +39,22 @@ that it stores in its storage backends. It **may contain** security
 credentials and is **not** user-facing.
 """
 
+import copy
 import urlparse
 
 from glance.common import exception
+from glance.common import utils
 import glance.openstack.common.log as logging
 
 LOG = logging.getLogger(__name__)
 
 SCHEME_TO_CLS_MAP = {}
 
+# Parsed locations keyed by URI and store location class. Callers are
+# handed copies, so the cached objects are never modified.
+LOCATION_CACHE_SIZE = 1024
+_LOCATION_CACHE = utils.LRUCache(LOCATION_CACHE_SIZE)
+
 
 def get_location_from_uri(uri):
     """
@@ -72,8 +79,22 @@ def get_location_from_uri(uri):
     if pieces.scheme not in SCHEME_TO_CLS_MAP.keys():
         raise exception.UnknownScheme(scheme=pieces.scheme)
     scheme_info = SCHEME_TO_CLS_MAP[pieces.scheme]
-    return Location(pieces.scheme, uri=uri,
-                    store_location_class=scheme_info['location_class'])
+    key = (uri, scheme_info['location_class'])
+    loc = _LOCATION_CACHE.get(key)
+    if loc is None:
+        loc = Location(pieces.scheme, uri=uri,
+                       store_location_class=scheme_info['location_class'])
+        _LOCATION_CACHE[key] = loc
+    return _copy_location(loc)
+
+
+def _copy_location(loc):
+    """Returns a copy of a Location that shares no mutable state with it"""
+    new_loc = copy.copy(loc)
+    new_loc.store_specs = dict(loc.store_specs)
+    new_loc.store_location = copy.copy(loc.store_location)
+    new_loc.store_location.specs = new_loc.store_specs
+    return new_loc
 
 
 def register_scheme_map(scheme_map):
@@ -110,6 +131,8 @@ class Location(object):
         """
         self.store_name = store_name
         self.image_id = image_id
+        # Metadata of the image location, when known
+        self.metadata = None
         self.store_specs = store_specs or {}
         self.store_location = store_location_class(self.store_specs)
         if uri:
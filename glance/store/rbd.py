@@ -20,14 +20,19 @@
 from __future__ import absolute_import
 from __future__ import with_statement
 
-import hashlib
+import collections
+import contextlib
+import itertools
 import math
+import os
 import urllib
 
+import eventlet
 from oslo.config import cfg
 
 from glance.common import exception
 from glance.common import utils
+from glance.openstack.common import excutils
 import glance.openstack.common.log as logging
 import glance.store
 import glance.store.base
@@ -44,6 +49,7 @@ DEFAULT_CONFFILE = ''  # librados will locate the default conf file
 DEFAULT_USER = None    # let librados decide based on the Ceph conf file
 DEFAULT_CHUNKSIZE = 4  # in MiB
 DEFAULT_SNAPNAME = 'snap'
+DEFAULT_IO_CONCURRENCY = 1
 
 LOG = logging.getLogger(__name__)
 
@@ -59,12 +65,160 @@ rbd_opts = [
                       'using cephx.)')),
     cfg.StrOpt('rbd_store_ceph_conf', default=DEFAULT_CONFFILE,
                help=_('Ceph configuration file path.')),
+    cfg.IntOpt('rbd_store_io_concurrency', default=DEFAULT_IO_CONCURRENCY,
+               help=_('The number of chunk reads or writes kept in flight '
+                      'per image transfer. Up to this many chunks of '
+                      'rbd_store_chunk_size are held in memory per '
+                      'transfer.')),
 ]
 
 CONF = cfg.CONF
 CONF.register_opts(rbd_opts)
 
 
+class ClusterCache(object):
+    """
+    Process-wide cache of connected ``rados.Rados`` handles, keyed by the
+    Ceph configuration file and user they were connected with, and of the
+    pool ioctxs opened through them. Connecting to a cluster means a
+    monitor handshake and authentication, so sharing one connection saves
+    that on every operation.
+
+    Handles are not carried over a fork: librados threads do not survive
+    it, so a child process connects again on first use.
+    """
+
+    def __init__(self):
+        self.pid = None
+        self.clusters = {}
+        self.ioctxs = {}
+        self.lock = eventlet.semaphore.Semaphore()
+
+    def _check_pid(self):
+        pid = os.getpid()
+        if pid != self.pid:
+            # NOTE: handles inherited from the parent must not be closed
+            # here either, as that would tear down the parent's connection
+            self.clusters = {}
+            self.ioctxs = {}
+            self.lock = eventlet.semaphore.Semaphore()
+            self.pid = pid
+
+    def get_ioctx(self, conf_file, user, pool):
+        """
+        Return a connected ``rados.Rados`` for conf_file and user, and an
+        ioctx for pool opened through it, connecting if needed.
+        """
+        self._check_pid()
+        key = (conf_file, user)
+        # NOTE: connecting yields to other greenthreads, which must wait
+        # for this connection rather than open one of their own
+        with self.lock:
+            conn = self.clusters.get(key)
+            if conn is None:
+                conn = rados.Rados(conffile=conf_file, rados_id=user)
+                utils.native_call(conn.connect)
+                self.clusters[key] = conn
+            ioctx = self.ioctxs.get(key + (pool,))
+            if ioctx is None:
+                ioctx = utils.native_call(conn.open_ioctx, pool)
+                self.ioctxs[key + (pool,)] = ioctx
+        return conn, ioctx
+
+    def reset(self, conf_file, user):
+        """
+        Drop the connection for conf_file and user, and the ioctxs opened
+        through it, so that the next operation connects again.
+        """
+        self._check_pid()
+        key = (conf_file, user)
+        for ioctx_key in [k for k in self.ioctxs if k[:2] == key]:
+            ioctx = self.ioctxs.pop(ioctx_key)
+            try:
+                ioctx.close()
+            except Exception:
+                pass
+        conn = self.clusters.pop(key, None)
+        if conn is not None:
+            try:
+                conn.shutdown()
+            except Exception:
+                pass
+
+    def clear(self):
+        """Drop all connections"""
+        self._check_pid()
+        for conf_file, user in self.clusters.keys():
+            self.reset(conf_file, user)
+
+
+CLUSTERS = ClusterCache()
+
+
+def _pipelined(func, calls, depth):
+    """
+    Call func(*args) for each args in calls in native threads, so that
+    blocking librbd calls do not stall the eventlet hub, keeping up to
+    depth calls in flight, and yield their results in order.
+
+    The next args are only taken from calls once a result has been
+    yielded, so at most depth calls and their data are pending at once.
+    Closing the generator waits for the calls in flight.
+    """
+    pending = collections.deque()
+    calls = iter(calls)
+    try:
+        for args in itertools.islice(calls, depth):
+            pending.append(eventlet.spawn(utils.native_call, func, *args))
+        while pending:
+            result = pending.popleft().wait()
+            for args in itertools.islice(calls, 1):
+                pending.append(eventlet.spawn(utils.native_call, func,
+                                              *args))
+            yield result
+    finally:
+        # NOTE: calls still running in native threads use the image, so
+        # they have to finish before the caller closes it
+        for thread in pending:
+            try:
+                thread.wait()
+            except Exception:
+                pass
+
+
+@contextlib.contextmanager
+def _ioctx(store):
+    """
+    Yield the shared cluster connection and ioctx of a store's pool. If
+    librados raises an error the connection is dropped, so the next
+    operation reconnects instead of reusing a broken connection.
+    """
+    try:
+        conn, ioctx = CLUSTERS.get_ioctx(store.conf_file, store.user,
+                                         store.pool)
+    except rados.Error:
+        CLUSTERS.reset(store.conf_file, store.user)
+        raise
+    try:
+        yield conn, ioctx
+    except rados.Error:
+        CLUSTERS.reset(store.conf_file, store.user)
+        raise
+
+
+@contextlib.contextmanager
+def _image(ioctx, name, **kwargs):
+    """
+    Yield the RBD image name, opened and closed in native threads since
+    both wait on the cluster and would otherwise stall the eventlet hub.
+    """
+    image = utils.native_call(rbd.Image, ioctx, name, **kwargs)
+    try:
+        yield image
+    finally:
+        utils.native_call(image.close)
+
+
 class StoreLocation(glance.store.location.StoreLocation):
     """
     Class describing a RBD URI. This is of the form:
@@ -132,28 +286,30 @@ class ImageIterator(object):
     Reads data from an RBD image, one chunk at a time.
     """
 
-    def __init__(self, name, store):
+    def __init__(self, name, store, offset=0, length=None):
         self.name = name
-        self.pool = store.pool
-        self.user = store.user
-        self.conf_file = store.conf_file
+        self.store = store
         self.chunk_size = store.chunk_size
+        self.offset = offset
+        self.length = length
 
     def __iter__(self):
         try:
-            with rados.Rados(conffile=self.conf_file,
-                             rados_id=self.user) as conn:
-                with conn.open_ioctx(self.pool) as ioctx:
-                    with rbd.Image(ioctx, self.name) as image:
-                        img_info = image.stat()
-                        size = img_info['size']
-                        bytes_left = size
-                        while bytes_left > 0:
-                            length = min(self.chunk_size, bytes_left)
-                            data = image.read(size - bytes_left, length)
-                            bytes_left -= len(data)
+            with _ioctx(self.store) as (conn, ioctx):
+                with _image(ioctx, self.name) as image:
+                    img_info = utils.native_call(image.stat)
+                    size = glance.store.get_range_size(img_info['size'],
+                                                       self.offset,
+                                                       self.length)
+                    reads = ((self.offset + start,
+                              min(self.chunk_size, size - start))
+                             for start in xrange(0, size, self.chunk_size))
+                    pipeline = _pipelined(image.read, reads,
+                                          self.store.io_concurrency)
+                    with contextlib.closing(pipeline):
+                        for data in pipeline:
                             yield data
-                        raise StopIteration()
+                    raise StopIteration()
         except rbd.ImageNotFound:
             raise exception.NotFound(
                 _('RBD image %s does not exist') % self.name)
@@ -164,6 +320,9 @@ class Store(glance.store.base.Store):
 
     EXAMPLE_URL = "rbd://<FSID>/<POOL>/<IMAGE>/<SNAP>"
 
+    # RBD images are created with the size of the image data
+    accepts_unknown_size = False
+
     def get_schemes(self):
         return ('rbd',)
 
@@ -182,13 +341,14 @@ class Store(glance.store.base.Store):
             self.pool = str(CONF.rbd_store_pool)
             self.user = str(CONF.rbd_store_user)
             self.conf_file = str(CONF.rbd_store_ceph_conf)
+            self.io_concurrency = max(CONF.rbd_store_io_concurrency, 1)
         except cfg.ConfigFileValueError as e:
             reason = _("Error in store configuration: %s") % e
             LOG.error(reason)
             raise exception.BadStoreConfiguration(store_name='rbd',
                                                   reason=reason)
 
-    def get(self, location):
+    def get(self, location, offset=0, length=None):
         """
         Takes a `glance.store.location.Location` object that indicates
         where to find the image file, and returns a tuple of generator
@@ -196,10 +356,14 @@ class Store(glance.store.base.Store):
 
         :param location `glance.store.location.Location` object, supplied
                         from glance.store.location.get_location_from_uri()
+        :param offset: offset of the first byte to read
+        :param length: maximum number of bytes to read
         :raises `glance.exception.NotFound` if image does not exist
         """
         loc = location.store_location
-        return (ImageIterator(loc.image, self), self.get_size(location))
+        size = glance.store.get_range_size(self.get_size(location), offset,
+                                           length)
+        return (ImageIterator(loc.image, self, offset, length), size)
 
     def get_size(self, location):
         """
@@ -211,18 +375,16 @@ class Store(glance.store.base.Store):
         :raises `glance.exception.NotFound` if image does not exist
         """
         loc = location.store_location
-        with rados.Rados(conffile=self.conf_file,
-                         rados_id=self.user) as conn:
-            with conn.open_ioctx(self.pool) as ioctx:
-                try:
-                    with rbd.Image(ioctx, loc.image,
-                                   snapshot=loc.snapshot) as image:
-                        img_info = image.stat()
-                        return img_info['size']
-                except rbd.ImageNotFound:
-                    msg = _('RBD image %s does not exist') % loc.get_uri()
-                    LOG.debug(msg)
-                    raise exception.NotFound(msg)
+        with _ioctx(self) as (conn, ioctx):
+            try:
+                with _image(ioctx, loc.image,
+                            snapshot=loc.snapshot) as image:
+                    img_info = utils.native_call(image.stat)
+                    return img_info['size']
+            except rbd.ImageNotFound:
+                msg = _('RBD image %s does not exist') % loc.get_uri()
+                LOG.debug(msg)
+                raise exception.NotFound(msg)
 
     def _create_image(self, fsid, ioctx, name, size, order):
         """
@@ -234,8 +396,9 @@ class Store(glance.store.base.Store):
         """
         librbd = rbd.RBD()
         if hasattr(rbd, 'RBD_FEATURE_LAYERING'):
-            librbd.create(ioctx, name, size, order, old_format=False,
-                          features=rbd.RBD_FEATURE_LAYERING)
+            utils.native_call(librbd.create, ioctx, name, size, order,
+                              old_format=False,
+                              features=rbd.RBD_FEATURE_LAYERING)
             return StoreLocation({
                 'fsid': fsid,
                 'pool': self.pool,
@@ -243,7 +406,8 @@ class Store(glance.store.base.Store):
                 'snapshot': DEFAULT_SNAPNAME,
             })
         else:
-            librbd.create(ioctx, name, size, order, old_format=True)
+            utils.native_call(librbd.create, ioctx, name, size, order,
+                              old_format=True)
             return StoreLocation({'image': name})
 
     def add(self, image_id, image_file, image_size):
@@ -261,33 +425,57 @@ class Store(glance.store.base.Store):
         :raises `glance.common.exception.Duplicate` if the image already
                 existed
         """
-        checksum = hashlib.md5()
+        checksum = self.new_digests()
         image_name = str(image_id)
-        with rados.Rados(conffile=self.conf_file, rados_id=self.user) as conn:
+        with _ioctx(self) as (conn, ioctx):
             fsid = None
             if hasattr(conn, 'get_fsid'):
                 fsid = conn.get_fsid()
-            with conn.open_ioctx(self.pool) as ioctx:
-                order = int(math.log(self.chunk_size, 2))
-                LOG.debug('creating image %s with order %d',
-                          image_name, order)
-                try:
-                    location = self._create_image(fsid, ioctx, image_name,
-                                                  image_size, order)
-                except rbd.ImageExists:
-                    raise exception.Duplicate(
-                        _('RBD image %s already exists') % image_id)
-                with rbd.Image(ioctx, image_name) as image:
-                    offset = 0
-                    chunks = utils.chunkreadable(image_file, self.chunk_size)
-                    for chunk in chunks:
-                        offset += image.write(chunk, offset)
-                        checksum.update(chunk)
+            order = int(math.log(self.chunk_size, 2))
+            LOG.debug('creating image %s with order %d', image_name, order)
+            try:
+                location = self._create_image(fsid, ioctx, image_name,
+                                              image_size, order)
+            except rbd.ImageExists:
+                raise exception.Duplicate(
+                    _('RBD image %s already exists') % image_id)
+
+            def writes(data):
+                offset = 0
+                for chunk in utils.chunkreadable(data, self.chunk_size):
+                    utils.update_checksum(checksum, chunk)
+                    yield chunk, offset
+                    offset += len(chunk)
+
+            try:
+                with _image(ioctx, image_name) as image:
+                    with self.read_ahead(image_file,
+                                         self.chunk_size) as data:
+                        pipeline = _pipelined(image.write, writes(data),
+                                              self.io_concurrency)
+                        with contextlib.closing(pipeline):
+                            for written in pipeline:
+                                pass
                     if location.snapshot:
-                        image.create_snap(location.snapshot)
-                        image.protect_snap(location.snapshot)
-
-        return (location.get_uri(), image_size, checksum.hexdigest(), {})
+                        utils.native_call(image.create_snap,
+                                          location.snapshot)
+                        utils.native_call(image.protect_snap,
+                                          location.snapshot)
+            except Exception:
+                with excutils.save_and_reraise_exception():
+                    self._remove_partial_image(ioctx, image_name)
+
+        return (location.get_uri(), image_size, checksum.hexdigest(),
+                self.digests_metadata(checksum))
+
+    def _remove_partial_image(self, ioctx, name):
+        """Remove an image whose data could not be written completely"""
+        LOG.debug(_('Removing partially written RBD image %s'), name)
+        try:
+            utils.native_call(rbd.RBD().remove, ioctx, name)
+        except Exception as e:
+            LOG.warn(_('Failed to remove partially written RBD image '
+                       '%(name)s: %(error)s') % {'name': name, 'error': e})
 
     def delete(self, location):
         """
@@ -301,25 +489,24 @@ class Store(glance.store.base.Store):
         """
         loc = location.store_location
 
-        with rados.Rados(conffile=self.conf_file, rados_id=self.user) as conn:
-            with conn.open_ioctx(self.pool) as ioctx:
-                if loc.snapshot:
-                    with rbd.Image(ioctx, loc.image) as image:
-                        try:
-                            image.unprotect_snap(loc.snapshot)
-                        except rbd.ImageBusy:
-                            log_msg = _("snapshot %s@%s could not be "
-                                        "unprotected because it is in use")
-                            LOG.debug(log_msg % (loc.image, loc.snapshot))
-                            raise exception.InUseByStore()
-                        image.remove_snap(loc.snapshot)
-                try:
-                    rbd.RBD().remove(ioctx, loc.image)
-                except rbd.ImageNotFound:
-                    raise exception.NotFound(
-                        _('RBD image %s does not exist') % loc.image)
-                except rbd.ImageBusy:
-                    log_msg = _("image %s could not be removed"
-                                "because it is in use")
-                    LOG.debug(log_msg % loc.image)
-                    raise exception.InUseByStore()
+        with _ioctx(self) as (conn, ioctx):
+            if loc.snapshot:
+                with _image(ioctx, loc.image) as image:
+                    try:
+                        utils.native_call(image.unprotect_snap, loc.snapshot)
+                    except rbd.ImageBusy:
+                        log_msg = _("snapshot %s@%s could not be "
+                                    "unprotected because it is in use")
+                        LOG.debug(log_msg % (loc.image, loc.snapshot))
+                        raise exception.InUseByStore()
+                    utils.native_call(image.remove_snap, loc.snapshot)
+            try:
+                utils.native_call(rbd.RBD().remove, ioctx, loc.image)
+            except rbd.ImageNotFound:
+                raise exception.NotFound(
+                    _('RBD image %s does not exist') % loc.image)
+            except rbd.ImageBusy:
+                log_msg = _("image %s could not be removed"
+                            "because it is in use")
+                LOG.debug(log_msg % loc.image)
+                raise exception.InUseByStore()
@@ -17,12 +17,15 @@
 
 """Storage backend for S3 or Storage Servers that follow the S3 Protocol"""
 
-import hashlib
+import base64
+import collections
 import httplib
+import itertools
 import re
-import tempfile
+import time
 import urlparse
 
+import eventlet
 from oslo.config import cfg
 
 from glance.common import exception
@@ -34,6 +37,13 @@ import glance.store.location
 
 LOG = logging.getLogger(__name__)
 
+DEFAULT_LARGE_OBJECT_SIZE = 100  # 100M
+DEFAULT_LARGE_OBJECT_CHUNK_SIZE = 10  # 10M
+DEFAULT_LARGE_OBJECT_MIN_CHUNK_SIZE = 5  # 5M
+DEFAULT_THREAD_POOLS = 10  # 10 pools
+DEFAULT_DOWNLOAD_CHUNK_SIZE = 16  # 16M
+ONE_MB = 1024 * 1024
+
 s3_opts = [
     cfg.StrOpt('s3_store_host',
                help=_('The host where the S3 server is listening.')),
@@ -44,8 +54,8 @@ s3_opts = [
     cfg.StrOpt('s3_store_bucket',
                help=_('The S3 bucket to be used to store the Glance data.')),
     cfg.StrOpt('s3_store_object_buffer_dir',
-               help=_('The local directory where uploads will be staged '
-                      'before they are transfered into S3.')),
+               help=_('Deprecated and unused: uploads are streamed into S3 '
+                      'without being staged in a local directory.')),
     cfg.BoolOpt('s3_store_create_bucket_on_put', default=False,
                 help=_('A boolean to determine if the S3 bucket should be '
                        'created on upload if it does not exist or if '
@@ -53,12 +63,110 @@ s3_opts = [
     cfg.StrOpt('s3_store_bucket_url_format', default='subdomain',
                help=_('The S3 calling format used to determine the bucket. '
                       'Either subdomain or path can be used.')),
+    cfg.IntOpt('s3_store_large_object_size',
+               default=DEFAULT_LARGE_OBJECT_SIZE,
+               help=_('The size, in MB, from which images are uploaded to '
+                      'S3 as multipart uploads, unless '
+                      's3_store_large_object_chunk_size is smaller. Images '
+                      'of unknown size are always uploaded as multipart '
+                      'uploads.')),
+    cfg.IntOpt('s3_store_large_object_chunk_size',
+               default=DEFAULT_LARGE_OBJECT_CHUNK_SIZE,
+               help=_('The size, in MB, of the parts of multipart uploads. '
+                      'S3 requires parts of at least 5MB.')),
+    cfg.IntOpt('s3_store_thread_pools', default=DEFAULT_THREAD_POOLS,
+               help=_('The number of parts of a multipart upload that are '
+                      'sent to S3 at the same time. Each part is buffered '
+                      'in memory while it is sent.')),
+    cfg.IntOpt('s3_store_download_concurrency', default=1,
+               help=_('The number of ranged GETs used to download an '
+                      'image from S3 in parallel. The default of 1 reads '
+                      'images with a single GET.')),
+    cfg.IntOpt('s3_store_download_chunk_size',
+               default=DEFAULT_DOWNLOAD_CHUNK_SIZE,
+               help=_('The size, in MB, of the ranged GETs used when '
+                      's3_store_download_concurrency is greater than 1. '
+                      'Up to s3_store_download_concurrency of these are '
+                      'held in memory per download.')),
+    cfg.IntOpt('s3_store_bucket_cache_ttl', default=300,
+               help=_('The number of seconds a bucket handle is reused '
+                      'before it is looked up in S3 again. Set to 0 to '
+                      'look buckets up on every request.')),
 ]
 
 CONF = cfg.CONF
 CONF.register_opts(s3_opts)
 
 
+class ConnectionCache(object):
+
+    """
+    Process-wide cache of S3 connections, keyed by the host, credentials
+    and calling format they were created with, and of the bucket handles
+    fetched through them. A boto connection keeps a pool of HTTP
+    connections and can be shared between green threads, so reusing one
+    saves a TCP/TLS handshake per operation, and reusing a bucket handle
+    saves the round-trips that look the bucket up (and create it when
+    s3_store_create_bucket_on_put is set).
+    """
+
+    def __init__(self):
+        self.connections = {}
+        self.buckets = {}
+
+    def _get_connection_key(self, loc):
+        return (loc.s3serviceurl, loc.accesskey, loc.secretkey,
+                loc.scheme, CONF.s3_store_bucket_url_format)
+
+    def get_connection(self, loc):
+        """
+        Return the connection for a
+        `glance.store.s3.StoreLocation`, creating it if needed.
+        """
+        from boto.s3.connection import S3Connection
+
+        key = self._get_connection_key(loc)
+        connection = self.connections.get(key)
+        if connection is None:
+            connection = S3Connection(loc.accesskey, loc.secretkey,
+                                      host=loc.s3serviceurl,
+                                      is_secure=(loc.scheme == 's3+https'),
+                                      calling_format=get_calling_format())
+            self.connections[key] = connection
+        return connection
+
+    def get_bucket(self, loc, create=False):
+        """
+        Return the bucket of a `glance.store.s3.StoreLocation`, reusing
+        a handle fetched less than s3_store_bucket_cache_ttl seconds ago.
+
+        :param create: create the bucket if it is missing and
+                       s3_store_create_bucket_on_put is set
+        :raises ``glance.exception.NotFound`` if bucket is not found.
+        """
+        key = (self._get_connection_key(loc), loc.bucket)
+        cached = self.buckets.get(key)
+        if cached is not None:
+            bucket, fetched = cached
+            if time.time() - fetched < CONF.s3_store_bucket_cache_ttl:
+                return bucket
+
+        s3_conn = self.get_connection(loc)
+        if create:
+            create_bucket_if_missing(loc.bucket, s3_conn)
+        bucket = get_bucket(s3_conn, loc.bucket)
+        if CONF.s3_store_bucket_cache_ttl > 0:
+            self.buckets[key] = (bucket, time.time())
+        return bucket
+
+    def clear(self):
+        self.connections.clear()
+        self.buckets.clear()
+
+
+CONNECTION_CACHE = ConnectionCache()
+
+
 class StoreLocation(glance.store.location.StoreLocation):
 
     """
@@ -196,12 +304,8 @@ class ChunkedFile(object):
 
     def getvalue(self):
         """Return entire string value... used in testing"""
-        data = ""
-        self.len = 0
-        for chunk in self:
-            read_bytes = len(chunk)
-            data = data + chunk
-            self.len = self.len + read_bytes
+        data = ''.join(self)
+        self.len = len(data)
         return data
 
     def close(self):
@@ -219,6 +323,11 @@ class Store(glance.store.base.Store):
     def get_schemes(self):
         return ('s3', 's3+http', 's3+https')
 
+    def configure(self):
+        self.download_concurrency = CONF.s3_store_download_concurrency
+        _chunk_size = self._option_get('s3_store_download_chunk_size')
+        self.download_chunk_size = _chunk_size * ONE_MB
+
     def configure_add(self):
         """
         Configure the Store to use the stored configuration options
@@ -246,7 +355,17 @@ class Store(glance.store.base.Store):
         else:  # Defaults http
             self.full_s3_host = 'http://' + self.s3_host
 
-        self.s3_store_object_buffer_dir = CONF.s3_store_object_buffer_dir
+        _obj_size = self._option_get('s3_store_large_object_size')
+        self.large_object_size = _obj_size * ONE_MB
+        _chunk_size = self._option_get('s3_store_large_object_chunk_size')
+        if _chunk_size < DEFAULT_LARGE_OBJECT_MIN_CHUNK_SIZE:
+            reason = (_("s3_store_large_object_chunk_size must be at least "
+                        "%d MB") % DEFAULT_LARGE_OBJECT_MIN_CHUNK_SIZE)
+            LOG.error(reason)
+            raise exception.BadStoreConfiguration(store_name="s3",
+                                                  reason=reason)
+        self.large_object_chunk_size = _chunk_size * ONE_MB
+        self.thread_pools = self._option_get('s3_store_thread_pools')
 
     def _option_get(self, param):
         result = getattr(CONF, param)
@@ -258,7 +377,7 @@ class Store(glance.store.base.Store):
                                                   reason=reason)
         return result
 
-    def get(self, location):
+    def get(self, location, offset=0, length=None):
         """
         Takes a `glance.store.location.Location` object that indicates
         where to find the image file, and returns a tuple of generator
@@ -266,18 +385,93 @@ class Store(glance.store.base.Store):
 
         :param location `glance.store.location.Location` object, supplied
                         from glance.store.location.get_location_from_uri()
+        :param offset: offset of the first byte to read
+        :param length: maximum number of bytes to read
         :raises `glance.exception.NotFound` if image does not exist
         """
         key = self._retrieve_key(location)
 
         key.BufferSize = self.CHUNKSIZE
 
+        if (self.download_concurrency > 1 and
+                key.size > self.download_chunk_size):
+            parts, size = self._get_parts(key, offset, length)
+
+            class PartsIndexable(glance.store.Indexable):
+                def another(self):
+                    try:
+                        return self.wrapped.next()
+                    except StopIteration:
+                        return ''
+
+            return (PartsIndexable(parts, size), size)
+
+        size = key.size
+        range_header = glance.store.get_range_header(offset, length)
+        if range_header:
+            # NOTE: the key is read from the response opened here, boto
+            # leaves key.size as the size of the whole object
+            key.open_read(headers={'Range': range_header})
+            size = glance.store.get_range_size(key.size, offset, length)
+
         class ChunkedIndexable(glance.store.Indexable):
             def another(self):
                 return (self.wrapped.fp.read(ChunkedFile.CHUNKSIZE)
                         if self.wrapped.fp else None)
 
-        return (ChunkedIndexable(ChunkedFile(key), key.size), key.size)
+        return (ChunkedIndexable(ChunkedFile(key), size), size)
+
+    def _get_parts(self, key, offset=0, length=None):
+        """
+        Return an iterator over the data of key, fetched with up to
+        s3_store_download_concurrency ranged GETs of at most
+        s3_store_download_chunk_size at a time, and the size of the data
+        it yields.
+
+        Parts are yielded in order. A part that arrives early is kept
+        until the ones before it have been yielded, and no more parts are
+        requested until then, so at most download_concurrency parts are
+        held in memory.
+        """
+        size = glance.store.get_range_size(key.size, offset, length)
+        end = offset + size
+
+        parts = []
+        start = offset
+        while start < end:
+            part_length = min(self.download_chunk_size, end - start)
+            parts.append((start, part_length))
+            start += part_length
+
+        def get_part(part):
+            part_offset, part_length = part
+            headers = {'Range': glance.store.get_range_header(part_offset,
+                                                              part_length)}
+            # NOTE: new_key() builds a Key locally without a request, so
+            # each part is read through its own response
+            part_key = key.bucket.new_key(key.name)
+            return part_key.get_contents_as_string(headers=headers)
+
+        def iterator():
+            pending = collections.deque()
+            remaining = iter(parts)
+            try:
+                for part in itertools.islice(remaining,
+                                             self.download_concurrency):
+                    pending.append(eventlet.spawn(get_part, part))
+                while pending:
+                    data = pending.popleft().wait()
+                    yield data
+                    # NOTE: the next part is only requested once the data
+                    # yielded was consumed, so that it counts against
+                    # download_concurrency
+                    for part in itertools.islice(remaining, 1):
+                        pending.append(eventlet.spawn(get_part, part))
+            finally:
+                for thread in pending:
+                    thread.kill()
+
+        return iterator(), size
 
     def get_size(self, location):
         """
@@ -296,13 +490,7 @@ class Store(glance.store.base.Store):
 
     def _retrieve_key(self, location):
         loc = location.store_location
-        from boto.s3.connection import S3Connection
-
-        s3_conn = S3Connection(loc.accesskey, loc.secretkey,
-                               host=loc.s3serviceurl,
-                               is_secure=(loc.scheme == 's3+https'),
-                               calling_format=get_calling_format())
-        bucket_obj = get_bucket(s3_conn, loc.bucket)
+        bucket_obj = CONNECTION_CACHE.get_bucket(loc)
 
         key = get_key(bucket_obj, loc.key)
 
@@ -340,8 +528,6 @@ class Store(glance.store.base.Store):
             <BUCKET> = ``s3_store_bucket``
             <ID> = The id of the image being added
         """
-        from boto.s3.connection import S3Connection
-
         loc = StoreLocation({'scheme': self.scheme,
                              'bucket': self.bucket,
                              'key': image_id,
@@ -349,14 +535,7 @@ class Store(glance.store.base.Store):
                              'accesskey': self.access_key,
                              'secretkey': self.secret_key})
 
-        s3_conn = S3Connection(loc.accesskey, loc.secretkey,
-                               host=loc.s3serviceurl,
-                               is_secure=(loc.scheme == 's3+https'),
-                               calling_format=get_calling_format())
-
-        create_bucket_if_missing(self.bucket, s3_conn)
-
-        bucket_obj = get_bucket(s3_conn, self.bucket)
+        bucket_obj = CONNECTION_CACHE.get_bucket(loc, create=True)
         obj_name = str(image_id)
 
         def _sanitize(uri):
@@ -378,45 +557,106 @@ class Store(glance.store.base.Store):
                                          'obj_name': obj_name})
         LOG.debug(msg)
 
-        key = bucket_obj.new_key(obj_name)
+        if 0 < image_size < min(self.large_object_size,
+                                self.large_object_chunk_size):
+            size, digests = self._add_singlepart(bucket_obj, obj_name,
+                                                 image_file)
+        else:
+            size, digests = self._add_multipart(bucket_obj, obj_name,
+                                                image_file)
 
-        # We need to wrap image_file, which is a reference to the
-        # webob.Request.body_file, with a seekable file-like object,
-        # otherwise the call to set_contents_from_file() will die
-        # with an error about Input object has no method 'seek'. We
-        # might want to call webob.Request.make_body_seekable(), but
-        # unfortunately, that method copies the entire image into
-        # memory and results in LP Bug #818292 occurring. So, here
-        # we write temporary file in as memory-efficient manner as
-        # possible and then supply the temporary file to S3. We also
-        # take this opportunity to calculate the image checksum while
-        # writing the tempfile, so we don't need to call key.compute_md5()
-
-        msg = _("Writing request body file to temporary file "
-                "for %s") % _sanitize(loc.get_uri())
-        LOG.debug(msg)
+        checksum_hex = digests.hexdigest()
+        LOG.debug(_("Wrote %(size)d bytes to S3 key named %(obj_name)s "
+                    "with checksum %(checksum_hex)s") % locals())
 
-        tmpdir = self.s3_store_object_buffer_dir
-        temp_file = tempfile.NamedTemporaryFile(dir=tmpdir)
-        checksum = hashlib.md5()
-        for chunk in utils.chunkreadable(image_file, self.CHUNKSIZE):
-            checksum.update(chunk)
-            temp_file.write(chunk)
-        temp_file.flush()
+        return (loc.get_uri(), size, checksum_hex,
+                self.digests_metadata(digests))
 
-        msg = (_("Uploading temporary file to S3 for %s") %
-               _sanitize(loc.get_uri()))
-        LOG.debug(msg)
+    def _add_singlepart(self, bucket_obj, obj_name, image_file):
+        """
+        Upload an image smaller than both s3_store_large_object_size and
+        s3_store_large_object_chunk_size with a single PUT, returning its
+        size and digests.
+
+        boto needs a seekable file to send, so the image is read into a
+        buffer the size of a multipart upload part first, which bounds the
+        memory used like a multipart upload does. Its checksum is computed
+        on the way and handed to boto, so the data is only hashed once.
+        """
+        buf = bytearray(self.large_object_chunk_size)
+        size = utils.readinto(image_file, buf, self.CHUNKSIZE)
+        checksum = self.new_digests()
+        utils.update_checksum(checksum, buffer(buf, 0, size))
 
-        # OK, now upload the data into the key
-        key.set_contents_from_file(open(temp_file.name, 'r+b'), replace=False)
-        size = key.size
-        checksum_hex = checksum.hexdigest()
+        key = bucket_obj.new_key(obj_name)
+        md5 = (checksum.hexdigest(), base64.b64encode(checksum.digest()))
+        key.set_contents_from_file(utils.BufferReader(buf, size),
+                                   replace=False, md5=md5)
+        return size, checksum
 
-        LOG.debug(_("Wrote %(size)d bytes to S3 key named %(obj_name)s "
-                    "with checksum %(checksum_hex)s") % locals())
+    def _add_multipart(self, bucket_obj, obj_name, image_file):
+        """
+        Upload an image as an S3 multipart upload, returning its size and
+        digests.
+
+        The request body is read into parts of s3_store_large_object_chunk_size
+        in memory, which are sent s3_store_thread_pools at a time while the
+        next part is read. Since reading waits for a free thread, at most
+        s3_store_thread_pools + 1 parts are buffered. Part buffers are
+        reused for the later parts of the upload and freed once it ends.
+        """
+        mpu = bucket_obj.initiate_multipart_upload(obj_name)
+        pool = eventlet.GreenPool(self.thread_pools)
+        part_buffers = utils.BufferPool(self.large_object_chunk_size,
+                                        self.thread_pools + 1)
+        errors = []
 
-        return (loc.get_uri(), size, checksum_hex, {})
+        def upload_part(buf, length, part_num):
+            try:
+                mpu.upload_part_from_file(utils.BufferReader(buf, length),
+                                          part_num, size=length)
+                LOG.debug(_("Uploaded part %(part_num)d of length "
+                            "%(length)d of S3 key named %(obj_name)s") %
+                          {'part_num': part_num, 'length': length,
+                           'obj_name': obj_name})
+            except Exception as e:
+                LOG.exception(_("Failed to upload part %(part_num)d of S3 "
+                                "key named %(obj_name)s") %
+                              {'part_num': part_num, 'obj_name': obj_name})
+                errors.append(e)
+            finally:
+                part_buffers.put(buf)
+
+        checksum = self.new_digests()
+        size = 0
+        part_num = 0
+        try:
+            length = self.large_object_chunk_size
+            while length == self.large_object_chunk_size and not errors:
+                buf = part_buffers.get()
+                length = utils.readinto(image_file, buf, self.CHUNKSIZE)
+                if not length and part_num:
+                    part_buffers.put(buf)
+                    break
+                utils.update_checksum(checksum, buffer(buf, 0, length))
+                size += length
+                part_num += 1
+                pool.spawn_n(upload_part, buf, length, part_num)
+            pool.waitall()
+        except Exception:
+            pool.waitall()
+            mpu.cancel_upload()
+            raise
+
+        if errors:
+            mpu.cancel_upload()
+            msg = (_("Failed to upload image to S3 key named %(obj_name)s: "
+                     "%(error)s") % {'obj_name': obj_name,
+                                     'error': errors[0]})
+            raise glance.store.BackendException(msg)
+
+        mpu.complete_upload()
+        return size, checksum
 
     def delete(self, location):
         """
@@ -429,12 +669,7 @@ class Store(glance.store.base.Store):
         :raises NotFound if image does not exist
         """
         loc = location.store_location
-        from boto.s3.connection import S3Connection
-        s3_conn = S3Connection(loc.accesskey, loc.secretkey,
-                               host=loc.s3serviceurl,
-                               is_secure=(loc.scheme == 's3+https'),
-                               calling_format=get_calling_format())
-        bucket_obj = get_bucket(s3_conn, loc.bucket)
+        bucket_obj = CONNECTION_CACHE.get_bucket(loc)
 
         # Close the key when we're through.
         key = get_key(bucket_obj, loc.key)
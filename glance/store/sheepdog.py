@@ -17,13 +17,15 @@
 
 """Storage backend for Sheepdog storage system"""
 
-import hashlib
+import itertools
+import socket
+import struct
 
 from oslo.config import cfg
 
 from glance.common import exception
+from glance.common import utils
 import glance.openstack.common.log as logging
-from glance.openstack.common import processutils
 import glance.store
 import glance.store.base
 import glance.store.location
@@ -51,6 +53,190 @@ sheepdog_opts = [
 CONF = cfg.CONF
 CONF.register_opts(sheepdog_opts)
 
+# Sheepdog wire protocol, see include/sheepdog_proto.h in sheepdog
+SD_PROTO_VER = 0x01
+
+SD_OP_CREATE_AND_WRITE_OBJ = 0x01
+SD_OP_READ_OBJ = 0x02
+SD_OP_WRITE_OBJ = 0x03
+SD_OP_NEW_VDI = 0x11
+SD_OP_GET_VDI_INFO = 0x14
+SD_OP_DEL_VDI = 0x17
+
+SD_FLAG_CMD_WRITE = 0x01
+SD_FLAG_CMD_COW = 0x02
+
+SD_RES_SUCCESS = 0x00
+SD_RES_NO_OBJ = 0x02
+SD_RES_VDI_EXIST = 0x04
+SD_RES_NO_VDI = 0x08
+
+SD_MAX_VDI_LEN = 256
+SD_MAX_VDI_TAG_LEN = 256
+SD_DATA_OBJ_SIZE = 1 << 22
+VDI_SPACE_SHIFT = 32
+VDI_BIT = 1 << 63
+
+# Offsets of the fields of struct sd_inode read by the client
+SD_INODE_VDI_SIZE_OFFSET = 536
+SD_INODE_NR_COPIES_OFFSET = 554
+SD_INODE_HEADER_SIZE = 4664
+
+# All requests and responses start with a 48 byte header: the common
+# fields followed by 32 bytes that depend on the opcode
+SD_HEADER = struct.Struct('<BBHIII32s')
+SD_OBJ_REQ = struct.Struct('<QQIIQ')
+SD_VDI_REQ = struct.Struct('<QIBB2xI12x')
+SD_RSP = struct.Struct('<I28x')
+SD_VDI_RSP = struct.Struct('<III20x')
+
+# Idle sockets kept by a client for later requests; sockets handed back
+# beyond this, after a burst of concurrent requests, are closed
+MAX_IDLE_SOCKETS = 10
+
+
+class SheepdogError(glance.store.BackendException):
+    def __init__(self, result, msg):
+        self.result = result
+        super(SheepdogError, self).__init__(msg)
+
+
+def vdi_oid(vid):
+    """Return the object id of the inode of VDI vid"""
+    return VDI_BIT | (vid << VDI_SPACE_SHIFT)
+
+
+def data_oid(vid, idx):
+    """Return the object id of data object idx of VDI vid"""
+    return (vid << VDI_SPACE_SHIFT) | idx
+
+
+class SheepdogClient(object):
+    """
+    Minimal client for the Sheepdog wire protocol, keeping a pool of up
+    to MAX_IDLE_SOCKETS idle sockets to a sheep daemon. Requests are sent
+    one at a time per socket, so a socket is taken from the pool for each
+    request and handed back once its response has been read in full.
+    """
+
+    def __init__(self, addr, port):
+        self.addr = addr
+        self.port = int(port)
+        self.idle = []
+        self.ids = itertools.count(1)
+
+    def _connect(self):
+        try:
+            return self.idle.pop()
+        except IndexError:
+            pass
+        try:
+            return socket.create_connection((self.addr, self.port))
+        except socket.error as e:
+            msg = (_("Failed to connect to sheep daemon at "
+                     "%(addr)s:%(port)s: %(e)s") %
+                   {'addr': self.addr, 'port': self.port, 'e': e})
+            LOG.error(msg)
+            raise glance.store.BackendException(msg)
+
+    def _release(self, sock):
+        """Hand back a socket whose last response was read in full"""
+        if len(self.idle) < MAX_IDLE_SOCKETS:
+            self.idle.append(sock)
+        else:
+            sock.close()
+
+    @staticmethod
+    def _recv(sock, length):
+        chunks = []
+        while length > 0:
+            chunk = sock.recv(length)
+            if not chunk:
+                raise socket.error(_("Connection closed by sheep daemon"))
+            chunks.append(chunk)
+            length -= len(chunk)
+        return ''.join(chunks)
+
+    def request(self, opcode, body, data='', flags=0, read_length=0):
+        """
+        Send a request and return the fields of its response header that
+        depend on the opcode, and the data that came with it.
+
+        :param body: the packed opcode specific fields of the request
+        :param data: data to send with the request
+        :param read_length: the number of bytes of data to read back
+        """
+        if data:
+            flags |= SD_FLAG_CMD_WRITE
+        header = SD_HEADER.pack(SD_PROTO_VER, opcode, flags, 0,
+                                self.ids.next() & 0xffffffff,
+                                len(data) or read_length, body)
+        sock = self._connect()
+        try:
+            sock.sendall(header + data)
+            rsp = SD_HEADER.unpack(self._recv(sock, SD_HEADER.size))
+            rsp_data = self._recv(sock, rsp[5])
+        except socket.error as e:
+            sock.close()
+            msg = (_("Sheepdog request %(opcode)#x failed: %(e)s") %
+                   {'opcode': opcode, 'e': e})
+            LOG.error(msg)
+            raise glance.store.BackendException(msg)
+        self._release(sock)
+        return rsp[6], rsp_data
+
+    def _check(self, rsp, what):
+        result = SD_RSP.unpack(rsp)[0]
+        if result != SD_RES_SUCCESS:
+            raise SheepdogError(result, _("Sheepdog failed to %(what)s: "
+                                          "error %(result)#x") % locals())
+
+    def _vdi_request(self, opcode, name, size=0, with_tag=False):
+        data = name.ljust(SD_MAX_VDI_LEN, '\0')
+        if with_tag:
+            data += '\0' * SD_MAX_VDI_TAG_LEN
+        body = SD_VDI_REQ.pack(size, 0, 0, 0, 0)
+        rsp, _data = self.request(opcode, body, data)
+        self._check(rsp, _('access VDI %s') % name)
+        return SD_VDI_RSP.unpack(rsp)[2]
+
+    def create_vdi(self, name, size):
+        """Create VDI name of size bytes and return its id"""
+        return self._vdi_request(SD_OP_NEW_VDI, name, size)
+
+    def find_vdi(self, name):
+        """Return the id of VDI name"""
+        return self._vdi_request(SD_OP_GET_VDI_INFO, name, with_tag=True)
+
+    def delete_vdi(self, name):
+        self._vdi_request(SD_OP_DEL_VDI, name, with_tag=True)
+
+    def read_obj(self, oid, offset, length):
+        body = SD_OBJ_REQ.pack(oid, 0, 0, 0, offset)
+        rsp, data = self.request(SD_OP_READ_OBJ, body, read_length=length)
+        self._check(rsp, _('read object %x') % oid)
+        return data
+
+    def write_obj(self, oid, offset, data, copies=0, create=False,
+                  cow_oid=0):
+        opcode = SD_OP_CREATE_AND_WRITE_OBJ if create else SD_OP_WRITE_OBJ
+        flags = SD_FLAG_CMD_COW if cow_oid else 0
+        body = SD_OBJ_REQ.pack(oid, cow_oid, copies, 0, offset)
+        rsp, _data = self.request(opcode, body, data, flags=flags)
+        self._check(rsp, _('write object %x') % oid)
+
+
+_CLIENTS = {}
+
+
+def get_client(addr, port):
+    """Return the process-wide client for the sheep daemon at addr"""
+    key = (addr, int(port))
+    client = _CLIENTS.get(key)
+    if client is None:
+        client = _CLIENTS[key] = SheepdogClient(addr, port)
+    return client
+
 
 class SheepdogImage:
     """Class describing an image stored in Sheepdog storage."""
@@ -60,77 +246,113 @@ class SheepdogImage:
         self.port = port
         self.name = name
         self.chunk_size = chunk_size
+        self.client = get_client(addr, port)
+        self.vid = None
 
-    def _run_command(self, command, data, *params):
-        cmd = ("collie vdi %(command)s -a %(addr)s -p %(port)s %(name)s "
-               "%(params)s" %
-               {"command": command,
-                "addr": self.addr,
-                "port": self.port,
-                "name": self.name,
-                "params": " ".join(map(str, params))})
+    def _get_vid(self):
+        if self.vid is None:
+            self.vid = self.client.find_vdi(self.name)
+        return self.vid
 
-        try:
-            return processutils.execute(
-                cmd, process_input=data, shell=True)[0]
-        except processutils.ProcessExecutionError as exc:
-            LOG.error(exc)
-            raise glance.store.BackendException(exc)
+    def _read_inode(self, offset, length):
+        return self.client.read_obj(vdi_oid(self._get_vid()), offset, length)
+
+    def _get_data_vdi_ids(self, first, count):
+        """
+        Return the ids of the VDIs owning data objects first to
+        first + count, 0 for objects that were never written.
+        """
+        data = self._read_inode(SD_INODE_HEADER_SIZE + 4 * first, 4 * count)
+        return struct.unpack('<%dI' % count, data)
+
+    def _objects(self, offset, count):
+        """
+        Split count bytes from offset into (index, offset in object,
+        length) of the data objects they span.
+        """
+        end = offset + count
+        while offset < end:
+            idx, obj_offset = divmod(offset, SD_DATA_OBJ_SIZE)
+            length = min(SD_DATA_OBJ_SIZE - obj_offset, end - offset)
+            yield idx, obj_offset, length
+            offset += length
 
     def get_size(self):
         """
         Return the size of the this iamge
-
-        Sheepdog Usage: collie vdi list -r -a address -p port image
         """
-        out = self._run_command("list -r", None)
-        return long(out.split(' ')[3])
+        data = self._read_inode(SD_INODE_VDI_SIZE_OFFSET, 8)
+        return struct.unpack('<Q', data)[0]
 
     def read(self, offset, count):
         """
         Read up to 'count' bytes from this image starting at 'offset' and
         return the data.
-
-        Sheepdog Usage: collie vdi read -a address -p port image offset len
         """
-        return self._run_command("read", None, str(offset), str(count))
+        objects = list(self._objects(offset, count))
+        if not objects:
+            return ''
+        vids = self._get_data_vdi_ids(objects[0][0], len(objects))
+        data = []
+        for (idx, obj_offset, length), vid in zip(objects, vids):
+            if vid:
+                data.append(self.client.read_obj(data_oid(vid, idx),
+                                                 obj_offset, length))
+            else:
+                data.append('\0' * length)
+        return ''.join(data)
 
     def write(self, data, offset, count):
         """
         Write up to 'count' bytes from the data to this image starting at
         'offset'
-
-        Sheepdog Usage: collie vdi write -a address -p port image offset len
         """
-        self._run_command("write", data, str(offset), str(count))
+        objects = list(self._objects(offset, min(count, len(data))))
+        if not objects:
+            return
+        vid = self._get_vid()
+        copies = ord(self._read_inode(SD_INODE_NR_COPIES_OFFSET, 1))
+        vids = self._get_data_vdi_ids(objects[0][0], len(objects))
+        pos = 0
+        for (idx, obj_offset, length), owner in zip(objects, vids):
+            piece = data[pos:pos + length]
+            pos += length
+            if owner == vid:
+                self.client.write_obj(data_oid(vid, idx), obj_offset, piece,
+                                      copies)
+                continue
+            cow_oid = data_oid(owner, idx) if owner else 0
+            self.client.write_obj(data_oid(vid, idx), obj_offset, piece,
+                                  copies, create=True, cow_oid=cow_oid)
+            # record in the inode that this VDI now owns the object
+            self.client.write_obj(vdi_oid(vid),
+                                  SD_INODE_HEADER_SIZE + 4 * idx,
+                                  struct.pack('<I', vid), copies)
 
     def create(self, size):
         """
         Create this image in the Sheepdog cluster with size 'size'.
-
-        Sheepdog Usage: collie vdi create -a address -p port image size
         """
-        self._run_command("create", None, str(size))
+        self.vid = self.client.create_vdi(self.name, size)
 
     def delete(self):
         """
         Delete this image in the Sheepdog cluster
-
-        Sheepdog Usage: collie vdi delete -a address -p port image
         """
-        self._run_command("delete", None)
+        self.client.delete_vdi(self.name)
+        self.vid = None
 
     def exist(self):
         """
-        Check if this image exists in the Sheepdog cluster via 'list' command
-
-        Sheepdog Usage: collie vdi list -r -a address -p port image
+        Check if this image exists in the Sheepdog cluster
         """
-        out = self._run_command("list -r", None)
-        if not out:
-            return False
-        else:
-            return True
+        try:
+            self._get_vid()
+        except SheepdogError as e:
+            if e.result == SD_RES_NO_VDI:
+                return False
+            raise
+        return True
 
 
 class StoreLocation(glance.store.location.StoreLocation):
@@ -159,15 +381,18 @@ class ImageIterator(object):
     Reads data from an Sheepdog image, one chunk at a time.
     """
 
-    def __init__(self, image):
+    def __init__(self, image, offset=0, length=None):
         self.image = image
+        self.offset = offset
+        self.length = length
 
     def __iter__(self):
         image = self.image
-        total = left = image.get_size()
+        total = left = glance.store.get_range_size(image.get_size(),
+                                                   self.offset, self.length)
         while left > 0:
             length = min(image.chunk_size, left)
-            data = image.read(total - left, length)
+            data = image.read(self.offset + total - left, length)
             left -= len(data)
             yield data
         raise StopIteration()
@@ -178,6 +403,9 @@ class Store(glance.store.base.Store):
 
     EXAMPLE_URL = "sheepdog://image"
 
+    # Sheepdog VDIs are created with the size of the image data
+    accepts_unknown_size = False
+
     def get_schemes(self):
         return ('sheepdog',)
 
@@ -200,14 +428,14 @@ class Store(glance.store.base.Store):
                                                   reason=reason)
 
         try:
-            processutils.execute("collie", shell=True)
-        except processutils.ProcessExecutionError as exc:
-            reason = _("Error in store configuration: %s") % exc
+            int(self.port)
+        except ValueError:
+            reason = (_("Invalid sheepdog_store_port %s") % self.port)
             LOG.error(reason)
             raise exception.BadStoreConfiguration(store_name='sheepdog',
                                                   reason=reason)
 
-    def get(self, location):
+    def get(self, location, offset=0, length=None):
         """
         Takes a `glance.store.location.Location` object that indicates
         where to find the image file, and returns a generator for reading
@@ -215,6 +443,8 @@ class Store(glance.store.base.Store):
 
         :param location `glance.store.location.Location` object, supplied
                         from glance.store.location.get_location_from_uri()
+        :param offset: offset of the first byte to read
+        :param length: maximum number of bytes to read
         :raises `glance.exception.NotFound` if image does not exist
         """
 
@@ -224,7 +454,8 @@ class Store(glance.store.base.Store):
         if not image.exist():
             raise exception.NotFound(_("Sheepdog image %s does not exist")
                                      % image.name)
-        return (ImageIterator(image), image.get_size())
+        size = glance.store.get_range_size(image.get_size(), offset, length)
+        return (ImageIterator(image, offset, length), size)
 
     def get_size(self, location):
         """
@@ -267,7 +498,7 @@ class Store(glance.store.base.Store):
                                       % image_id)
 
         location = StoreLocation({'image': image_id})
-        checksum = hashlib.md5()
+        checksum = self.new_digests()
 
         image.create(image_size)
 
@@ -277,9 +508,10 @@ class Store(glance.store.base.Store):
             data = image_file.read(length)
             image.write(data, total - left, length)
             left -= length
-            checksum.update(data)
+            utils.update_checksum(checksum, data)
 
-        return (location.get_uri(), image_size, checksum.hexdigest(), {})
+        return (location.get_uri(), image_size, checksum.hexdigest(),
+                self.digests_metadata(checksum))
 
     def delete(self, location):
         """
@@ -19,16 +19,22 @@
 
 from __future__ import absolute_import
 
+import collections
+import contextlib
 import hashlib
 import httplib
+import itertools
 import math
+import tempfile
 import urllib
 import urlparse
 
+import eventlet
 from oslo.config import cfg
 
 from glance.common import auth
 from glance.common import exception
+from glance.common import utils
 import glance.openstack.common.log as logging
 import glance.store
 import glance.store.base
@@ -102,12 +108,80 @@ swift_opts = [
                 help=_('A list of tenants that will be granted read/write '
                        'access on all Swift containers created by Glance in '
                        'multi-tenant mode.')),
+    cfg.IntOpt('swift_store_upload_concurrency', default=1,
+               help=_('The number of segments of a large object that are '
+                      'uploaded to Swift at the same time. Each segment is '
+                      'buffered in a temporary file while it is sent.')),
+    cfg.StrOpt('swift_store_upload_buffer_dir',
+               help=_('Directory in which segments are buffered when '
+                      'swift_store_upload_concurrency is greater than 1. '
+                      'Defaults to the system temporary directory.')),
+    cfg.BoolOpt('swift_store_resumable_uploads', default=False,
+                help=_('If True, the chunks of a large object are kept in '
+                       'Swift when its upload fails, and chunks already in '
+                       'Swift with the same content are not sent again when '
+                       'the upload of the image is retried.')),
+    cfg.IntOpt('swift_store_resumable_upload_expiry', default=86400,
+               help=_('The number of seconds after which Swift deletes the '
+                      'chunks of a large object upload that did not '
+                      'complete, when swift_store_resumable_uploads is '
+                      'True. 0 keeps them until the image is deleted.')),
+    cfg.IntOpt('swift_store_download_concurrency', default=1,
+               help=_('The number of ranged GETs used at the same time to '
+                      'download the segments of a large object. 1 reads '
+                      'the whole object through a single GET.')),
+    cfg.IntOpt('swift_store_download_chunk_size', default=16,
+               help=_('The size, in MB, of the ranged GETs used when '
+                      'swift_store_download_concurrency is greater than 1. '
+                      'Up to swift_store_download_concurrency of these are '
+                      'held in memory for each download.')),
+    cfg.IntOpt('swift_store_connection_pool_size', default=10,
+               help=_('The maximum number of idle authenticated Swift '
+                      'connections kept for reuse for each set of '
+                      'credentials in single-tenant mode. 0 disables '
+                      'connection reuse.')),
 ]
 
 CONF = cfg.CONF
 CONF.register_opts(swift_opts)
 
 
+class ConnectionPool(object):
+
+    """
+    Process-wide pool of idle Swift connections, keyed by the credentials
+    and options they were created with. A swiftclient connection keeps its
+    auth token and HTTP connection between requests and re-authenticates
+    when the token expires, so reusing one saves an auth round-trip and a
+    TCP/TLS handshake per operation.
+    """
+
+    def __init__(self):
+        self.connections = {}
+
+    def get(self, key, create):
+        """
+        Return an idle connection for key, or a new one from create()
+        if there is none.
+        """
+        try:
+            return self.connections.get(key, []).pop()
+        except IndexError:
+            return create()
+
+    def put(self, key, connection):
+        """Hand back a connection that is no longer in use"""
+        idle = self.connections.setdefault(key, [])
+        if len(idle) < CONF.swift_store_connection_pool_size:
+            idle.append(connection)
+
+    def clear(self):
+        self.connections.clear()
+
+
+CONNECTION_POOL = ConnectionPool()
+
+
 class StoreLocation(glance.store.location.StoreLocation):
 
     """
@@ -243,11 +317,21 @@ class StoreLocation(glance.store.location.StoreLocation):
             return ''.join([auth_scheme, self.auth_or_store_url])
 
 
-def Store(context=None, loc=None):
-    if (CONF.swift_store_multi_tenant and
-            (loc is None or loc.store_location.user is None)):
-        return MultiTenantStore(context, loc)
-    return SingleTenantStore(context, loc)
+class Store(object):
+    """
+    Builds the store for a location: a MultiTenantStore in multi-tenant
+    mode, unless the location names a user, a SingleTenantStore otherwise.
+    """
+
+    def __new__(cls, context=None, loc=None):
+        return cls.get_store_class(loc)(context, loc)
+
+    @staticmethod
+    def get_store_class(loc=None):
+        if (CONF.swift_store_multi_tenant and
+                (loc is None or loc.store_location.user is None)):
+            return MultiTenantStore
+        return SingleTenantStore
 
 
 class BaseStore(glance.store.base.Store):
@@ -261,6 +345,12 @@ class BaseStore(glance.store.base.Store):
         self.large_object_size = _obj_size * ONE_MB
         _chunk_size = self._option_get('swift_store_large_object_chunk_size')
         self.large_object_chunk_size = _chunk_size * ONE_MB
+        self.upload_concurrency = CONF.swift_store_upload_concurrency
+        self.resumable_uploads = CONF.swift_store_resumable_uploads
+        self.resumable_upload_expiry = CONF.swift_store_resumable_upload_expiry
+        self.download_concurrency = CONF.swift_store_download_concurrency
+        _chunk_size = self._option_get('swift_store_download_chunk_size')
+        self.download_chunk_size = _chunk_size * ONE_MB
         self.admin_tenants = CONF.swift_store_admin_tenants
         self.region = CONF.swift_store_region
         self.service_type = CONF.swift_store_service_type
@@ -268,15 +358,89 @@ class BaseStore(glance.store.base.Store):
         self.snet = CONF.swift_enable_snet
         self.insecure = CONF.swift_store_auth_insecure
 
-    def get(self, location, connection=None):
+    @contextlib.contextmanager
+    def _connection(self, location, connection=None):
+        """
+        Yield connection, or one from get_connection() if it is None. A
+        connection obtained here is handed back with release_connection()
+        unless the operation fails, in which case it is dropped as its
+        state is unknown.
+        """
+        if connection:
+            yield connection
+            return
+
+        connection = self.get_connection(location)
+        yield connection
+        self.release_connection(location, connection)
+
+    def get(self, location, connection=None, offset=0, length=None):
         location = location.store_location
+        pooled = not connection
         if not connection:
             connection = self.get_connection(location)
 
+        resp_headers, resp_body = self._get_object(location, connection,
+                                                   offset, length)
+        manifest = resp_headers.get('x-object-manifest')
+
+        release = None
+        if self.download_concurrency > 1 and manifest:
+            # The body of the manifest is not read, so the HTTP connection
+            # it arrives on is closed. The connection reopens it, keeping
+            # its auth token, for the next request.
+            connection.close()
+            segments = self._get_manifest_segments(connection, manifest)
+            if pooled:
+                self.release_connection(location, connection)
+            resp_body, size = self._get_segments(location, segments,
+                                                 offset, length)
+        else:
+            size = int(resp_headers.get('content-length', 0))
+            if pooled:
+                release = lambda: self.release_connection(location,
+                                                          connection)
+
+        class ResponseIndexable(glance.store.Indexable):
+            """
+            Hands the connection the body is read from back once it has
+            been read in full.
+            """
+            def __iter__(self):
+                for chunk in super(ResponseIndexable, self).__iter__():
+                    yield chunk
+                self.release()
+
+            def another(self):
+                try:
+                    return self.wrapped.next()
+                except StopIteration:
+                    self.release()
+                    return ''
+
+            def release(self):
+                if self.release_func is not None:
+                    self.release_func()
+                    self.release_func = None
+
+        resp_body = ResponseIndexable(resp_body, size)
+        resp_body.release_func = release
+        return (resp_body, size)
+
+    def _get_object(self, location, connection, offset, length):
+        """
+        Return the headers of the object at location and an iterator over
+        its body, read through a single GET.
+        """
+        kwargs = {}
+        range_header = glance.store.get_range_header(offset, length)
+        if range_header:
+            kwargs['headers'] = {'Range': range_header}
+
         try:
             resp_headers, resp_body = connection.get_object(
                     container=location.container, obj=location.obj,
-                    resp_chunk_size=self.CHUNKSIZE)
+                    resp_chunk_size=self.CHUNKSIZE, **kwargs)
         except swiftclient.ClientException as e:
             if e.http_status == httplib.NOT_FOUND:
                 msg = _("Swift could not find image at URI.")
@@ -284,23 +448,81 @@ class BaseStore(glance.store.base.Store):
             else:
                 raise
 
-        class ResponseIndexable(glance.store.Indexable):
-            def another(self):
-                try:
-                    return self.wrapped.next()
-                except StopIteration:
-                    return ''
+        return resp_headers, resp_body
 
-        length = int(resp_headers.get('content-length', 0))
-        return (ResponseIndexable(resp_body, length), length)
+    def _get_manifest_segments(self, connection, manifest):
+        """
+        Return the container and a list of (name, size) tuples of the
+        segments of a large object, in order, given its manifest header.
+        """
+        obj_container, obj_prefix = manifest.split('/', 1)
+        listing = connection.get_container(obj_container, prefix=obj_prefix,
+                                           full_listing=True)[1]
+        return obj_container, [(segment['name'], int(segment['bytes']))
+                               for segment in listing]
+
+    def _get_segments(self, location, segments, offset=0, length=None):
+        """
+        Return an iterator over the segments of a large object, fetched
+        with up to swift_store_download_concurrency ranged GETs of at most
+        swift_store_download_chunk_size at a time, and the size of the
+        data it yields.
+
+        Pieces are yielded in order. A piece that arrives early is kept
+        until the ones before it have been yielded, and the next piece is
+        only requested once one has been yielded, so at most
+        download_concurrency pieces are held in memory.
+        """
+        obj_container, segments = segments
+        total_size = sum(size for name, size in segments)
+        size = glance.store.get_range_size(total_size, offset, length)
+        end = offset + size
+
+        pieces = []
+        segment_start = 0
+        for name, segment_size in segments:
+            start = max(offset, segment_start) - segment_start
+            stop = min(end, segment_start + segment_size) - segment_start
+            while start < stop:
+                piece_length = min(self.download_chunk_size, stop - start)
+                pieces.append((name, start, piece_length))
+                start += piece_length
+            segment_start += segment_size
+
+        def get_piece(piece):
+            name, piece_offset, piece_length = piece
+            headers = {'Range': glance.store.get_range_header(piece_offset,
+                                                              piece_length)}
+            with self._connection(location) as connection:
+                return connection.get_object(obj_container, name,
+                                             headers=headers)[1]
+
+        def iterator():
+            pending = collections.deque()
+            remaining = iter(pieces)
+            try:
+                for piece in itertools.islice(remaining,
+                                              self.download_concurrency):
+                    pending.append(eventlet.spawn(get_piece, piece))
+                while pending:
+                    yield pending.popleft().wait()
+                    # NOTE: the next piece is requested only after the
+                    # consumer is done with the last one, which it may
+                    # still hold while the generator is suspended.
+                    for piece in itertools.islice(remaining, 1):
+                        pending.append(eventlet.spawn(get_piece, piece))
+            finally:
+                for thread in pending:
+                    thread.kill()
+
+        return iterator(), size
 
     def get_size(self, location, connection=None):
         location = location.store_location
-        if not connection:
-            connection = self.get_connection(location)
         try:
-            resp_headers = connection.head_object(
-                    container=location.container, obj=location.obj)
+            with self._connection(location, connection) as connection:
+                resp_headers = connection.head_object(
+                        container=location.container, obj=location.obj)
             return int(resp_headers.get('content-length', 0))
         except Exception:
             return 0
@@ -316,6 +538,32 @@ class BaseStore(glance.store.base.Store):
         return result
 
     def _delete_stale_chunks(self, connection, container, chunk_list):
+        if self.resumable_uploads:
+            LOG.info(_("Keeping %d chunks in Swift so that the upload can "
+                       "be resumed") % len(chunk_list))
+            return
+        self._delete_chunks(connection, container, chunk_list)
+
+    def _chunk_headers(self):
+        """
+        Return the headers to PUT chunks with. The chunks of a resumable
+        upload expire until the upload completes, so that those of an
+        upload that is never retried do not stay in Swift forever.
+        """
+        if self.resumable_uploads and self.resumable_upload_expiry > 0:
+            return {'X-Delete-After': str(self.resumable_upload_expiry)}
+        return None
+
+    def _keep_chunks(self, location, connection):
+        """Remove the expiry of the chunks of a completed upload"""
+        prefix = "%s-" % location.obj
+        listing = connection.get_container(location.container, prefix=prefix,
+                                           full_listing=True)[1]
+        for chunk in listing:
+            connection.post_object(location.container, chunk['name'],
+                                   headers={'X-Remove-Delete-At': '1'})
+
+    def _delete_chunks(self, connection, container, chunk_list):
         for chunk in chunk_list:
             LOG.debug(_("Deleting chunk %s") % chunk)
             try:
@@ -326,9 +574,12 @@ class BaseStore(glance.store.base.Store):
 
     def add(self, image_id, image_file, image_size, connection=None):
         location = self.create_location(image_id)
-        if not connection:
-            connection = self.get_connection(location)
+        with self._connection(location, connection) as connection:
+            with self.read_ahead(image_file, self.CHUNKSIZE) as image_file:
+                return self._add(location, image_file, image_size,
+                                 connection)
 
+    def _add(self, location, image_file, image_size, connection):
         self._create_container_if_missing(location.container, connection)
 
         LOG.debug(_("Adding image object '%(obj_name)s' "
@@ -336,13 +587,16 @@ class BaseStore(glance.store.base.Store):
         try:
             if image_size > 0 and image_size < self.large_object_size:
                 # Image size is known, and is less than large_object_size.
-                # Send to Swift with regular PUT.
+                # Send to Swift with regular PUT. Swift verifies the data
+                # it stored against the ETag it returns, so that is used
+                # as the checksum and only other digests are computed.
+                digests = self.new_digests(backend_md5=True)
+                reader = ChunkReader(image_file, digests, image_size)
                 obj_etag = connection.put_object(location.container,
-                                                 location.obj, image_file,
+                                                 location.obj, reader,
                                                  content_length=image_size)
             else:
                 # Write the image into Swift in chunks.
-                chunk_id = 1
                 if image_size > 0:
                     total_chunks = str(int(
                         math.ceil(float(image_size) /
@@ -355,54 +609,25 @@ class BaseStore(glance.store.base.Store):
                                 "segmented object to Swift."))
                     total_chunks = '?'
 
-                checksum = hashlib.md5()
-                written_chunks = []
-                combined_chunks_size = 0
-                while True:
-                    chunk_size = self.large_object_chunk_size
-                    if image_size == 0:
-                        content_length = None
-                    else:
-                        left = image_size - combined_chunks_size
-                        if left == 0:
-                            break
-                        if chunk_size > left:
-                            chunk_size = left
-                        content_length = chunk_size
-
-                    chunk_name = "%s-%05d" % (location.obj, chunk_id)
-                    reader = ChunkReader(image_file, checksum, chunk_size)
-                    try:
-                        chunk_etag = connection.put_object(
-                            location.container, chunk_name, reader,
-                            content_length=content_length)
-                        written_chunks.append(chunk_name)
-                    except Exception:
-                        # Delete orphaned segments from swift backend
-                        LOG.exception(_("Error during chunked upload to "
-                                        "backend, deleting stale chunks"))
-                        self._delete_stale_chunks(connection,
-                                                  location.container,
-                                                  written_chunks)
-                        raise
-
-                    bytes_read = reader.bytes_read
-                    msg = _("Wrote chunk %(chunk_name)s (%(chunk_id)d/"
-                            "%(total_chunks)s) of length %(bytes_read)d "
-                            "to Swift returning MD5 of content: "
-                            "%(chunk_etag)s")
-                    LOG.debug(msg % locals())
-
-                    if bytes_read == 0:
-                        # Delete the last chunk, because it's of zero size.
-                        # This will happen if size == 0.
-                        LOG.debug(_("Deleting final zero-length chunk"))
-                        connection.delete_object(location.container,
-                                                 chunk_name)
-                        break
-
-                    chunk_id += 1
-                    combined_chunks_size += bytes_read
+                digests = self.new_digests()
+                resumable_chunks = self._get_resumable_chunks(location,
+                                                              connection)
+                if self.upload_concurrency > 1:
+                    combined_chunks_size = self._add_chunks_concurrently(
+                            location, image_file, image_size, digests,
+                            total_chunks, resumable_chunks)
+                else:
+                    combined_chunks_size = self._add_chunks(
+                            location, image_file, image_size, digests,
+                            total_chunks, connection, resumable_chunks)
+
+                if resumable_chunks:
+                    # Chunks of an earlier upload beyond the end of this
+                    # one would otherwise become part of the object.
+                    self._delete_chunks(connection, location.container,
+                                        sorted(resumable_chunks))
+                if self._chunk_headers():
+                    self._keep_chunks(location, connection)
 
                 # In the case we have been given an unknown image size,
                 # set the size to the total size of the combined chunks.
@@ -422,7 +647,7 @@ class BaseStore(glance.store.base.Store):
                 # users can verify the image file contents accordingly
                 connection.put_object(location.container, location.obj,
                                       None, headers=headers)
-                obj_etag = checksum.hexdigest()
+                obj_etag = digests.hexdigest()
 
             # NOTE: We return the user and key here! Have to because
             # location is used by the API server to return the actual
@@ -430,7 +655,8 @@ class BaseStore(glance.store.base.Store):
             # the location attribute from GET /images/<ID> and
             # GET /images/details
 
-            return (location.get_uri(), image_size, obj_etag, {})
+            return (location.get_uri(), image_size, obj_etag,
+                    self.digests_metadata(digests))
         except swiftclient.ClientException as e:
             if e.http_status == httplib.CONFLICT:
                 raise exception.Duplicate(_("Swift already has an image at "
@@ -440,16 +666,228 @@ class BaseStore(glance.store.base.Store):
             LOG.error(msg)
             raise glance.store.BackendException(msg)
 
+    def _get_resumable_chunks(self, location, connection):
+        """
+        Return a dict mapping the names of the chunks left in Swift by an
+        earlier upload of the image at location to their (etag, size), if
+        resumable uploads are enabled.
+        """
+        if not self.resumable_uploads:
+            return {}
+        prefix = "%s-" % location.obj
+        listing = connection.get_container(location.container, prefix=prefix,
+                                           full_listing=True)[1]
+        chunks = dict((chunk['name'], (chunk['hash'], int(chunk['bytes'])))
+                      for chunk in listing)
+        if chunks:
+            LOG.debug(_("Found %(count)d chunks of an earlier upload of "
+                        "%(obj)s") % {'count': len(chunks),
+                                      'obj': location.obj})
+        return chunks
+
+    def _buffer_chunk(self, reader, verify=True):
+        """
+        Read a chunk into a temporary file, returning the file positioned at
+        its start and, if verify is True, the MD5 of its contents.
+        """
+        chunk_file = tempfile.TemporaryFile(
+                dir=CONF.swift_store_upload_buffer_dir)
+        chunk_checksum = hashlib.md5() if verify else None
+        try:
+            for buf in utils.chunkreadable(reader, self.CHUNKSIZE):
+                if chunk_checksum:
+                    utils.update_checksum(chunk_checksum, buf)
+                chunk_file.write(buf)
+        except Exception:
+            chunk_file.close()
+            raise
+        chunk_file.seek(0)
+        return chunk_file, chunk_checksum and chunk_checksum.hexdigest()
+
+    def _add_chunks(self, location, image_file, image_size, checksum,
+                    total_chunks, connection, resumable_chunks):
+        """
+        Write the image into Swift as a sequence of segments, one after
+        the other, and return the number of bytes written.
+
+        A chunk whose name is in resumable_chunks is buffered first, and
+        only sent if its etag or size differ from the chunk in Swift.
+        Matching entries are removed from resumable_chunks.
+        """
+        chunk_id = 1
+        written_chunks = []
+        combined_chunks_size = 0
+        while True:
+            chunk_size = self.large_object_chunk_size
+            if image_size == 0:
+                content_length = None
+            else:
+                left = image_size - combined_chunks_size
+                if left == 0:
+                    break
+                if chunk_size > left:
+                    chunk_size = left
+                content_length = chunk_size
+
+            chunk_name = "%s-%05d" % (location.obj, chunk_id)
+            reader = ChunkReader(image_file, checksum, chunk_size)
+            try:
+                if chunk_name in resumable_chunks:
+                    chunk_file, chunk_etag = self._buffer_chunk(reader)
+                    try:
+                        if (resumable_chunks.pop(chunk_name) !=
+                                (chunk_etag, reader.bytes_read)):
+                            chunk_etag = connection.put_object(
+                                location.container, chunk_name, chunk_file,
+                                content_length=reader.bytes_read,
+                                headers=self._chunk_headers())
+                        else:
+                            LOG.debug(_("Chunk %s is already in Swift")
+                                      % chunk_name)
+                    finally:
+                        chunk_file.close()
+                else:
+                    chunk_etag = connection.put_object(
+                        location.container, chunk_name, reader,
+                        content_length=content_length,
+                        headers=self._chunk_headers())
+                written_chunks.append(chunk_name)
+            except Exception:
+                # Delete orphaned segments from swift backend
+                LOG.exception(_("Error during chunked upload to "
+                                "backend, deleting stale chunks"))
+                self._delete_stale_chunks(connection,
+                                          location.container,
+                                          written_chunks)
+                raise
+
+            bytes_read = reader.bytes_read
+            msg = _("Wrote chunk %(chunk_name)s (%(chunk_id)d/"
+                    "%(total_chunks)s) of length %(bytes_read)d "
+                    "to Swift returning MD5 of content: "
+                    "%(chunk_etag)s")
+            LOG.debug(msg % locals())
+
+            if bytes_read == 0:
+                # Delete the last chunk, because it's of zero size.
+                # This will happen if size == 0.
+                LOG.debug(_("Deleting final zero-length chunk"))
+                connection.delete_object(location.container,
+                                         chunk_name)
+                break
+
+            chunk_id += 1
+            combined_chunks_size += bytes_read
+
+        return combined_chunks_size
+
+    def _add_chunks_concurrently(self, location, image_file, image_size,
+                                 checksum, total_chunks, resumable_chunks):
+        """
+        Write the image into Swift as a sequence of segments, PUTting up to
+        swift_store_upload_concurrency segments at a time, and return the
+        number of bytes written.
+
+        Each segment is read from image_file into a temporary file, then
+        sent on a connection of its own while the next one is read, so at
+        most swift_store_upload_concurrency + 1 segments are buffered.
+        Chunks in resumable_chunks are skipped as in _add_chunks.
+        """
+        pool = eventlet.GreenPool(self.upload_concurrency)
+        written_chunks = []
+        errors = []
+
+        def put_chunk(chunk_name, chunk_id, chunk_file, bytes_read):
+            try:
+                with self._connection(location) as connection:
+                    chunk_etag = connection.put_object(
+                        location.container, chunk_name, chunk_file,
+                        content_length=bytes_read,
+                        headers=self._chunk_headers())
+                written_chunks.append(chunk_name)
+                msg = _("Wrote chunk %(chunk_name)s (%(chunk_id)d/"
+                        "%(total_chunks)s) of length %(bytes_read)d "
+                        "to Swift returning MD5 of content: "
+                        "%(chunk_etag)s")
+                LOG.debug(msg % {'chunk_name': chunk_name,
+                                 'chunk_id': chunk_id,
+                                 'total_chunks': total_chunks,
+                                 'bytes_read': bytes_read,
+                                 'chunk_etag': chunk_etag})
+            except Exception as e:
+                LOG.exception(_("Error writing chunk %s to Swift")
+                              % chunk_name)
+                errors.append(e)
+            finally:
+                chunk_file.close()
+
+        def delete_stale_chunks():
+            # Delete orphaned segments from swift backend
+            with self._connection(location) as connection:
+                self._delete_stale_chunks(connection, location.container,
+                                          written_chunks)
+
+        chunk_id = 1
+        combined_chunks_size = 0
+        try:
+            while not errors:
+                chunk_size = self.large_object_chunk_size
+                if image_size != 0:
+                    left = image_size - combined_chunks_size
+                    if left == 0:
+                        break
+                    if chunk_size > left:
+                        chunk_size = left
+
+                chunk_name = "%s-%05d" % (location.obj, chunk_id)
+                reader = ChunkReader(image_file, checksum, chunk_size)
+                chunk_file, chunk_etag = self._buffer_chunk(
+                        reader, verify=chunk_name in resumable_chunks)
+
+                bytes_read = reader.bytes_read
+                if bytes_read == 0:
+                    # This will happen if size == 0.
+                    chunk_file.close()
+                    break
+
+                if (chunk_name in resumable_chunks and
+                        resumable_chunks.pop(chunk_name) ==
+                        (chunk_etag, bytes_read)):
+                    LOG.debug(_("Chunk %s is already in Swift") % chunk_name)
+                    chunk_file.close()
+                    written_chunks.append(chunk_name)
+                else:
+                    pool.spawn_n(put_chunk, chunk_name, chunk_id, chunk_file,
+                                 bytes_read)
+                chunk_id += 1
+                combined_chunks_size += bytes_read
+            pool.waitall()
+        except Exception:
+            pool.waitall()
+            LOG.exception(_("Error during chunked upload to backend, "
+                            "deleting stale chunks"))
+            delete_stale_chunks()
+            raise
+
+        if errors:
+            LOG.error(_("Error during chunked upload to backend, "
+                        "deleting stale chunks"))
+            delete_stale_chunks()
+            raise errors[0]
+        return combined_chunks_size
+
     def delete(self, location, connection=None):
         location = location.store_location
-        if not connection:
-            connection = self.get_connection(location)
+        with self._connection(location, connection) as connection:
+            self._delete(location, connection)
 
+    def _delete(self, location, connection):
         try:
             # We request the manifest for the object. If one exists,
             # that means the object was uploaded in chunks/segments,
             # and we need to delete all the chunks as well as the
-            # manifest.
+            # manifest. Without one, the chunks of an upload that did
+            # not complete may still be left.
             manifest = None
             try:
                 headers = connection.head_object(
@@ -459,20 +897,28 @@ class BaseStore(glance.store.base.Store):
                 if e.http_status != httplib.NOT_FOUND:
                     raise
             if manifest:
-                # Delete all the chunks before the object manifest itself
                 obj_container, obj_prefix = manifest.split('/', 1)
-                segments = connection.get_container(
-                        obj_container, prefix=obj_prefix)[1]
-                for segment in segments:
-                    # TODO(jaypipes): This would be an easy area to parallelize
-                    # since we're simply sending off parallelizable requests
-                    # to Swift to delete stuff. It's not like we're going to
-                    # be hogging up network or file I/O here...
-                    connection.delete_object(obj_container,
-                                             segment['name'])
+            else:
+                obj_container = location.container
+                obj_prefix = "%s-" % location.obj
+
+            # Delete all the chunks before the object manifest itself
+            segments = connection.get_container(
+                    obj_container, prefix=obj_prefix)[1]
+            for segment in segments:
+                # TODO(jaypipes): This would be an easy area to parallelize
+                # since we're simply sending off parallelizable requests
+                # to Swift to delete stuff. It's not like we're going to
+                # be hogging up network or file I/O here...
+                connection.delete_object(obj_container,
+                                         segment['name'])
 
             # Delete object (or, in segmented case, the manifest)
-            connection.delete_object(location.container, location.obj)
+            try:
+                connection.delete_object(location.container, location.obj)
+            except swiftclient.ClientException as e:
+                if e.http_status != httplib.NOT_FOUND or not segments:
+                    raise
 
         except swiftclient.ClientException as e:
             if e.http_status == httplib.NOT_FOUND:
@@ -513,6 +959,13 @@ class BaseStore(glance.store.base.Store):
     def get_connection(self):
         raise NotImplemented()
 
+    def release_connection(self, location, connection):
+        """
+        Called with a connection from get_connection() once it is no
+        longer in use.
+        """
+        pass
+
     def create_location(self):
         raise NotImplemented()
 
@@ -544,6 +997,31 @@ class SingleTenantStore(BaseStore):
         return StoreLocation(specs)
 
     def get_connection(self, location):
+        args, kwargs = self._get_connection_args(location)
+        if CONF.swift_store_connection_pool_size <= 0:
+            return swiftclient.Connection(*args, **kwargs)
+        return CONNECTION_POOL.get(
+                self._get_connection_key(args, kwargs),
+                lambda: swiftclient.Connection(*args, **kwargs))
+
+    def release_connection(self, location, connection):
+        if CONF.swift_store_connection_pool_size <= 0:
+            return
+        args, kwargs = self._get_connection_args(location)
+        CONNECTION_POOL.put(self._get_connection_key(args, kwargs),
+                            connection)
+
+    @staticmethod
+    def _get_connection_key(args, kwargs):
+        options = dict(kwargs, os_options=tuple(
+                sorted(kwargs['os_options'].items())))
+        return args + tuple(sorted(options.items()))
+
+    def _get_connection_args(self, location):
+        """
+        Return the positional and keyword arguments of the
+        swiftclient.Connection for location.
+        """
         if not location.user:
             reason = (_("Location is missing user:password information."))
             LOG.debug(reason)
@@ -571,14 +1049,15 @@ class SingleTenantStore(BaseStore):
         os_options['endpoint_type'] = self.endpoint_type
         os_options['service_type'] = self.service_type
 
-        return swiftclient.Connection(
-                auth_url, user, location.key, insecure=self.insecure,
-                tenant_name=tenant_name, snet=self.snet,
-                auth_version=self.auth_version, os_options=os_options)
+        return ((auth_url, user, location.key),
+                {'insecure': self.insecure, 'tenant_name': tenant_name,
+                 'snet': self.snet, 'auth_version': self.auth_version,
+                 'os_options': os_options})
 
 
 class MultiTenantStore(BaseStore):
     EXAMPLE_URL = "swift://<SWIFT_URL>/<CONTAINER>/<FILE>"
+    configure_per_context = True
 
     def configure_add(self):
         self.container = CONF.swift_store_container
@@ -670,5 +1149,5 @@ class ChunkReader(object):
             i = left
         result = self.fd.read(i)
         self.bytes_read += len(result)
-        self.checksum.update(result)
+        utils.update_checksum(self.checksum, result)
         return result
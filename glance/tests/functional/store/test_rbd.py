@@ -101,6 +101,7 @@ class TestRBDStore(store_tests.BaseTestCase, testtools.TestCase):
         super(TestRBDStore, self).setUp()
 
     def tearDown(self):
+        glance.store.rbd.CLUSTERS.clear()
         self.rados_client.delete_pool(self.rbd_config['rbd_store_pool'])
         self.rados_client.shutdown()
 
@@ -25,7 +25,6 @@ import stubout
 
 from glance import store
 from glance.store import location
-from glance.store import sheepdog
 from glance.tests import stubs
 from glance.tests import utils as test_utils
 
@@ -45,10 +44,7 @@ class StoreClearingUnitTest(test_utils.BaseTestCase):
         self.addCleanup(setattr, location, 'SCHEME_TO_CLS_MAP', dict())
 
     def _create_stores(self):
-        """Create known stores. Mock out sheepdog's subprocess dependency
-        on collie.
-        """
-        self.stubs.Set(sheepdog.Store, 'configure_add', lambda x: None)
+        """Create known stores."""
         store.create_stores()
 
 
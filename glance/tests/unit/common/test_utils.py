@@ -15,6 +15,7 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import hashlib
 import os
 import StringIO
 import tempfile
@@ -217,3 +218,106 @@ class TestUtils(test_utils.BaseTestCase):
                 self.assertRaises(RuntimeError,
                                   utils.validate_key_cert,
                                   keyf.name, keyf.name)
+
+    def test_lru_cache_evicts_least_recently_used(self):
+        cache = utils.LRUCache(2)
+        cache['a'] = 1
+        cache['b'] = 2
+        self.assertEqual(1, cache.get('a'))
+        cache['c'] = 3
+        self.assertEqual(2, len(cache))
+        self.assertTrue('a' in cache)
+        self.assertFalse('b' in cache)
+        self.assertEqual(None, cache.get('b'))
+        self.assertEqual(3, cache.get('c'))
+
+    def test_lru_cache_set_existing_key_refreshes_it(self):
+        cache = utils.LRUCache(2)
+        cache['a'] = 1
+        cache['b'] = 2
+        cache['a'] = 10
+        cache['c'] = 3
+        self.assertEqual(10, cache.get('a'))
+        self.assertFalse('b' in cache)
+        cache.clear()
+        self.assertEqual(0, len(cache))
+        cache['d'] = 4
+        self.assertEqual(4, cache.get('d'))
+
+    def test_update_checksum(self):
+        data = 'x' * utils.NATIVE_HASH_MIN_SIZE
+        checksum = hashlib.md5()
+        utils.update_checksum(checksum, data)
+        utils.update_checksum(checksum, 'y')
+        self.assertEqual(hashlib.md5(data + 'y').hexdigest(),
+                         checksum.hexdigest())
+
+    def test_native_call_raises(self):
+        self.assertRaises(ValueError, utils.native_call, int, 'x')
+
+    def test_multi_hash(self):
+        digests = utils.MultiHash(['md5', 'sha256'])
+        digests.update('abc')
+        digests.update('def')
+        self.assertEqual(hashlib.md5('abcdef').hexdigest(),
+                         digests.hexdigest())
+        self.assertEqual({'md5': hashlib.md5('abcdef').hexdigest(),
+                          'sha256': hashlib.sha256('abcdef').hexdigest()},
+                         digests.hexdigests())
+
+    def test_read_ahead(self):
+        data = 'x' * 100 + 'y' * 50
+        with utils.read_ahead(StringIO.StringIO(data), 16, 2) as reader:
+            self.assertEqual(data[:40], reader.read(40))
+            self.assertEqual(data[40:], reader.read())
+            self.assertEqual('', reader.read(10))
+
+    def test_read_ahead_error(self):
+        class BrokenFile(object):
+            def read(self, length):
+                raise IOError('Connection reset')
+
+        with utils.read_ahead(BrokenFile(), 16, 2) as reader:
+            self.assertRaises(IOError, reader.read, 10)
+
+    def test_read_ahead_disabled(self):
+        fd = StringIO.StringIO('data')
+        with utils.read_ahead(fd, 16, 0) as reader:
+            self.assertTrue(reader is fd)
+
+    def test_readinto(self):
+        buf = bytearray(10)
+        fd = StringIO.StringIO('abcdefghijkl')
+        self.assertEqual(10, utils.readinto(fd, buf, 3))
+        self.assertEqual('abcdefghij', str(buf))
+        self.assertEqual(2, utils.readinto(fd, buf, 3))
+        self.assertEqual('kl', str(buf[:2]))
+
+    def test_readinto_file(self):
+        buf = bytearray(10)
+        with tempfile.TemporaryFile() as fd:
+            fd.write('abcdefghijkl')
+            fd.seek(0)
+            self.assertEqual(10, utils.readinto(fd, buf))
+            self.assertEqual('abcdefghij', str(buf))
+            self.assertEqual(2, utils.readinto(fd, buf))
+            self.assertEqual('kl', str(buf[:2]))
+
+    def test_buffer_pool_reuses_buffers(self):
+        pool = utils.BufferPool(16, 1)
+        buf = pool.get()
+        self.assertEqual(16, len(buf))
+        pool.put(buf)
+        pool.put(bytearray(16))
+        self.assertTrue(pool.get() is buf)
+        self.assertFalse(pool.get() is buf)
+
+    def test_buffer_reader(self):
+        reader = utils.BufferReader(bytearray('abcdefgh'), 6)
+        self.assertEqual('abcd', reader.read(4))
+        self.assertEqual(4, reader.tell())
+        self.assertEqual('ef', reader.read())
+        reader.seek(1)
+        self.assertEqual('bcdef', reader.read(10))
+        reader.seek(-2, os.SEEK_END)
+        self.assertEqual('ef', reader.read())
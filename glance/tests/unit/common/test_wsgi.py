@@ -16,6 +16,7 @@
 #    under the License.
 
 import socket
+import tempfile
 import time
 
 import datetime
@@ -257,6 +258,106 @@ class ServerTest(test_utils.BaseTestCase):
         self.assertTrue(isinstance(actual, eventlet.greenpool.GreenPool))
 
 
+class FakeInput(object):
+    def __init__(self, sock):
+        self.sock = sock
+
+    def get_socket(self):
+        return self.sock
+
+
+class SendfileApplicationTest(test_utils.BaseTestCase):
+
+    def setUp(self):
+        super(SendfileApplicationTest, self).setUp()
+        self.data = 'X' * (wsgi.SendfileApplication.FIRST_CHUNKSIZE + 4096)
+        self.image_file = tempfile.TemporaryFile()
+        self.image_file.write(self.data)
+        self.image_file.flush()
+        self.sender, self.receiver = socket.socketpair()
+        self.sent = []
+
+    def tearDown(self):
+        self.sender.close()
+        self.receiver.close()
+        super(SendfileApplicationTest, self).tearDown()
+
+    def _get_app(self, body, headers=None):
+        if headers is None:
+            headers = [('Content-Length', str(len(self.data)))]
+
+        def app(environ, start_response):
+            start_response('200 OK', headers)
+            return body
+        return wsgi.SendfileApplication(app)
+
+    def _get_environ(self, **kwargs):
+        environ = {'eventlet.input': FakeInput(self.sender)}
+        environ.update(kwargs)
+        return environ
+
+    def _get_wrapper(self):
+        return utils.FileWrapper(self.image_file, len(self.data),
+                                 iter(['unused']),
+                                 callbacks=[self.sent.append])
+
+    def test_sendfile(self):
+        environ = self._get_environ()
+        result = self._get_app(self._get_wrapper())(environ,
+                                                    lambda *args: None)
+
+        chunks = list(result)
+        self.assertEqual(1, len(chunks))
+        self.assertEqual(0, environ['eventlet.minimum_write_chunk_size'])
+        remaining = len(self.data) - len(chunks[0])
+        received = ''
+        while len(received) < remaining:
+            received += self.receiver.recv(remaining - len(received))
+        self.assertEqual(self.data, chunks[0] + received)
+        self.assertEqual([len(self.data)], self.sent)
+        self.assertTrue(self.image_file.closed)
+
+    def test_sendfile_offset(self):
+        self.image_file.seek(0)
+        self.image_file.write('ABCDE' * 20)
+        self.image_file.flush()
+        length = len(self.data) - 100
+        wrapper = utils.FileWrapper(self.image_file, length,
+                                    iter(['unused']),
+                                    callbacks=[self.sent.append],
+                                    offset=100)
+        headers = [('Content-Length', str(length))]
+        result = self._get_app(wrapper, headers)(self._get_environ(),
+                                                 lambda *args: None)
+
+        chunks = list(result)
+        remaining = length - len(chunks[0])
+        received = ''
+        while len(received) < remaining:
+            received += self.receiver.recv(remaining - len(received))
+        self.assertEqual(self.data[100:], chunks[0] + received)
+        self.assertEqual([length], self.sent)
+
+    def test_wrapped_body_is_iterated(self):
+        body = (chunk for chunk in self._get_wrapper())
+        result = self._get_app(body)(self._get_environ(), lambda *args: None)
+        self.assertEqual(['unused'], list(result))
+        self.assertEqual([], self.sent)
+
+    def test_no_content_length(self):
+        app = self._get_app(self._get_wrapper(), headers=[])
+        result = app(self._get_environ(), lambda *args: None)
+        self.assertEqual(['unused'], list(result))
+        self.assertEqual([], self.sent)
+
+    def test_ssl(self):
+        environ = self._get_environ(**{'wsgi.url_scheme': 'https'})
+        result = self._get_app(self._get_wrapper())(environ,
+                                                    lambda *args: None)
+        self.assertEqual(['unused'], list(result))
+        self.assertEqual([], self.sent)
+
+
 class TestHelpers(test_utils.BaseTestCase):
 
     def test_headers_are_unicode(self):
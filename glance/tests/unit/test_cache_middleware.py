@@ -109,6 +109,14 @@ class TestCacheMiddlewareChecksumVerification(testtools.TestCase):
 
         self.assertEqual("abcdefghi", cache_filter.cache.image_checksum)
 
+    def test_partial_content_not_cached(self):
+        cache_filter = ChecksumTestCacheFilter()
+        headers = {"Content-MD5": "abcdefghi"}
+        resp = webob.Response(headers=headers, status=206)
+        cache_filter._process_GET_response(resp, None)
+
+        self.assertFalse(hasattr(cache_filter.cache, 'image_checksum'))
+
     def test_checksum_missing_header(self):
         cache_filter = ChecksumTestCacheFilter()
         resp = webob.Response()
@@ -189,6 +197,13 @@ class TestCacheMiddlewareProcessRequest(utils.BaseTestCase):
         cache_filter.process_request(request)
         self.assertTrue(image_id in cache_filter.cache.deleted_images)
 
+    def test_range_request_not_served_from_cache(self):
+        image_id = 'test1'
+        request = webob.Request.blank('/v1/images/%s' % image_id,
+                                      headers={'Range': 'bytes=0-9'})
+        cache_filter = ProcessRequestTestCacheFilter()
+        self.assertEqual(None, cache_filter.process_request(request))
+
     def test_v1_process_request_image_fetch(self):
 
         def fake_get_image_metadata(context, image_id):
@@ -27,7 +27,9 @@ import StringIO
 import mox
 
 from glance.common import exception
+from glance.common import utils
 from glance.openstack.common import uuidutils
+from glance.store import filesystem
 from glance.store.filesystem import Store, ChunkedFile
 from glance.store.location import get_location_from_uri
 from glance.tests.unit import base
@@ -74,6 +76,44 @@ class TestStore(base.IsolatedUnitTest):
         self.assertEqual(expected_data, data)
         self.assertEqual(expected_num_chunks, num_chunks)
 
+    def test_get_file_wrapper(self):
+        """Test that retrieved data exposes the underlying file"""
+        image_id = uuidutils.generate_uuid()
+        file_contents = "chunk00000remainder"
+        self.store.add(image_id, StringIO.StringIO(file_contents),
+                       len(file_contents))
+
+        uri = "file:///%s/%s" % (self.test_dir, image_id)
+        loc = get_location_from_uri(uri)
+        (image_file, image_size) = self.store.get(loc)
+
+        self.assertTrue(isinstance(image_file, utils.FileWrapper))
+        self.assertEqual(len(file_contents), image_file.length)
+        self.assertEqual(file_contents,
+                         os.read(image_file.fileno(), image_size))
+        image_file.close()
+
+    def test_get_range(self):
+        """Test retrieval of a byte range of a file"""
+        ChunkedFile.CHUNKSIZE = 2
+        image_id = uuidutils.generate_uuid()
+        file_contents = "chunk00000remainder"
+        self.store.add(image_id, StringIO.StringIO(file_contents),
+                       len(file_contents))
+
+        uri = "file:///%s/%s" % (self.test_dir, image_id)
+        loc = get_location_from_uri(uri)
+        (image_file, image_size) = self.store.get(loc, offset=5, length=5)
+
+        self.assertEqual(5, image_size)
+        self.assertEqual(5, image_file.length)
+        self.assertEqual(5, image_file.offset)
+        self.assertEqual(['00', '00', '0'], list(image_file))
+
+        (image_file, image_size) = self.store.get(loc, offset=10)
+        self.assertEqual(9, image_size)
+        self.assertEqual('remainder', ''.join(image_file))
+
     def test_get_non_existing(self):
         """
         Test that trying to retrieve a file that doesn't exist
@@ -116,6 +156,47 @@ class TestStore(base.IsolatedUnitTest):
         self.assertEquals(expected_file_contents, new_image_contents)
         self.assertEquals(expected_file_size, new_image_file_size)
 
+    def test_add_read_ahead(self):
+        """Test adding an image while reading the upload ahead"""
+        self.config(store_read_ahead_chunks=2)
+        ChunkedFile.CHUNKSIZE = 1024
+        expected_file_contents = "*" * 1024 * 5
+        image_file = StringIO.StringIO(expected_file_contents)
+
+        location, size, checksum, _ = self.store.add(
+            uuidutils.generate_uuid(), image_file, 0)
+
+        self.assertEquals(len(expected_file_contents), size)
+        self.assertEquals(hashlib.md5(expected_file_contents).hexdigest(),
+                          checksum)
+        (new_image_file, new_image_size) = self.store.get(
+            get_location_from_uri(location))
+        self.assertEquals(expected_file_contents, ''.join(new_image_file))
+
+    def test_add_extra_digests(self):
+        """Test that requested digests are saved in location metadata"""
+        self.config(image_digest_algorithms=['sha256'])
+        expected_file_contents = "*" * 1024
+        image_file = StringIO.StringIO(expected_file_contents)
+
+        location, size, checksum, metadata = self.store.add(
+            uuidutils.generate_uuid(), image_file, len(expected_file_contents))
+
+        self.assertEquals(hashlib.md5(expected_file_contents).hexdigest(),
+                          checksum)
+        self.assertEquals(
+            {'digests': {
+                'sha256': hashlib.sha256(expected_file_contents).hexdigest()}},
+            metadata)
+
+    def test_add_bad_digest_algorithm(self):
+        """Test that an unknown digest algorithm disables adding"""
+        self.config(image_digest_algorithms=['nosuchhash'])
+        store = Store()
+        self.assertRaises(exception.StoreAddDisabled, store.add,
+                          uuidutils.generate_uuid(), StringIO.StringIO('*'),
+                          1)
+
     def test_add_check_metadata_success(self):
         expected_image_id = uuidutils.generate_uuid()
         in_metadata = {'akey': u'some value', 'list': [u'1', u'2', u'3']}
@@ -294,3 +375,125 @@ class TestStore(base.IsolatedUnitTest):
         self.assertRaises(exception.NotFound,
                           self.store.delete,
                           loc)
+
+    def _configure_datadirs(self, *datadirs):
+        self.config(filesystem_store_datadir=None,
+                    filesystem_store_datadirs=list(datadirs))
+        return Store()
+
+    def test_configure_add_with_multiple_datadirs(self):
+        """Test that the directories are created and grouped by priority"""
+        dir1 = os.path.join(self.test_dir, 'dir1')
+        dir2 = os.path.join(self.test_dir, 'dir2')
+        dir3 = os.path.join(self.test_dir, 'dir3')
+        store = self._configure_datadirs(dir1 + ':100', dir2 + ':200', dir3)
+
+        self.assertEqual([200, 100, 0], store.priority_list)
+        self.assertEqual({200: [dir2], 100: [dir1], 0: [dir3]},
+                         store.priority_data_map)
+        for datadir in (dir1, dir2, dir3):
+            self.assertTrue(os.path.isdir(datadir))
+
+    def test_configure_add_with_datadir_and_datadirs(self):
+        """Test that only one of the datadir options may be used"""
+        self.config(filesystem_store_datadirs=[self.test_dir + ':1'])
+        self.assertRaises(exception.BadStoreConfiguration,
+                          self.store.configure_add)
+
+    def test_configure_add_with_invalid_priority(self):
+        self.config(filesystem_store_datadir=None,
+                    filesystem_store_datadirs=[self.test_dir + ':high'])
+        self.assertRaises(exception.BadStoreConfiguration,
+                          self.store.configure_add)
+
+    def test_configure_add_with_duplicate_datadirs(self):
+        self.config(filesystem_store_datadir=None,
+                    filesystem_store_datadirs=[self.test_dir + ':1',
+                                               self.test_dir + ':2'])
+        self.assertRaises(exception.BadStoreConfiguration,
+                          self.store.configure_add)
+
+    def test_add_with_multiple_datadirs(self):
+        """
+        Test that an image is written to the highest priority directory
+        with the most free space, and can be read back from there
+        """
+        dir1 = os.path.join(self.test_dir, 'dir1')
+        dir2 = os.path.join(self.test_dir, 'dir2')
+        dir3 = os.path.join(self.test_dir, 'dir3')
+        store = self._configure_datadirs(dir1 + ':100', dir2 + ':100',
+                                         dir3 + ':200')
+        free_space = {dir1: 1000, dir2: 2000, dir3: 10}
+        self.stubs.Set(store, '_get_free_space', free_space.get)
+
+        image_id = uuidutils.generate_uuid()
+        file_contents = "chunk00000remainder"
+        location, size, checksum, _ = store.add(
+                image_id, StringIO.StringIO(file_contents),
+                len(file_contents))
+
+        self.assertEqual("file://%s/%s" % (dir2, image_id), location)
+        (image_file, image_size) = store.get(get_location_from_uri(location))
+        self.assertEqual(file_contents, ''.join(image_file))
+
+    def test_add_with_multiple_datadirs_storage_full(self):
+        """
+        Test that StorageFull is raised when no directory can hold the image
+        """
+        dir1 = os.path.join(self.test_dir, 'dir1')
+        dir2 = os.path.join(self.test_dir, 'dir2')
+        store = self._configure_datadirs(dir1 + ':1', dir2 + ':2')
+        self.stubs.Set(store, '_get_free_space', lambda datadir: 10)
+
+        self.assertRaises(exception.StorageFull, store.add,
+                          uuidutils.generate_uuid(),
+                          StringIO.StringIO('*' * 100), 100)
+
+    def test_add_with_shard_depth(self):
+        """Test that images are written to shard directories"""
+        self.config(filesystem_store_shard_depth=2)
+        store = Store()
+        image_id = uuidutils.generate_uuid()
+        file_contents = "chunk00000remainder"
+        location, size, checksum, _ = store.add(
+                image_id, StringIO.StringIO(file_contents),
+                len(file_contents))
+
+        expected_path = os.path.join(self.test_dir, image_id[0:2],
+                                     image_id[2:4], image_id)
+        self.assertEqual("file://%s" % expected_path, location)
+        (image_file, image_size) = store.get(get_location_from_uri(location))
+        self.assertEqual(file_contents, ''.join(image_file))
+
+    def test_shard_datadir(self):
+        """
+        Test that image files are moved between layouts and stay
+        reachable through the locations recorded before they were moved
+        """
+        image_id = uuidutils.generate_uuid()
+        file_contents = "chunk00000remainder"
+        flat_location = self.store.add(image_id,
+                                       StringIO.StringIO(file_contents),
+                                       len(file_contents))[0]
+        open(os.path.join(self.test_dir, 'not-an-image'), 'w').close()
+
+        self.assertEqual(1, filesystem.shard_datadir(self.test_dir, 2))
+        sharded_path = filesystem.get_image_path(self.test_dir, image_id, 2)
+        self.assertTrue(os.path.exists(sharded_path))
+        self.assertTrue(os.path.exists(os.path.join(self.test_dir,
+                                                    'not-an-image')))
+        self.assertEqual(0, filesystem.shard_datadir(self.test_dir, 2))
+
+        self.config(filesystem_store_shard_depth=2)
+        loc = get_location_from_uri(flat_location)
+        self.assertEqual(len(file_contents), self.store.get_size(loc))
+
+        self.assertEqual(1, filesystem.shard_datadir(self.test_dir, 0))
+        self.assertFalse(os.path.exists(os.path.dirname(sharded_path)))
+        loc = get_location_from_uri("file://%s" % sharded_path)
+        (image_file, image_size) = self.store.get(loc)
+        self.assertEqual(file_contents, ''.join(image_file))
+
+        self.store.delete(loc)
+        self.assertFalse(os.path.exists(os.path.join(self.test_dir,
+                                                     image_id)))
@@ -0,0 +1,201 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2013 OpenStack, LLC
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Tests the GridFS backend store against fake pymongo and gridfs modules"""
+
+import hashlib
+import StringIO
+
+import fixtures
+
+from glance.common import exception
+import glance.store.gridfs as gridfs_store
+from glance.store.location import get_location_from_uri
+from glance.tests.unit import base
+
+
+class FakePymongo(object):
+    """Stands in for the pymongo module, recording the clients made"""
+
+    def __init__(self):
+        self.clients = []
+
+    def MongoClient(self, uri):
+        self.clients.append(uri)
+        return {'glance': 'glance-db'}
+
+
+class FakeUriParser(object):
+
+    @staticmethod
+    def parse_uri(uri):
+        return {'database': uri.rsplit('/', 1)[-1]}
+
+
+class FakeGridfs(object):
+    """Stands in for the gridfs module, keeping files in memory"""
+
+    class errors(object):
+
+        class NoFile(Exception):
+            pass
+
+    def __init__(self):
+        self.files = {}
+        self.writes = []
+        self.deleted = []
+        self.disable_md5 = False
+
+    def GridFS(self, database, disable_md5=False):
+        self.disable_md5 = disable_md5
+        return FakeGridFSCollection(self)
+
+
+class FakeGridFSCollection(object):
+
+    def __init__(self, gridfs):
+        self.gridfs = gridfs
+
+    def exists(self, file_id):
+        return file_id in self.gridfs.files
+
+    def new_file(self, _id, chunkSize):
+        return FakeGridIn(self.gridfs, _id, chunkSize)
+
+    def get(self, file_id):
+        if file_id not in self.gridfs.files:
+            raise self.gridfs.errors.NoFile(file_id)
+        return FakeGridOut(file_id, self.gridfs.files[file_id])
+
+    def delete(self, file_id):
+        self.gridfs.deleted.append(file_id)
+        self.gridfs.files.pop(file_id, None)
+
+
+class FakeGridIn(object):
+
+    def __init__(self, gridfs, file_id, chunk_size):
+        self.gridfs = gridfs
+        self._id = file_id
+        self.chunk_size = chunk_size
+        self.data = []
+        self.md5 = None
+
+    def write(self, data):
+        self.gridfs.writes.append((self.chunk_size, len(data)))
+        self.data.append(data)
+
+    def close(self):
+        data = ''.join(self.data)
+        if not self.gridfs.disable_md5:
+            self.md5 = hashlib.md5(data).hexdigest()
+        self.gridfs.files[self._id] = data
+
+
+class FakeGridOut(StringIO.StringIO):
+
+    def __init__(self, file_id, data):
+        StringIO.StringIO.__init__(self, data)
+        self._id = file_id
+        self.length = len(data)
+        self.chunk_size = 1024
+
+    def __iter__(self):
+        return iter(lambda: self.read(self.chunk_size), '')
+
+
+class FailingFile(object):
+    """A file whose reads fail once size bytes were read"""
+
+    def __init__(self, data, size):
+        self.data = StringIO.StringIO(data)
+        self.size = size
+
+    def read(self, length):
+        if self.data.tell() >= self.size:
+            raise IOError('connection reset')
+        return self.data.read(length)
+
+
+class TestStore(base.StoreClearingUnitTest):
+
+    def setUp(self):
+        self.pymongo = FakePymongo()
+        self.gridfs = FakeGridfs()
+        for name, module in (('pymongo', self.pymongo),
+                             ('gridfs', self.gridfs),
+                             ('uri_parser', FakeUriParser)):
+            self.useFixture(fixtures.MonkeyPatch(
+                'glance.store.gridfs.%s' % name, module))
+        gridfs_store._CLIENTS.clear()
+        self.addCleanup(gridfs_store._CLIENTS.clear)
+
+        self.config(default_store='gridfs',
+                    known_stores=['glance.store.gridfs.Store'],
+                    mongodb_store_uri='mongodb://localhost/glance',
+                    mongodb_store_db='glance',
+                    mongodb_store_chunk_size=1)
+        super(TestStore, self).setUp()
+        self.store = gridfs_store.Store()
+        self.data = 'x' * 3500
+
+    def test_add_and_get(self):
+        """Test that the upload is written in chunks of the GridFS size"""
+        location, size, checksum, metadata = self.store.add(
+            'image', StringIO.StringIO(self.data), len(self.data))
+
+        self.assertEqual('gridfs://image', location)
+        self.assertEqual(len(self.data), size)
+        self.assertEqual(hashlib.md5(self.data).hexdigest(), checksum)
+        self.assertEqual([(1024, 1024)] * 3 + [(1024, 428)],
+                         self.gridfs.writes)
+        # The md5 is computed while writing, not by the server
+        self.assertTrue(self.gridfs.disable_md5)
+
+        loc = get_location_from_uri(location)
+        (image, image_size) = self.store.get(loc)
+        self.assertEqual(len(self.data), image_size)
+        self.assertEqual(self.data, ''.join(image))
+
+        (image, image_size) = self.store.get(loc, offset=1000, length=100)
+        self.assertEqual(100, image_size)
+        self.assertEqual(self.data[1000:1100], ''.join(image))
+
+    def test_add_failure_deletes_file(self):
+        """Test that the chunks of a failed upload are deleted"""
+        self.assertRaises(IOError, self.store.add, 'image',
+                          FailingFile(self.data, 2048), len(self.data))
+        self.assertEqual(['image'], self.gridfs.deleted)
+        self.assertFalse('image' in self.gridfs.files)
+
+    def test_add_already_existing(self):
+        """Test that adding an existing image raises Duplicate"""
+        self.store.add('image', StringIO.StringIO('x'), 1)
+        self.assertRaises(exception.Duplicate, self.store.add, 'image',
+                          StringIO.StringIO('x'), 1)
+
+    def test_client_shared(self):
+        """Test that stores share one client per mongodb URI"""
+        gridfs_store.Store()
+        self.assertEqual(['mongodb://localhost/glance'],
+                         self.pymongo.clients)
+
+        self.config(mongodb_store_uri='mongodb://otherhost/glance')
+        gridfs_store.Store()
+        self.assertEqual(['mongodb://localhost/glance',
+                          'mongodb://otherhost/glance'],
+                         self.pymongo.clients)
@@ -15,6 +15,8 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import httplib
+
 import stubout
 
 from glance.common import exception
@@ -23,6 +25,7 @@ from glance.db.sqlalchemy import api as db_api
 from glance.registry.client.v1.api import configure_registry_client
 from glance.store import (delete_from_backend,
                           safe_delete_from_backend)
+import glance.store.http
 from glance.store.http import Store, MAX_REDIRECTS
 from glance.store.location import get_location_from_uri
 from glance.tests.unit import base
@@ -34,6 +37,9 @@ from glance.tests import utils, stubs as test_stubs
 # FakeHTTPConnection below.
 FAKE_RESPONSE_STACK = []
 
+# Connections created by FakeHTTPConnection, and the requests they sent
+FAKE_CONNECTIONS = []
+
 
 def stub_out_http_backend(stubs):
     """
@@ -49,18 +55,20 @@ def stub_out_http_backend(stubs):
     class FakeHTTPConnection(object):
 
         def __init__(self, *args, **kwargs):
-            pass
+            self.requests = []
+            self.closed = False
+            FAKE_CONNECTIONS.append(self)
 
         def getresponse(self):
             if len(FAKE_RESPONSE_STACK):
                 return FAKE_RESPONSE_STACK.pop()
             return utils.FakeHTTPResponse()
 
-        def request(self, *_args, **_kwargs):
-            pass
+        def request(self, verb, *_args, **_kwargs):
+            self.requests.append(verb)
 
         def close(self):
-            pass
+            self.closed = True
 
     def fake_get_conn_class(self, *args, **kwargs):
         return FakeHTTPConnection
@@ -87,6 +95,11 @@ class TestHttpStore(base.StoreClearingUnitTest):
     def setUp(self):
         global FAKE_RESPONSE_STACK
         FAKE_RESPONSE_STACK = []
+        del FAKE_CONNECTIONS[:]
+        glance.store.http.CONNECTION_POOL.clear()
+        glance.store.http.HEAD_CACHE.clear()
+        self.addCleanup(glance.store.http.CONNECTION_POOL.clear)
+        self.addCleanup(glance.store.http.HEAD_CACHE.clear)
         self.config(default_store='http',
                     known_stores=['glance.store.http.Store'])
         super(TestHttpStore, self).setUp()
@@ -106,6 +119,26 @@ class TestHttpStore(base.StoreClearingUnitTest):
         chunks = [c for c in image_file]
         self.assertEqual(chunks, expected_returns)
 
+    def test_http_get_range(self):
+        uri = "http://netloc/path/to/file.tar.gz"
+        resp = utils.FakeHTTPResponse(status=206,
+                                      headers={'content-length': 4},
+                                      data='teap')
+        FAKE_RESPONSE_STACK.append(resp)
+        loc = get_location_from_uri(uri)
+        (image_file, image_size) = self.store.get(loc, offset=7, length=4)
+        self.assertEqual(image_size, 4)
+        self.assertEqual(''.join(image_file), 'teap')
+
+    def test_http_get_range_not_supported(self):
+        # The default response ignores the Range header and returns the
+        # whole image with a 200 OK
+        uri = "http://netloc/path/to/file.tar.gz"
+        loc = get_location_from_uri(uri)
+        (image_file, image_size) = self.store.get(loc, offset=7, length=5)
+        self.assertEqual(image_size, 5)
+        self.assertEqual(''.join(image_file), 'teapo')
+
     def test_http_get_redirect(self):
         # Add two layers of redirects to the response stack, which will
         # return the default 200 OK with the expected data after resolving
@@ -160,6 +193,71 @@ class TestHttpStore(base.StoreClearingUnitTest):
         loc = get_location_from_uri(uri)
         self.assertRaises(exception.BadStoreUri, self.store.get, loc)
 
+    def test_http_connection_reused(self):
+        uri = "http://netloc/path/to/file.tar.gz"
+        loc = get_location_from_uri(uri)
+        self.config(http_store_head_cache_ttl=0)
+        self.assertEqual(31, self.store.get_size(loc))
+        (image_file, image_size) = self.store.get(loc)
+        self.assertEqual(31, len(''.join(image_file)))
+        self.assertEqual(31, self.store.get_size(loc))
+
+        self.assertEqual(1, len(FAKE_CONNECTIONS))
+        self.assertEqual(['HEAD', 'GET', 'HEAD'], FAKE_CONNECTIONS[0].requests)
+        self.assertFalse(FAKE_CONNECTIONS[0].closed)
+
+    def test_http_connection_not_reused_when_closing(self):
+        uri = "http://netloc/path/to/file.tar.gz"
+        loc = get_location_from_uri(uri)
+        self.config(http_store_head_cache_ttl=0)
+        FAKE_RESPONSE_STACK.append(utils.FakeHTTPResponse(will_close=True))
+        self.store.get_size(loc)
+        self.store.get_size(loc)
+
+        self.assertEqual(2, len(FAKE_CONNECTIONS))
+        self.assertTrue(FAKE_CONNECTIONS[0].closed)
+
+    def test_http_connection_not_reused_when_partially_read(self):
+        uri = "http://netloc/path/to/file.tar.gz"
+        loc = get_location_from_uri(uri)
+        (image_file, image_size) = self.store.get(loc, offset=7, length=5)
+        self.assertEqual(''.join(image_file), 'teapo')
+        self.assertTrue(FAKE_CONNECTIONS[0].closed)
+        self.assertEqual({}, glance.store.http.CONNECTION_POOL.connections)
+
+    def test_http_stale_pooled_connection_retried(self):
+        uri = "http://netloc/path/to/file.tar.gz"
+        loc = get_location_from_uri(uri)
+        self.config(http_store_head_cache_ttl=0)
+        self.store.get_size(loc)
+
+        def fail(*args, **kwargs):
+            raise httplib.BadStatusLine('')
+
+        self.stubs.Set(FAKE_CONNECTIONS[0], 'getresponse', fail)
+        self.assertEqual(31, self.store.get_size(loc))
+        self.assertEqual(2, len(FAKE_CONNECTIONS))
+        self.assertTrue(FAKE_CONNECTIONS[0].closed)
+
+    def test_http_head_cached(self):
+        uri = "http://netloc/path/to/file.tar.gz"
+        loc = get_location_from_uri(uri)
+        self.assertEqual(31, self.store.get_size(loc))
+        self.assertEqual(31, self.store.get_size(loc))
+        self.assertEqual(['HEAD'], FAKE_CONNECTIONS[0].requests)
+
+    def test_http_head_cache_expires(self):
+        uri = "http://netloc/path/to/file.tar.gz"
+        loc = get_location_from_uri(uri)
+        self.config(http_store_head_cache_ttl=30)
+        now = [1000.0]
+        self.stubs.Set(glance.store.http.time, 'time', lambda: now[0])
+
+        self.store.get_size(loc)
+        now[0] += 30
+        self.store.get_size(loc)
+        self.assertEqual(['HEAD', 'HEAD'], FAKE_CONNECTIONS[0].requests)
+
     def test_https_get(self):
         uri = "https://netloc/path/to/file.tar.gz"
         expected_returns = ['I ', 'am', ' a', ' t', 'ea', 'po', 't,', ' s',
@@ -42,6 +42,17 @@ class UtilsTestCase(test_utils.BaseTestCase):
                 text = crypt.urlsafe_decrypt(key, ciphertext)
                 self.assertTrue(plaintext == text)
 
+    def test_decryption_cached_per_key(self):
+        key = "1234567890abcdef"
+        other_key = "fedcba0987654321"
+        ciphertext = crypt.urlsafe_encrypt(key, 'swift://secret')
+        self.assertEqual('swift://secret',
+                         crypt.urlsafe_decrypt(key, ciphertext))
+        self.assertEqual('swift://secret',
+                         crypt.urlsafe_decrypt(key, unicode(ciphertext)))
+        self.assertNotEqual('swift://secret',
+                            crypt.urlsafe_decrypt(other_key, ciphertext))
+
     def test_empty_metadata_headers(self):
         """Ensure unset metadata is not encoded in HTTP headers"""
 
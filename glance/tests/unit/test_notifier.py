@@ -23,6 +23,7 @@ import qpid.messaging
 import stubout
 
 from glance.common import exception
+import glance.common.utils
 import glance.context
 from glance import notifier
 import glance.notifier.notify_kombu
@@ -42,7 +43,7 @@ TENANT2 = '2c014f32-55eb-467d-8fcb-4bd706012f81'
 
 
 class ImageStub(glance.domain.Image):
-    def get_data(self):
+    def get_data(self, offset=0, length=None):
         return ['01234', '56789']
 
     def set_data(self, data, size=None):
@@ -546,6 +547,35 @@ class TestImageNotifications(utils.BaseTestCase):
         self.assertEqual(output_log['payload']['image_id'],
                          self.image.image_id)
 
+    def test_image_get_data_sendfile_notification(self):
+        self.image_proxy.size = 10
+        data = glance.common.utils.FileWrapper(None, 10,
+                                               ['01234', '56789'])
+        self.stubs.Set(self.image, 'get_data', lambda **kwargs: data)
+        wrapper = self.image_proxy.get_data()
+        self.assertTrue(isinstance(wrapper, glance.common.utils.FileWrapper))
+        self.assertEqual(self.notifier.get_logs(), [])
+        wrapper.transmitted(10)
+        output_logs = self.notifier.get_logs()
+        self.assertEqual(len(output_logs), 1)
+        output_log = output_logs[0]
+        self.assertEqual(output_log['notification_type'], 'INFO')
+        self.assertEqual(output_log['event_type'], 'image.send')
+        self.assertEqual(output_log['payload']['bytes_sent'], 10)
+
+    def test_image_get_data_range_notification(self):
+        self.image_proxy.size = 10
+        self.stubs.Set(self.image, 'get_data',
+                       lambda offset=0, length=None: ['23456'])
+        data = ''.join(self.image_proxy.get_data(offset=2, length=5))
+        self.assertEqual(data, '23456')
+        output_logs = self.notifier.get_logs()
+        self.assertEqual(len(output_logs), 1)
+        output_log = output_logs[0]
+        self.assertEqual(output_log['notification_type'], 'INFO')
+        self.assertEqual(output_log['event_type'], 'image.send')
+        self.assertEqual(output_log['payload']['bytes_sent'], 5)
+
     def test_image_set_data_prepare_notification(self):
         insurance = {'called': False}
 
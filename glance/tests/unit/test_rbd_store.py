@@ -0,0 +1,380 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2013 OpenStack, LLC
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Tests the RBD backend store against fake rados and rbd modules"""
+
+import contextlib
+import hashlib
+import StringIO
+import threading
+import time
+
+import eventlet
+import fixtures
+
+from glance.openstack.common import uuidutils
+import glance.store.rbd as rbd_store
+from glance.store.location import get_location_from_uri
+from glance.tests.unit import base
+
+ONE_MB = 1024 * 1024
+
+
+class FakeRados(object):
+    """Stands in for the rados module, recording the connections made"""
+
+    class Error(Exception):
+        pass
+
+    def __init__(self):
+        self.connections = []
+        self.connect_error = None
+
+    def Rados(self, conffile=None, rados_id=None):
+        conn = FakeConnection(self)
+        self.connections.append(conn)
+        return conn
+
+
+class FakeConnection(object):
+
+    def __init__(self, rados):
+        self.rados = rados
+        self.is_shut_down = False
+
+    def connect(self):
+        if self.rados.connect_error is not None:
+            raise self.rados.connect_error
+
+    def open_ioctx(self, pool):
+        return FakeIoctx(self, pool)
+
+    def get_fsid(self):
+        return 'fsid'
+
+    def shutdown(self):
+        self.is_shut_down = True
+
+
+class FakeIoctx(object):
+
+    def __init__(self, conn, pool):
+        self.conn = conn
+        self.pool = pool
+
+    def close(self):
+        pass
+
+
+class FakeRbd(object):
+    """
+    Stands in for the rbd module, keeping images in memory and recording
+    how many reads or writes run at once. Each read or write sleeps for
+    delays[offset] seconds, 0.01 if not given.
+    """
+
+    RBD_FEATURE_LAYERING = 1
+
+    class ImageNotFound(Exception):
+        pass
+
+    class ImageExists(Exception):
+        pass
+
+    class ImageBusy(Exception):
+        pass
+
+    class IOError(Exception):
+        pass
+
+    def __init__(self):
+        self.images = {}
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.delays = {}
+        self.fail_write_offset = None
+        self.open_error = None
+        self.in_flight_at_remove = None
+
+    def RBD(self):
+        return FakeRBDAdmin(self)
+
+    def Image(self, ioctx, name, snapshot=None):
+        if self.open_error is not None:
+            raise self.open_error
+        if name not in self.images:
+            raise self.ImageNotFound(name)
+        return FakeImage(self, name)
+
+    def io(self, offset, func):
+        with self.lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            time.sleep(self.delays.get(offset, 0.01))
+            return func()
+        finally:
+            with self.lock:
+                self.in_flight -= 1
+
+
+class FakeRBDAdmin(object):
+
+    def __init__(self, rbd):
+        self.rbd = rbd
+
+    def create(self, ioctx, name, size, order, old_format=True,
+               features=0):
+        if name in self.rbd.images:
+            raise self.rbd.ImageExists(name)
+        self.rbd.images[name] = bytearray(size)
+
+    def remove(self, ioctx, name):
+        self.rbd.in_flight_at_remove = self.rbd.in_flight
+        if name not in self.rbd.images:
+            raise self.rbd.ImageNotFound(name)
+        del self.rbd.images[name]
+
+
+class FakeImage(object):
+
+    def __init__(self, rbd, name):
+        self.rbd = rbd
+        self.data = rbd.images[name]
+
+    def close(self):
+        pass
+
+    def stat(self):
+        return {'size': len(self.data)}
+
+    def read(self, offset, length):
+        return self.rbd.io(offset, lambda: str(self.data[offset:offset +
+                                                          length]))
+
+    def write(self, data, offset):
+        def write():
+            if offset == self.rbd.fail_write_offset:
+                raise self.rbd.IOError('write failed')
+            self.data[offset:offset + len(data)] = data
+            return len(data)
+        return self.rbd.io(offset, write)
+
+    def create_snap(self, name):
+        pass
+
+    def protect_snap(self, name):
+        pass
+
+
+class TestStore(base.StoreClearingUnitTest):
+
+    def setUp(self):
+        self.rados = FakeRados()
+        self.rbd = FakeRbd()
+        self.useFixture(fixtures.MonkeyPatch('glance.store.rbd.rados',
+                                             self.rados))
+        self.useFixture(fixtures.MonkeyPatch('glance.store.rbd.rbd',
+                                             self.rbd))
+        rbd_store.CLUSTERS.clear()
+        self.addCleanup(rbd_store.CLUSTERS.clear)
+
+        self.config(default_store='rbd',
+                    known_stores=['glance.store.rbd.Store'],
+                    rbd_store_chunk_size=1,
+                    rbd_store_io_concurrency=3)
+        super(TestStore, self).setUp()
+        self.store = rbd_store.Store()
+        self.data = ''.join(chr(i % 251) for i in xrange(6 * ONE_MB + 100))
+
+    def _add(self, data):
+        image_id = uuidutils.generate_uuid()
+        location, size, checksum, _ = self.store.add(
+            image_id, StringIO.StringIO(data), len(data))
+        return image_id, get_location_from_uri(location), size, checksum
+
+    def test_add_and_get(self):
+        """Test that chunks come out in order, whichever finished first"""
+        self.rbd.delays = {0: 0.1, ONE_MB: 0.05}
+        image_id, loc, size, checksum = self._add(self.data)
+        self.assertEqual(len(self.data), size)
+        self.assertEqual(hashlib.md5(self.data).hexdigest(), checksum)
+        self.assertEqual(self.data, str(self.rbd.images[image_id]))
+
+        (image, image_size) = self.store.get(loc)
+        chunks = list(image)
+        self.assertEqual(len(self.data), image_size)
+        self.assertEqual(7, len(chunks))
+        self.assertEqual(self.data, ''.join(chunks))
+
+    def test_get_range(self):
+        """Test a byte range read across chunks"""
+        image_id, loc, size, checksum = self._add(self.data)
+        (image, image_size) = self.store.get(loc, offset=ONE_MB - 10,
+                                             length=ONE_MB + 20)
+        self.assertEqual(ONE_MB + 20, image_size)
+        self.assertEqual(self.data[ONE_MB - 10:2 * ONE_MB + 10],
+                         ''.join(image))
+
+    def test_image_calls_in_native_threads(self):
+        """Test that images are opened, queried and closed off the hub"""
+        image_id, loc, size, checksum = self._add(self.data)
+        orig_native_call = rbd_store.utils.native_call
+        calls = []
+
+        def recording_native_call(func, *args, **kwargs):
+            calls.append(func.__name__)
+            return orig_native_call(func, *args, **kwargs)
+
+        self.stubs.Set(rbd_store.utils, 'native_call', recording_native_call)
+        self.assertEqual(len(self.data), self.store.get_size(loc))
+        self.assertEqual(['Image', 'stat', 'close'], calls)
+
+    def test_in_flight_calls_bounded(self):
+        """Test that at most rbd_store_io_concurrency calls run at once"""
+        image_id, loc, size, checksum = self._add(self.data)
+        self.assertTrue(1 < self.rbd.max_in_flight <= 3)
+
+        self.rbd.max_in_flight = 0
+        (image, image_size) = self.store.get(loc)
+        for chunk in image:
+            time.sleep(0.01)
+        self.assertTrue(1 < self.rbd.max_in_flight <= 3)
+
+    def test_close_waits_for_pending_reads(self):
+        """Test that closing a read waits for the reads in flight"""
+        image_id, loc, size, checksum = self._add(self.data)
+        self.rbd.delays = dict((offset, 0.05)
+                               for offset in xrange(0, len(self.data),
+                                                    ONE_MB))
+        (image, image_size) = self.store.get(loc)
+        chunks = iter(image)
+        self.assertEqual(self.data[:ONE_MB], chunks.next())
+        chunks.close()
+        self.assertEqual(0, self.rbd.in_flight)
+
+    def test_pipelined_waits_on_error(self):
+        """Test that a failed call waits for the other calls in flight"""
+        calls = []
+
+        def call(i):
+            if i == 0:
+                raise ValueError()
+            time.sleep(0.05)
+            calls.append(i)
+
+        pipeline = rbd_store._pipelined(call, [(i,) for i in xrange(10)], 3)
+        with contextlib.closing(pipeline):
+            self.assertRaises(ValueError, list, pipeline)
+        self.assertEqual([1, 2], sorted(calls))
+
+    def test_add_write_failure(self):
+        """
+        Test that a failed write waits for the writes in flight and
+        removes the partial image
+        """
+        self.rbd.fail_write_offset = ONE_MB
+        self.rbd.delays = {2 * ONE_MB: 0.05}
+        image_id = uuidutils.generate_uuid()
+        self.assertRaises(self.rbd.IOError, self.store.add, image_id,
+                          StringIO.StringIO(self.data), len(self.data))
+        self.assertEqual(0, self.rbd.in_flight_at_remove)
+        self.assertFalse(image_id in self.rbd.images)
+
+
+class TestClusterCache(base.StoreClearingUnitTest):
+
+    def setUp(self):
+        self.rados = FakeRados()
+        self.rbd = FakeRbd()
+        self.useFixture(fixtures.MonkeyPatch('glance.store.rbd.rados',
+                                             self.rados))
+        self.useFixture(fixtures.MonkeyPatch('glance.store.rbd.rbd',
+                                             self.rbd))
+        rbd_store.CLUSTERS.clear()
+        self.addCleanup(rbd_store.CLUSTERS.clear)
+
+        self.config(default_store='rbd',
+                    known_stores=['glance.store.rbd.Store'])
+        super(TestClusterCache, self).setUp()
+        self.store = rbd_store.Store()
+        image_id = uuidutils.generate_uuid()
+        location = self.store.add(image_id, StringIO.StringIO('x' * 10),
+                                  10)[0]
+        self.loc = get_location_from_uri(location)
+
+    def test_connection_shared(self):
+        """Test that operations share one cluster connection"""
+        self.store.get_size(self.loc)
+        self.store.get_size(self.loc)
+        self.assertEqual(1, len(self.rados.connections))
+
+    def test_concurrent_connect(self):
+        """
+        Test that greenthreads needing a connection at the same time wait
+        for a single one to be made
+        """
+        rbd_store.CLUSTERS.clear()
+
+        def yielding_native_call(func, *args, **kwargs):
+            eventlet.sleep(0)
+            return func(*args, **kwargs)
+
+        self.stubs.Set(rbd_store.utils, 'native_call', yielding_native_call)
+        pool = eventlet.GreenPool()
+        sizes = list(pool.imap(lambda i: self.store.get_size(self.loc),
+                               range(3)))
+        self.assertEqual([10, 10, 10], sizes)
+        self.assertEqual(2, len(self.rados.connections))
+        self.assertFalse(self.rados.connections[1].is_shut_down)
+
+    def test_reconnect_after_fork(self):
+        """
+        Test that a forked child connects again, leaving the parent's
+        connection alone
+        """
+        parent_conn = self.rados.connections[0]
+        self.stubs.Set(rbd_store.os, 'getpid', lambda: -1)
+
+        self.assertEqual(10, self.store.get_size(self.loc))
+        self.assertEqual(2, len(self.rados.connections))
+        self.assertFalse(parent_conn.is_shut_down)
+
+        self.store.get_size(self.loc)
+        self.assertEqual(2, len(self.rados.connections))
+
+    def test_reconnect_after_rados_error(self):
+        """Test that a rados error drops the shared connection"""
+        conn = self.rados.connections[0]
+        self.rbd.open_error = self.rados.Error('connection lost')
+        self.assertRaises(self.rados.Error, self.store.get_size, self.loc)
+        self.assertTrue(conn.is_shut_down)
+
+        self.rbd.open_error = None
+        self.assertEqual(10, self.store.get_size(self.loc))
+        self.assertEqual(2, len(self.rados.connections))
+
+    def test_reconnect_after_failed_connect(self):
+        """Test that a failed connection attempt is not cached"""
+        rbd_store.CLUSTERS.clear()
+        self.rados.connect_error = self.rados.Error('no monitors')
+        self.assertRaises(self.rados.Error, self.store.get_size, self.loc)
+
+        self.rados.connect_error = None
+        self.assertEqual(10, self.store.get_size(self.loc))
+        self.assertEqual(3, len(self.rados.connections))
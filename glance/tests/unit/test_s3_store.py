@@ -21,6 +21,7 @@ import hashlib
 import StringIO
 
 import boto.s3.connection
+import eventlet
 import stubout
 
 from glance.common import exception
@@ -79,17 +80,52 @@ def stub_out_s3(stubs):
             return checksum_hex, None
 
         def set_contents_from_file(self, fp, replace=False, **kwargs):
-            self.data = StringIO.StringIO()
-            for bytes in fp:
-                self.data.write(bytes)
+            self.data = StringIO.StringIO(fp.read())
             self.size = self.data.len
             # Reset the buffer to start
             self.data.seek(0)
             self.read = self.data.read
+            self.bucket.keys[self.name] = self
+
+        def get_contents_as_string(self, headers=None):
+            data = self.bucket.keys[self.name].data.getvalue()
+            range_header = (headers or {}).get('Range')
+            if range_header:
+                start, end = range_header[len('bytes='):].split('-')
+                data = data[int(start):int(end) + 1]
+            return data
 
         def get_file(self):
             return self.data
 
+        def open_read(self, headers=None):
+            range_header = (headers or {}).get('Range')
+            if range_header:
+                start, end = range_header[len('bytes='):].split('-')
+                data = self.data.getvalue()[int(start):int(end) + 1]
+                self.read = StringIO.StringIO(data).read
+
+    class FakeMultiPartUpload:
+        """
+        Acts like a ``boto.s3.multipart.MultiPartUpload``
+        """
+        def __init__(self, bucket, key_name):
+            self.bucket = bucket
+            self.key_name = key_name
+            self.parts = {}
+
+        def upload_part_from_file(self, fp, part_num, size=None, **kwargs):
+            self.parts[part_num] = fp.read(size)
+
+        def complete_upload(self):
+            data = ''.join(self.parts[num] for num in sorted(self.parts))
+            key = self.bucket.new_key(self.key_name)
+            key.set_contents_from_file(StringIO.StringIO(data))
+            del self.bucket.uploads[self.key_name]
+
+        def cancel_upload(self):
+            del self.bucket.uploads[self.key_name]
+
     class FakeBucket:
         """
         Acts like a ``boto.s3.bucket.Bucket``
@@ -97,6 +133,7 @@ def stub_out_s3(stubs):
         def __init__(self, name, keys=None):
             self.name = name
             self.keys = keys or {}
+            self.uploads = {}
 
         def __str__(self):
             return self.name
@@ -114,11 +151,15 @@ def stub_out_s3(stubs):
             return key
 
         def new_key(self, key_name):
-            new_key = FakeKey(self, key_name)
-            self.keys[key_name] = new_key
-            return new_key
+            return FakeKey(self, key_name)
+
+        def initiate_multipart_upload(self, key_name):
+            upload = FakeMultiPartUpload(self, key_name)
+            self.uploads[key_name] = upload
+            return upload
 
     fixture_buckets = {'glance': FakeBucket('glance')}
+    stub_out_s3.buckets = fixture_buckets
     b = fixture_buckets['glance']
     k = b.new_key(FAKE_UUID)
     k.set_contents_from_file(StringIO.StringIO("*" * FIVE_KB))
@@ -164,6 +205,8 @@ class TestStore(base.StoreClearingUnitTest):
         super(TestStore, self).setUp()
         self.stubs = stubout.StubOutForTesting()
         stub_out_s3(self.stubs)
+        glance.store.s3.CONNECTION_CACHE.clear()
+        self.addCleanup(glance.store.s3.CONNECTION_CACHE.clear)
         self.store = Store()
         self.addCleanup(self.stubs.UnsetAll)
 
@@ -182,6 +225,65 @@ class TestStore(base.StoreClearingUnitTest):
             data += chunk
         self.assertEqual(expected_data, data)
 
+    def test_get_range(self):
+        """Test retrieval of a byte range of an image"""
+        loc = get_location_from_uri(
+            "s3://user:key@auth_address/glance/%s" % FAKE_UUID)
+        (image_s3, image_size) = self.store.get(loc, offset=1024,
+                                                length=2048)
+
+        self.assertEqual(image_size, 2048)
+        self.assertEqual("*" * 2048, "".join(image_s3))
+
+    def test_get_parallel(self):
+        """Test retrieval of an image with parallel ranged GETs"""
+        self.config(s3_store_download_concurrency=3)
+        self.store = Store()
+        self.store.download_chunk_size = 1000
+
+        image_id = uuidutils.generate_uuid()
+        expected_contents = "".join(str(i % 10) for i in xrange(FIVE_KB))
+        location, _, _, _ = self.store.add(
+            image_id, StringIO.StringIO(expected_contents), FIVE_KB)
+
+        requested = []
+        key_cls = stub_out_s3.buckets['glance'].keys[image_id].__class__
+        orig_get_contents_as_string = key_cls.get_contents_as_string
+
+        def fake_get_contents_as_string(key, headers=None):
+            requested.append(headers['Range'])
+            return orig_get_contents_as_string(key, headers=headers)
+
+        self.stubs.Set(key_cls, 'get_contents_as_string',
+                       fake_get_contents_as_string)
+
+        loc = get_location_from_uri(location)
+        (image_s3, image_size) = self.store.get(loc)
+        chunks = iter(image_s3)
+        first = chunks.next()
+        eventlet.sleep(0)
+        # The part being consumed counts against the concurrency
+        self.assertEqual(3, len(requested))
+
+        self.assertEqual(image_size, FIVE_KB)
+        self.assertEqual(expected_contents, first + "".join(chunks))
+        self.assertEqual(6, len(requested))
+        self.assertEqual('bytes=5000-5119', requested[-1])
+
+    def test_get_parallel_range(self):
+        """Test retrieval of a byte range with parallel ranged GETs"""
+        self.config(s3_store_download_concurrency=3)
+        self.store = Store()
+        self.store.download_chunk_size = 1000
+
+        loc = get_location_from_uri(
+            "s3://user:key@auth_address/glance/%s" % FAKE_UUID)
+        (image_s3, image_size) = self.store.get(loc, offset=1024,
+                                                length=2048)
+
+        self.assertEqual(image_size, 2048)
+        self.assertEqual("*" * 2048, "".join(image_s3))
+
     def test_get_calling_format_path(self):
         """Test a "normal" retrieval of an image in chunks"""
         self.config(s3_store_bucket_url_format='path')
@@ -258,6 +360,90 @@ class TestStore(base.StoreClearingUnitTest):
         self.assertEquals(expected_s3_contents, new_image_contents.getvalue())
         self.assertEquals(expected_s3_size, new_image_s3_size)
 
+    def _use_small_parts(self):
+        self.store.large_object_chunk_size = 1024
+
+    def _do_test_add_multipart(self, image_size):
+        self._use_small_parts()
+        expected_image_id = uuidutils.generate_uuid()
+        expected_s3_contents = "*" * FIVE_KB + "#" * 100
+        expected_checksum = hashlib.md5(expected_s3_contents).hexdigest()
+        image_s3 = StringIO.StringIO(expected_s3_contents)
+
+        location, size, checksum, _ = self.store.add(expected_image_id,
+                                                     image_s3, image_size)
+
+        self.assertEquals(len(expected_s3_contents), size)
+        self.assertEquals(expected_checksum, checksum)
+
+        loc = get_location_from_uri(location)
+        (new_image_s3, new_image_size) = self.store.get(loc)
+        self.assertEquals(expected_s3_contents, "".join(new_image_s3))
+        self.assertEquals({}, stub_out_s3.buckets['glance'].uploads)
+
+    def test_add_multipart(self):
+        """Test that large images are added as multipart uploads"""
+        self._do_test_add_multipart(FIVE_KB + 100)
+
+    def test_add_multipart_unknown_size(self):
+        """Test that images of unknown size are added as multipart uploads"""
+        self._do_test_add_multipart(0)
+
+    def test_add_singlepart(self):
+        """Test that small images are added with a single PUT"""
+        self._use_small_parts()
+
+        def fake_initiate_multipart_upload(key_name):
+            self.fail('small images should not be uploaded in parts')
+
+        self.stubs.Set(stub_out_s3.buckets['glance'],
+                       'initiate_multipart_upload',
+                       fake_initiate_multipart_upload)
+        image_s3 = StringIO.StringIO("*" * 1000)
+        location, size, checksum, _ = self.store.add(
+            uuidutils.generate_uuid(), image_s3, 1000)
+
+        self.assertEquals(1000, size)
+        (new_image_s3, new_image_size) = self.store.get(
+            get_location_from_uri(location))
+        self.assertEquals("*" * 1000, "".join(new_image_s3))
+
+    def test_add_multipart_part_fails(self):
+        """
+        Tests that a failed part upload cancels the multipart upload
+        and raises BackendException
+        """
+        self._use_small_parts()
+
+        def fake_upload_part_from_file(fp, part_num, **kwargs):
+            raise Exception('part %d failed' % part_num)
+
+        bucket = stub_out_s3.buckets['glance']
+        orig_initiate_multipart_upload = bucket.initiate_multipart_upload
+
+        def fake_initiate_multipart_upload(key_name):
+            upload = orig_initiate_multipart_upload(key_name)
+            upload.upload_part_from_file = fake_upload_part_from_file
+            return upload
+
+        self.stubs.Set(bucket, 'initiate_multipart_upload',
+                       fake_initiate_multipart_upload)
+
+        image_id = uuidutils.generate_uuid()
+        image_s3 = StringIO.StringIO("*" * FIVE_KB)
+        self.assertRaises(glance.store.BackendException,
+                          self.store.add, image_id, image_s3, FIVE_KB)
+        self.assertEquals({}, bucket.uploads)
+        self.assertFalse(bucket.exists(image_id))
+
+    def test_add_large_object_chunk_size_too_small(self):
+        """
+        Tests that a part size below the S3 minimum disables the add method
+        """
+        self.config(s3_store_large_object_chunk_size=1)
+        self.store = Store()
+        self.assertEqual(self.store.add, self.store.add_disabled)
+
     def test_add_host_variations(self):
         """
         Test that having http(s):// in the s3serviceurl in config
@@ -316,6 +502,77 @@ class TestStore(base.StoreClearingUnitTest):
                           self.store.add,
                           FAKE_UUID, image_s3, 0)
 
+    def _count_calls(self, cls, name):
+        calls = []
+        orig = getattr(cls, name)
+
+        def counting(*args, **kwargs):
+            calls.append(args)
+            return orig(*args, **kwargs)
+
+        self.stubs.Set(cls, name, counting)
+        return calls
+
+    def test_connection_and_bucket_reused(self):
+        """
+        Tests that S3 operations share one connection and bucket handle
+        """
+        inits = self._count_calls(boto.s3.connection.S3Connection,
+                                  '__init__')
+        lookups = self._count_calls(boto.s3.connection.S3Connection,
+                                    'get_bucket')
+
+        image_id = uuidutils.generate_uuid()
+        location, _, _, _ = self.store.add(
+            image_id, StringIO.StringIO("*" * FIVE_KB), FIVE_KB)
+        loc = get_location_from_uri(location)
+        self.assertEqual(FIVE_KB, self.store.get_size(loc))
+        (image_s3, image_size) = self.store.get(loc)
+        self.assertEqual("*" * FIVE_KB, "".join(image_s3))
+        self.store.delete(loc)
+
+        self.assertEqual(1, len(inits))
+        # create_bucket_if_missing and get_bucket on the first add only
+        self.assertEqual(2, len(lookups))
+
+    def test_bucket_cache_expires(self):
+        """
+        Tests that bucket handles are looked up again after their TTL
+        """
+        self.config(s3_store_bucket_cache_ttl=60)
+        lookups = self._count_calls(boto.s3.connection.S3Connection,
+                                    'get_bucket')
+        now = [1000.0]
+        self.stubs.Set(glance.store.s3.time, 'time', lambda: now[0])
+
+        loc = get_location_from_uri(
+            "s3://user:key@auth_address/glance/%s" % FAKE_UUID)
+        self.store.get_size(loc)
+        now[0] += 59
+        self.store.get_size(loc)
+        self.assertEqual(1, len(lookups))
+
+        now[0] += 1
+        self.store.get_size(loc)
+        self.assertEqual(2, len(lookups))
+
+    def test_bucket_cache_disabled(self):
+        """
+        Tests that a TTL of 0 looks the bucket up on every request
+        """
+        self.config(s3_store_bucket_cache_ttl=0)
+        inits = self._count_calls(boto.s3.connection.S3Connection,
+                                  '__init__')
+        lookups = self._count_calls(boto.s3.connection.S3Connection,
+                                    'get_bucket')
+
+        loc = get_location_from_uri(
+            "s3://user:key@auth_address/glance/%s" % FAKE_UUID)
+        self.store.get_size(loc)
+        self.store.get_size(loc)
+        self.assertEqual(1, len(inits))
+        self.assertEqual(2, len(lookups))
+
     def _option_required(self, key):
         conf = S3_CONF.copy()
         conf[key] = None
@@ -0,0 +1,224 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2013 OpenStack, LLC
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Tests the Sheepdog backend store against a fake sheep daemon"""
+
+import hashlib
+import itertools
+import socket
+import SocketServer
+import StringIO
+import struct
+import threading
+
+from glance.common import exception
+from glance.openstack.common import uuidutils
+from glance.store.location import get_location_from_uri
+import glance.store.sheepdog as sheepdog
+from glance.tests.unit import base
+
+
+class FakeSheepHandler(SocketServer.BaseRequestHandler):
+    """
+    Speaks enough of the Sheepdog protocol to serve the requests the
+    store sends, keeping objects in memory.
+    """
+
+    def _recv(self, length):
+        data = ''
+        while len(data) < length:
+            chunk = self.request.recv(length - len(data))
+            if not chunk:
+                return None
+            data += chunk
+        return data
+
+    def handle(self):
+        while True:
+            header = self._recv(sheepdog.SD_HEADER.size)
+            if header is None:
+                return
+            (ver, opcode, flags, epoch, req_id,
+             length, body) = sheepdog.SD_HEADER.unpack(header)
+            data = ''
+            if flags & sheepdog.SD_FLAG_CMD_WRITE:
+                data = self._recv(length)
+            self.server.requests.append(opcode)
+            result, vid, rsp_data = self.server.process(opcode, body, data,
+                                                        length)
+            rsp = struct.pack('<III20x', result, 0, vid)
+            self.request.sendall(sheepdog.SD_HEADER.pack(
+                ver, opcode, 0, epoch, req_id, len(rsp_data), rsp) +
+                rsp_data)
+
+
+class FakeSheep(SocketServer.ThreadingTCPServer):
+
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self):
+        SocketServer.ThreadingTCPServer.__init__(self, ('127.0.0.1', 0),
+                                                 FakeSheepHandler)
+        self.vdis = {}
+        self.objects = {}
+        self.requests = []
+        self.vids = itertools.count(1)
+
+    def process(self, opcode, body, data, length):
+        if opcode in (sheepdog.SD_OP_NEW_VDI, sheepdog.SD_OP_GET_VDI_INFO,
+                      sheepdog.SD_OP_DEL_VDI):
+            name = data[:sheepdog.SD_MAX_VDI_LEN].rstrip('\0')
+            size = sheepdog.SD_VDI_REQ.unpack(body)[0]
+            return self.process_vdi(opcode, name, size)
+
+        oid, cow_oid, copies, rsvd, offset = sheepdog.SD_OBJ_REQ.unpack(body)
+        obj = self.objects.get(oid)
+        if opcode == sheepdog.SD_OP_READ_OBJ:
+            if obj is None:
+                return sheepdog.SD_RES_NO_OBJ, 0, ''
+            return sheepdog.SD_RES_SUCCESS, 0, str(obj[offset:offset +
+                                                       length])
+        if opcode == sheepdog.SD_OP_CREATE_AND_WRITE_OBJ:
+            obj = self.objects[oid] = bytearray(sheepdog.SD_DATA_OBJ_SIZE)
+        elif obj is None:
+            return sheepdog.SD_RES_NO_OBJ, 0, ''
+        obj[offset:offset + len(data)] = data
+        return sheepdog.SD_RES_SUCCESS, 0, ''
+
+    def process_vdi(self, opcode, name, size):
+        vid = self.vdis.get(name)
+        if opcode == sheepdog.SD_OP_NEW_VDI:
+            if vid is not None:
+                return sheepdog.SD_RES_VDI_EXIST, 0, ''
+            vid = self.vdis[name] = self.vids.next()
+            inode = bytearray(sheepdog.SD_INODE_HEADER_SIZE + 4 * 1024)
+            inode[:len(name)] = name
+            struct.pack_into('<Q', inode, sheepdog.SD_INODE_VDI_SIZE_OFFSET,
+                             size)
+            inode[sheepdog.SD_INODE_NR_COPIES_OFFSET] = 1
+            self.objects[sheepdog.vdi_oid(vid)] = inode
+            return sheepdog.SD_RES_SUCCESS, vid, ''
+        if vid is None:
+            return sheepdog.SD_RES_NO_VDI, 0, ''
+        if opcode == sheepdog.SD_OP_DEL_VDI:
+            del self.vdis[name]
+            del self.objects[sheepdog.vdi_oid(vid)]
+        return sheepdog.SD_RES_SUCCESS, vid, ''
+
+
+class TestStore(base.StoreClearingUnitTest):
+
+    def setUp(self):
+        self.server = FakeSheep()
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(self.server.shutdown)
+        self.addCleanup(sheepdog._CLIENTS.clear)
+
+        self.config(default_store='sheepdog',
+                    known_stores=['glance.store.sheepdog.Store'],
+                    sheepdog_store_address='127.0.0.1',
+                    sheepdog_store_port=str(self.server.server_address[1]),
+                    sheepdog_store_chunk_size=1)
+        super(TestStore, self).setUp()
+        self.store = sheepdog.Store()
+
+    def _add(self, data):
+        image_id = uuidutils.generate_uuid()
+        location, size, checksum, _ = self.store.add(
+            image_id, StringIO.StringIO(data), len(data))
+        return get_location_from_uri(location), size, checksum
+
+    def test_add_and_get(self):
+        """Test an image spanning several data objects round trips"""
+        data = ''.join(chr(i % 251) for i in xrange(
+            sheepdog.SD_DATA_OBJ_SIZE + 1000))
+        loc, size, checksum = self._add(data)
+
+        self.assertEqual(len(data), size)
+        self.assertEqual(hashlib.md5(data).hexdigest(), checksum)
+        self.assertEqual(len(data), self.store.get_size(loc))
+
+        (image, image_size) = self.store.get(loc)
+        self.assertEqual(len(data), image_size)
+        self.assertEqual(data, ''.join(image))
+
+    def test_get_range(self):
+        """Test retrieval of a byte range across two data objects"""
+        data = ''.join(chr(i % 251) for i in xrange(
+            sheepdog.SD_DATA_OBJ_SIZE + 1000))
+        loc, size, checksum = self._add(data)
+        offset = sheepdog.SD_DATA_OBJ_SIZE - 10
+
+        (image, image_size) = self.store.get(loc, offset=offset, length=20)
+        self.assertEqual(20, image_size)
+        self.assertEqual(data[offset:offset + 20], ''.join(image))
+
+    def test_unwritten_objects_read_as_zeros(self):
+        """Test that never written data objects read as zeros"""
+        image = sheepdog.SheepdogImage('127.0.0.1',
+                                       self.server.server_address[1],
+                                       'sparse', 1024)
+        image.create(2 * sheepdog.SD_DATA_OBJ_SIZE)
+        image.write('x' * 10, sheepdog.SD_DATA_OBJ_SIZE, 10)
+
+        data = image.read(sheepdog.SD_DATA_OBJ_SIZE - 5, 20)
+        self.assertEqual('\0' * 5 + 'x' * 10 + '\0' * 5, data)
+
+    def test_connection_reused(self):
+        """Test that requests share a pooled connection"""
+        data = 'x' * 1000
+        loc, size, checksum = self._add(data)
+        self.store.get_size(loc)
+        client = sheepdog.get_client('127.0.0.1',
+                                     self.server.server_address[1])
+        self.assertEqual(1, len(client.idle))
+
+    def test_idle_connections_capped(self):
+        """Test that sockets handed back beyond MAX_IDLE_SOCKETS are closed"""
+        self.stubs.Set(sheepdog, 'MAX_IDLE_SOCKETS', 1)
+        client = sheepdog.get_client('127.0.0.1',
+                                     self.server.server_address[1])
+        first = client._connect()
+        second = client._connect()
+        client._release(first)
+        client._release(second)
+
+        self.assertEqual([first], client.idle)
+        self.assertRaises(socket.error, second.send, 'x')
+        first.close()
+
+    def test_add_already_existing(self):
+        """Test that adding an existing image raises Duplicate"""
+        self.store.add('exists', StringIO.StringIO('x'), 1)
+        self.assertRaises(exception.Duplicate, self.store.add, 'exists',
+                          StringIO.StringIO('x'), 1)
+
+    def test_get_non_existing(self):
+        """Test that getting a missing image raises NotFound"""
+        loc = get_location_from_uri('sheepdog://noexist')
+        self.assertRaises(exception.NotFound, self.store.get, loc)
+        self.assertRaises(exception.NotFound, self.store.get_size, loc)
+
+    def test_delete(self):
+        """Test that a deleted image can no longer be found"""
+        loc, size, checksum = self._add('x' * 1000)
+        self.store.delete(loc)
+        self.assertRaises(exception.NotFound, self.store.get, loc)
+        self.assertRaises(exception.NotFound, self.store.delete, loc)
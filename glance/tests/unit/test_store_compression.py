@@ -0,0 +1,148 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2013 OpenStack, LLC
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Tests compression of image data written to a store"""
+
+import hashlib
+import os
+import StringIO
+
+from glance.common import exception
+import glance.context
+from glance.openstack.common import uuidutils
+import glance.store
+from glance.store import compression
+import glance.store.filesystem
+from glance.tests.unit import base
+
+
+class TestCompressedStore(base.IsolatedUnitTest):
+
+    def setUp(self):
+        self.config(compressed_stores=['file:zlib'],
+                    compression_block_size=1)
+        super(TestCompressedStore, self).setUp()
+        compression._LAYOUT_CACHE.clear()
+        self.addCleanup(compression._LAYOUT_CACHE.clear)
+        self.context = glance.context.RequestContext()
+        self.data = 'glance' * 1000
+
+    def _add(self):
+        return glance.store.add_to_backend(self.context, 'file',
+                                           uuidutils.generate_uuid(),
+                                           StringIO.StringIO(self.data),
+                                           len(self.data))
+
+    def test_add_and_get(self):
+        """Test that compressed image data round trips"""
+        location, size, checksum, metadata = self._add()
+
+        self.assertEqual(len(self.data), size)
+        self.assertEqual(hashlib.md5(self.data).hexdigest(), checksum)
+        self.assertEqual({'compression': 'zlib'}, metadata)
+        self.assertTrue(os.path.getsize(location[len('file://'):]) <
+                        len(self.data))
+
+        data, size = glance.store.get_from_backend(self.context, location)
+        self.assertEqual(len(self.data), size)
+        self.assertEqual(self.data, ''.join(data))
+        self.assertEqual(len(self.data),
+                         glance.store.get_size_from_backend(self.context,
+                                                            location))
+
+    def test_get_range(self):
+        """Test reading a range spanning several compressed blocks"""
+        location = self._add()[0]
+        data, size = glance.store.get_from_backend(self.context, location,
+                                                   offset=1000, length=2000)
+        self.assertEqual(2000, size)
+        self.assertEqual(self.data[1000:3000], ''.join(data))
+
+    def test_get_uncompressed(self):
+        """Test that data written before compression was enabled is read"""
+        path = os.path.join(self.test_dir, 'uncompressed')
+        with open(path, 'wb') as f:
+            f.write(self.data)
+        location = 'file://%s' % path
+
+        data, size = glance.store.get_from_backend(self.context, location)
+        self.assertEqual(self.data, ''.join(data))
+        self.assertEqual(len(self.data),
+                         glance.store.get_size_from_backend(self.context,
+                                                            location))
+
+    def test_get_with_location_metadata(self):
+        """
+        Test that the location metadata tells whether the data was
+        compressed, without looking at the stored data
+        """
+        location = self._add()[0]
+        stored_size = os.path.getsize(location[len('file://'):])
+
+        data, size = glance.store.get_from_backend(
+            self.context, location, metadata={u'compression': u'zlib'})
+        self.assertEqual(self.data, ''.join(data))
+
+        def fail_get_size(store, location):
+            self.fail('get_size called')
+
+        self.stubs.Set(glance.store.filesystem.Store, 'get_size',
+                       fail_get_size)
+        data, size = glance.store.get_from_backend(self.context, location,
+                                                   metadata={})
+        self.assertEqual(stored_size, size)
+        self.assertNotEqual(self.data, ''.join(data))
+
+    def test_layout_cached(self):
+        """
+        Test that the index and footer of an object are read once when
+        the location metadata is not known
+        """
+        location = self._add()[0]
+        orig_get_size = glance.store.filesystem.Store.get_size
+        calls = []
+
+        def counting_get_size(store, location):
+            calls.append(location)
+            return orig_get_size(store, location)
+
+        self.stubs.Set(glance.store.filesystem.Store, 'get_size',
+                       counting_get_size)
+        for i in range(2):
+            data, size = glance.store.get_from_backend(self.context,
+                                                       location)
+            self.assertEqual(self.data, ''.join(data))
+            self.assertEqual(len(self.data),
+                             glance.store.get_size_from_backend(self.context,
+                                                                location))
+        self.assertEqual(1, len(calls))
+
+        glance.store.delete_from_backend(self.context, location)
+        self.assertEqual(0, len(compression._LAYOUT_CACHE))
+
+    def test_not_configured(self):
+        """Test that only the configured stores compress data"""
+        self.config(compressed_stores=[])
+        glance.store.create_stores()
+        store = glance.store.get_store_from_scheme(self.context, 'file')
+        self.assertFalse(isinstance(store, compression.CompressedStore))
+
+    def test_unknown_codec(self):
+        """Test that an unknown codec is refused at startup"""
+        self.config(compressed_stores=['file:nosuchcodec'])
+        self.assertRaises(exception.BadStoreConfiguration,
+                          glance.store.create_stores)
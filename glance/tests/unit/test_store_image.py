@@ -12,6 +12,8 @@
 #    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
 #    License for the specific language governing permissions and limitations
 #    under the License.
+import StringIO
+
 import mox
 
 from glance.common import exception
@@ -108,7 +110,7 @@ class TestStoreImage(utils.BaseTestCase):
         self.assertEquals(image.get_data(), 'XXX')
 
     def test_image_get_data_from_second_location(self):
-        def fake_get_from_backend(self, context, location):
+        def fake_get_from_backend(self, context, location, **kwargs):
             if UUID1 in location:
                 raise Exception('not allow download from %s' % location)
             else:
@@ -132,6 +134,46 @@ class TestStoreImage(utils.BaseTestCase):
         self.assertEquals(len(image1.locations), 1)
         image2.delete()
 
+    def _stub_two_cluster_image(self):
+        locations = [{'url': 'rbd://cluster1/pool/%s/snap' % UUID1},
+                     {'url': 'rbd://cluster2/pool/%s/snap' % UUID1}]
+        calls = []
+
+        def fake_get_from_backend(self, context, location, **kwargs):
+            calls.append(location)
+            if 'cluster1' in location:
+                raise Exception('cluster1 is degraded')
+            return 'YYY', 3
+
+        self.stubs.Set(unit_test_utils.FakeStoreAPI, 'get_from_backend',
+                       fake_get_from_backend)
+        image_stub = ImageStub(UUID1, status='active', locations=locations)
+        image = glance.store.ImageProxy(image_stub, {}, self.store_api)
+        return image, calls
+
+    def test_image_get_data_skips_failing_backend(self):
+        image, calls = self._stub_two_cluster_image()
+        self.assertEquals(image.get_data(), 'YYY')
+        self.assertEquals(len(calls), 2)
+
+        del calls[:]
+        self.assertEquals(image.get_data(), 'YYY')
+        self.assertEquals(calls,
+                          ['rbd://cluster2/pool/%s/snap' % UUID1])
+
+    def test_image_get_data_location_preference(self):
+        self.config(location_preference=['rbd://cluster2'])
+        image, calls = self._stub_two_cluster_image()
+        self.assertEquals(image.get_data(), 'YYY')
+        self.assertEquals(calls,
+                          ['rbd://cluster2/pool/%s/snap' % UUID1])
+
+    def test_image_get_data_race(self):
+        self.config(location_race=True)
+        image, calls = self._stub_two_cluster_image()
+        self.assertEquals(''.join(image.get_data()), 'YYY')
+        self.assertEquals(len(calls), 2)
+
     def test_image_set_data(self):
         context = glance.context.RequestContext(user=USER1)
         image_stub = ImageStub(UUID2, status='queued', locations=[])
@@ -162,6 +204,51 @@ class TestStoreImage(utils.BaseTestCase):
                           self.store_api.get_from_backend, {},
                           image.locations[0]['url'])
 
+    def _stub_replica_stores(self, failing_scheme=None):
+        written = {}
+        deleted = []
+
+        def fake_add_to_backend(self, context, scheme, image_id, data, size):
+            written[scheme] = data.read()
+            if scheme == failing_scheme:
+                raise exception.StorageFull()
+            return ('%s://%s' % (scheme, image_id), len(written[scheme]),
+                    'Z', {})
+
+        def fake_safe_delete_from_backend(self, uri, context, id, **kwargs):
+            deleted.append(uri)
+
+        self.stubs.Set(unit_test_utils.FakeStoreAPI, 'add_to_backend',
+                       fake_add_to_backend)
+        self.stubs.Set(unit_test_utils.FakeStoreAPI,
+                       'safe_delete_from_backend',
+                       fake_safe_delete_from_backend)
+        self.config(default_store='file', replica_stores=['file', 'swift'],
+                    replica_store_buffer_chunks=1)
+        return written, deleted
+
+    def test_image_set_data_replicas(self):
+        written, deleted = self._stub_replica_stores()
+        context = glance.context.RequestContext(user=USER1)
+        image_stub = ImageStub(UUID2, status='queued', locations=[])
+        image = glance.store.ImageProxy(image_stub, context, self.store_api)
+        image.set_data(StringIO.StringIO('YYYY'), 4)
+        self.assertEquals(written, {'file': 'YYYY', 'swift': 'YYYY'})
+        self.assertEquals([loc['url'] for loc in image.locations],
+                          ['file://%s' % UUID2, 'swift://%s' % UUID2])
+        self.assertEquals(image.size, 4)
+        self.assertEquals(image.status, 'active')
+
+    def test_image_set_data_replica_failure(self):
+        written, deleted = self._stub_replica_stores(failing_scheme='swift')
+        context = glance.context.RequestContext(user=USER1)
+        image_stub = ImageStub(UUID2, status='queued', locations=[])
+        image = glance.store.ImageProxy(image_stub, context, self.store_api)
+        self.assertRaises(exception.StorageFull, image.set_data,
+                          StringIO.StringIO('YYYY'), 4)
+        self.assertEquals(deleted, ['file://%s' % UUID2])
+        self.assertEquals(image.locations, [])
+
     def test_image_set_data_unknown_size(self):
         context = glance.context.RequestContext(user=USER1)
         image_stub = ImageStub(UUID2, status='queued', locations=[])
@@ -115,7 +115,8 @@ class FakeStoreAPI(object):
             'write': write_tenants,
         }
 
-    def get_from_backend(self, context, location):
+    def get_from_backend(self, context, location, offset=0, length=None,
+                         metadata=None):
         try:
             scheme = location[:location.find('/') - 1]
             if scheme == 'unknown':
@@ -1539,6 +1539,23 @@ class TestGlanceAPI(base.IsolatedUnitTest):
         self.assertEqual(res.content_type, 'application/octet-stream')
         self.assertEqual('chunk00000remainder', res.body)
 
+    def test_show_image_range(self):
+        req = webob.Request.blank("/images/%s" % UUID2)
+        req.headers['Range'] = 'bytes=5-9'
+        res = req.get_response(self.api)
+        self.assertEqual(res.status_int, 206)
+        self.assertEqual('bytes 5-9/19', res.headers['Content-Range'])
+        self.assertEqual('5', res.headers['Content-Length'])
+        self.assertEqual('19', res.headers['x-image-meta-size'])
+        self.assertEqual('00000', res.body)
+
+    def test_show_image_range_not_satisfiable(self):
+        req = webob.Request.blank("/images/%s" % UUID2)
+        req.headers['Range'] = 'bytes=19-'
+        res = req.get_response(self.api)
+        self.assertEqual(res.status_int, 416)
+        self.assertEqual('bytes */19', res.headers['Content-Range'])
+
     def test_show_non_exists_image(self):
         req = webob.Request.blank("/images/%s" % _gen_uuid())
         res = req.get_response(self.api)
@@ -35,6 +35,7 @@ from glance.common import config
 from glance.common import exception
 from glance.common import wsgi
 from glance import context
+import glance.store
 
 CONF = cfg.CONF
 
@@ -49,6 +50,8 @@ class BaseTestCase(testtools.TestCase):
         # the following policy tests
         config.parse_args(args=[])
         self.addCleanup(CONF.reset)
+        self.addCleanup(glance.store.clear_store_cache)
+        self.addCleanup(glance.store.BACKEND_STATS.clear)
         self.stubs = stubout.StubOutForTesting()
         self.stubs.Set(exception, '_FATAL_EXCEPTION_FORMAT_ERRORS', True)
 
@@ -73,6 +76,9 @@ class BaseTestCase(testtools.TestCase):
         group = kw.pop('group', None)
         for k, v in kw.iteritems():
             CONF.set_override(k, v, group)
+        # stores are configured once and cached, so have them pick up
+        # the new values
+        glance.store.clear_store_cache()
 
 
 class requires(object):
@@ -409,6 +415,10 @@ class FakeHTTPResponse(object):
         self.read = self.data.read
         self.status = status
         self.headers = headers or {'content-length': len(data)}
+        self.will_close = kwargs.get('will_close', False)
+
+    def isclosed(self):
+        return self.data.tell() >= self.data.len
 
     def getheader(self, name, default=None):
         return self.headers.get(name.lower(), default)